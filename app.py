@@ -7,14 +7,29 @@ Volcanic forcing and climate response tool
 # --- imports
 
 # std lib imports:
+import datetime
+import functools
 import json
 import os
+import sqlite3
+import sys
+import time
 
 # third party imports:
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, url_for
 
 # local imports:
-from model import run_model
+from binary_format import MIME_TYPE as BINARY_MIME_TYPE, encode_result
+from eva_h.static_data import warm_up
+from jobs import JOB_CONCURRENCY, JOB_FILE, JobQueue
+from model import (
+    check_params, run_model, run_model_batch, run_model_nc, OUTPUT_FULL
+)
+from result_cache import CACHE_FILE, CACHE_SIZE, ResultCache, result_key
+from timing import (
+    finish_timing, server_timing, stage_timer, start_timing, METRICS_FILE,
+    TimingMetrics
+)
 
 # --- global variables
 
@@ -30,9 +45,123 @@ with open(CONFIG_FILE, 'r', encoding='utf-8') as CONFIG_JSON:
     APP_CONFIG = json.load(CONFIG_JSON)
 # define flask app secret key:
 app.secret_key = APP_CONFIG['secret_key']
+# load static eva_h data once per process, so that model runs do no file
+# access:
+warm_up(EVA_H_DIR)
+# size of chunks when streaming NetCDF data, in bytes:
+NC_CHUNK_SIZE = 256 * 1024
+# store of model results, shared between workers:
+RESULT_CACHE = ResultCache(
+    APP_CONFIG.get('result_cache_file', CACHE_FILE),
+    APP_CONFIG.get('result_cache_size', CACHE_SIZE)
+)
+# request and stage latency histograms, shared between workers:
+TIMING_METRICS = TimingMetrics(APP_CONFIG.get('metrics_file', METRICS_FILE))
+# endpoints which are not timed:
+UNTIMED_ENDPOINTS = [None, 'static', 'metrics']
+
+def __store_job_result(request_params, result):
+    """
+    Store the result of a successful job in the result store
+
+    :param request_params: Job parameters
+    :param result: Job result, as returned by run_model
+    """
+    # results with NetCDF data include the url of the data, which is added
+    # when the result is served:
+    if result['status'] != 0:
+        return
+    status, user_params, _ = check_params(request_params)
+    if status and (user_params['output'] == OUTPUT_FULL):
+        return
+    key = result_key(user_params) if status else None
+    if key is not None:
+        __cache_put(key, app.json.dumps(result).encode())
+
+# queue of asynchronous model runs, shared between workers. jobs run in a
+# separate process, which loads the static eva_h data on start up. the
+# dispatcher is started on first use, so importing the app does not run
+# jobs:
+JOB_QUEUE = JobQueue(
+    functools.partial(run_model, EVA_H_DIR),
+    job_file=APP_CONFIG.get('job_file', JOB_FILE),
+    concurrency=APP_CONFIG.get('job_concurrency', JOB_CONCURRENCY),
+    initializer=warm_up, initargs=(EVA_H_DIR,),
+    on_result=__store_job_result
+)
 
 # ---
 
+@app.before_request
+def start_request_timing():
+    """
+    Start timing the stages of the request
+    """
+    if request.endpoint not in UNTIMED_ENDPOINTS:
+        start_timing()
+
+@app.after_request
+def finish_request_timing(response):
+    """
+    Add the request stage times to the Server-Timing header and the latency
+    histograms
+    """
+    timings = finish_timing()
+    if timings is None:
+        return response
+    total, stages = timings
+    # times already reported by the endpoint are kept:
+    endpoint_timing = response.headers.get('Server-Timing')
+    if endpoint_timing:
+        endpoint_stages = [
+            i.split(';')[0].strip() for i in endpoint_timing.split(',')
+        ]
+        response.headers['Server-Timing'] = '{0}, {1}'.format(
+            endpoint_timing, server_timing(total, stages, endpoint_stages)
+        )
+    else:
+        response.headers['Server-Timing'] = server_timing(total, stages)
+    # a streamed body, e.g. NetCDF data, is sent after the headers, so the
+    # Server-Timing header does not include it. the time to send the body is
+    # added to the histograms, as the stream stage, when the response is
+    # closed:
+    endpoint = request.endpoint
+    if response.is_streamed:
+        stream_start = time.perf_counter()
+        def observe_stream():
+            stream_time = time.perf_counter() - stream_start
+            __observe_timing(
+                endpoint, total + stream_time, dict(stages, stream=stream_time)
+            )
+        response.call_on_close(observe_stream)
+    else:
+        __observe_timing(endpoint, total, stages)
+    return response
+
+@app.teardown_request
+def clear_request_timing(error=None):
+    """
+    Stop timing the request, if the timings were not finished, e.g. if
+    handling the request failed, so that they are not added to a later
+    request in this thread
+    """
+    finish_timing()
+
+def __observe_timing(endpoint, total, stages):
+    """
+    Add request timings to the latency histograms, ignoring store failures
+
+    :param endpoint: Name of the request endpoint
+    :param total: Total request time, in seconds
+    :param stages: Dict of stage times, in seconds
+    """
+    try:
+        TIMING_METRICS.observe(endpoint, total, stages)
+    except sqlite3.Error as err_msg:
+        sys.stderr.write('[{0}] [ERROR] timing metrics: {1}\n'.format(
+            datetime.datetime.now(), err_msg
+        ))
+
 # home:
 @app.route('/', methods=['GET'])
 def render_home():
@@ -59,15 +188,286 @@ def render_contact():
 @app.route('/model', methods=['POST'])
 def model():
     """
-    Run the model
+    Run the model. The result is JSON, or the binary format if requested by
+    the format parameter or the Accept header
+    """
+    # get POST data:
+    request_params = request.form.to_dict()
+    binary = __binary_requested(request_params)
+    # the parameters are checked once, and the checked parameters used for
+    # the result key, the model run and the NetCDF url:
+    status, user_params, err_msg = check_params(request_params)
+    if not status:
+        return __result_response(
+            {'status': 1, 'message': err_msg, 'data': {}}, binary
+        )
+    # results are stored by a key from the checked parameters, and the
+    # result format. if the result can not be stored, run the model:
+    key = result_key(user_params)
+    if key is None:
+        return __result_response(__add_nc_url(
+            run_model(EVA_H_DIR, request_params, arrays=binary,
+                      user_params=user_params),
+            request_params, user_params
+        ), binary)
+    if binary:
+        key += '-binary'
+    # results are content addressed, so if the client has a result with
+    # this key, it is current:
+    if request.if_none_match.contains(key):
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        response.vary.add('Accept')
+        return response
+    # use the stored result if available, otherwise run the model and store
+    # successful results:
+    result_data = __cache_get(key)
+    if result_data is None:
+        result = __add_nc_url(
+            run_model(EVA_H_DIR, request_params, arrays=binary,
+                      user_params=user_params),
+            request_params, user_params
+        )
+        response = __result_response(result, binary)
+        if result['status'] != 0:
+            return response
+        __cache_put(key, response.get_data())
+    else:
+        response = app.response_class(
+            result_data,
+            mimetype=BINARY_MIME_TYPE if binary else 'application/json'
+        )
+        response.vary.add('Accept')
+    # return the result:
+    response.set_etag(key)
+    return response
+
+def __binary_requested(request_params):
+    """
+    Return True if the binary result format is requested, either by a
+    format parameter, which is removed from the parameters, or by the Accept
+    header
+
+    :param request_params: Dict of request parameters
+    """
+    result_format = request_params.pop('format', None)
+    if result_format is not None:
+        return result_format == 'binary'
+    return request.accept_mimetypes.best_match(
+        ['application/json', BINARY_MIME_TYPE]
+    ) == BINARY_MIME_TYPE
+
+def __result_response(result, binary):
+    """
+    Return a response for a model result, as JSON or in the binary format
+
+    :param result: Model result, as returned by run_model
+    :param binary: Whether to use the binary format
+    """
+    if binary:
+        with stage_timer('binary'):
+            result_data = encode_result(result)
+        response = app.response_class(
+            result_data, mimetype=BINARY_MIME_TYPE
+        )
+    else:
+        with stage_timer('json'):
+            result_data = app.json.dumps(result)
+        response = app.response_class(
+            result_data, mimetype='application/json'
+        )
+    response.vary.add('Accept')
+    return response
+
+def __add_nc_url(result, request_params, user_params=None):
+    """
+    Add the url of the NetCDF data to a successful model result, if NetCDF
+    data was requested, and return the result
+
+    :param result: Model result, as returned by run_model
+    :param request_params: Model parameters
+    :param user_params: Optional parameters from check_params, if the model
+                        parameters are already checked
+    """
+    if result['status'] != 0:
+        return result
+    status = True
+    if user_params is None:
+        status, user_params, _ = check_params(request_params)
+    if status and (user_params['output'] == OUTPUT_FULL):
+        # list values, from JSON parameters, are given in the '[a,b]' form
+        # which check_params reads, as url_for would repeat the key for each
+        # value:
+        nc_params = {
+            i: '[{0}]'.format(','.join(str(k) for k in j))
+            if isinstance(j, (list, tuple)) else j
+            for i, j in request_params.items()
+            if i not in ['nc', 'output']
+        }
+        result['data']['nc_url'] = url_for('model_nc', **nc_params)
+    return result
+
+# model netcdf data:
+@app.route('/model/nc', methods=['GET'])
+def model_nc():
+    """
+    Run the model, or use the cached model run, and stream the NetCDF data.
+    NetCDF encoding options (nc_packing, nc_shuffle, nc_complevel and
+    nc_chunk_time) may be included with the model parameters
+    """
+    # get the model parameters from the query string:
+    request_params = dict(request.args.to_dict(), nc='1')
+    status, user_params, err_msg = check_params(request_params)
+    if not status:
+        return {'status': 1, 'message': err_msg, 'data': {}}, 400
+    key = result_key(user_params)
+    # if the client has this data, it is current:
+    if (key is not None) and request.if_none_match.contains(key):
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
+    # run the model:
+    result = run_model_nc(EVA_H_DIR, request_params, user_params)
+    if result['status'] != 0:
+        return {'status': result['status'], 'message': result['message'],
+                'data': {}}, 400
+    nc_data = result['data']
+    # stream the data in chunks:
+    def generate_chunks():
+        for i in range(0, len(nc_data), NC_CHUNK_SIZE):
+            yield bytes(nc_data[i:i + NC_CHUNK_SIZE])
+    response = app.response_class(
+        generate_chunks(), mimetype='application/x-netcdf',
+        headers={
+            'Content-Length': str(len(nc_data)),
+            'Content-Disposition': 'attachment; filename=model_data.nc',
+            # report the file size and the time taken to encode it:
+            'X-NetCDF-Size': str(len(nc_data)),
+            'Server-Timing': 'nc_encode;dur={0:.1f}'.format(
+                result['encode_time'] * 1000
+            )
+        }
+    )
+    if key is not None:
+        response.set_etag(key)
+    return response
+
+def __cache_get(key):
+    """
+    Return stored result, or None if not stored or the store fails
+
+    :param key: Result key
+    """
+    try:
+        return RESULT_CACHE.get(key)
+    except sqlite3.Error as err_msg:
+        sys.stderr.write('[{0}] [ERROR] result cache: {1}\n'.format(
+            datetime.datetime.now(), err_msg
+        ))
+        return None
+
+def __cache_put(key, result_json):
+    """
+    Store result, ignoring store failures
+
+    :param key: Result key
+    :param result_json: JSON result, as bytes
+    """
+    try:
+        RESULT_CACHE.put(key, result_json)
+    except sqlite3.Error as err_msg:
+        sys.stderr.write('[{0}] [ERROR] result cache: {1}\n'.format(
+            datetime.datetime.now(), err_msg
+        ))
+
+# batch model:
+@app.route('/model/batch', methods=['POST'])
+def model_batch():
+    """
+    Run the model for a batch of scenarios, supplied as JSON, either as a
+    list of parameter sets or as parameter sets keyed by scenario name
     """
     # get POST data:
-    request_params = request.form
+    batch_params = request.get_json(silent=True)
     # run the model:
-    result = run_model(EVA_H_DIR, request_params)
+    result = run_model_batch(EVA_H_DIR, batch_params)
+    # add netcdf urls for each scenario:
+    scenario_params = batch_params
+    if isinstance(scenario_params, list):
+        scenario_params = {str(i): j for i, j in enumerate(scenario_params)}
+    if isinstance(scenario_params, dict):
+        for scenario_name, scenario_result in result['data'].items():
+            __add_nc_url(scenario_result, scenario_params[scenario_name])
     # return the result:
     return result
 
+# submit model job:
+@app.route('/model/submit', methods=['POST'])
+def model_submit():
+    """
+    Queue a model run, returning the job id without waiting for the run
+    """
+    # get POST data:
+    request_params = request.form.to_dict()
+    # return invalid parameters straight away:
+    status, user_params, err_msg = check_params(request_params)
+    if not status:
+        return {'status': 1, 'message': err_msg, 'data': {}}
+    # if the result is already stored, the job is done straight away:
+    key = result_key(user_params)
+    result_json = None if key is None else __cache_get(key)
+    try:
+        job_id = JOB_QUEUE.submit(request_params, result_json)
+    except sqlite3.Error as err_msg:
+        sys.stderr.write('[{0}] [ERROR] job queue: {1}\n'.format(
+            datetime.datetime.now(), err_msg
+        ))
+        return {'status': 1, 'message': 'job submission failed', 'data': {}}
+    # return the job id, and where to check the job:
+    job_url = url_for('model_job', job_id=job_id)
+    return {
+        'status': 0,
+        'message': 'job submitted',
+        'data': {'job_id': job_id, 'job_url': job_url}
+    }, 202, {'Location': job_url}
+
+# model job status:
+@app.route('/model/jobs/<job_id>', methods=['GET'])
+def model_job(job_id):
+    """
+    Return the status of a model job, and the model result once the job is
+    done
+    """
+    # dispatch jobs from this process, if not already, so that jobs queued
+    # by other workers, or left by a stopped worker, are run:
+    JOB_QUEUE.start()
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        return {'status': 1, 'message': 'job not found', 'data': {}}, 404
+    if 'result' in job:
+        __add_nc_url(job['result'], job['params'])
+    # return the job status:
+    return {'status': 0, 'message': 'job {0}'.format(job['job_status']),
+            'data': job}
+
+# latency metrics:
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Return request and stage latency histograms, for all workers, in the
+    Prometheus text format
+    """
+    try:
+        metrics_text = TIMING_METRICS.prometheus_text()
+    except sqlite3.Error as err_msg:
+        sys.stderr.write('[{0}] [ERROR] timing metrics: {1}\n'.format(
+            datetime.datetime.now(), err_msg
+        ))
+        return 'metrics unavailable\n', 503, {'Content-Type': 'text/plain'}
+    return app.response_class(
+        metrics_text, mimetype='text/plain; version=0.0.4'
+    )
+
 # error:
 @app.errorhandler(Exception)
 def handle_exception(error):
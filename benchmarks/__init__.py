@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the stages of the model pipeline.
+
+Each stage (SO2 injection, sulfate solve, post processing, FAIR, NetCDF
+encoding) and the end to end model run is timed for a fixed set of
+canonical eruptions, with post processing also timed for increasing
+numbers of wavelengths. Results are saved as JSON, and compared against a
+baseline, flagging benchmarks which are slower than the baseline by more
+than a tolerance. Timings depend on the machine, so the baseline is not
+committed, and is saved on the machine where benchmarks are compared, e.g.
+before making a change:
+
+    python -m benchmarks --save-baseline
+    python -m benchmarks --output results.json
+
+The web app is load tested with a mix of /model requests, in process or
+with gunicorn, by:
+
+    python -m benchmarks.load_test
+"""
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run the model pipeline benchmarks, save the results as JSON, and compare
+them against a baseline saved on the same machine.
+
+A benchmark regresses if its minimum time, which is the least affected by
+other load on the machine, is slower than the baseline minimum by more than
+the tolerance, as a fraction of the baseline. The exit status is 1 if any
+benchmark regresses.
+"""
+
+# --- imports
+
+# std lib imports:
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+
+# local imports:
+from benchmarks.cases import benchmark_cases
+
+# --- global variables
+
+# path to the baseline, which is saved locally by --save-baseline, and is
+# not committed, as timings depend on the machine:
+BASELINE_FILE = os.sep.join([
+    os.path.dirname(os.path.realpath(__file__)), 'baseline.json'
+])
+# default number of timed runs of each benchmark:
+REPEAT = 5
+# default tolerance, as a fraction of the baseline minimum time:
+TOLERANCE = 0.25
+
+# ---
+
+def run_benchmarks(repeat=REPEAT, name_filter=None):
+    """
+    Run the benchmarks, returning a results dict, with the minimum, median
+    and mean time of each benchmark, in seconds
+
+    Each timed run calls the benchmark enough times to take at least 0.2
+    seconds, as found by timeit, which also means that one off set up, e.g.
+    loading stored tables, is not timed.
+
+    :param repeat: Number of timed runs of each benchmark
+    :param name_filter: Optional string, only benchmarks with names
+                        containing this string are run
+    """
+    results = {}
+    for name, benchmark in benchmark_cases(name_filter).items():
+        timer = timeit.Timer(benchmark)
+        number, _ = timer.autorange()
+        times = [i / number for i in timer.repeat(repeat, number)]
+        results[name] = {
+            'number': number,
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times)
+        }
+        sys.stdout.write('{0:<32} {1:>10.2f} ms\n'.format(
+            name, results[name]['min'] * 1000
+        ))
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'repeat': repeat,
+        'results': results
+    }
+
+def compare_results(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare benchmark results against a baseline, returning a list of
+    (name, baseline minimum, minimum, relative change) tuples for benchmarks
+    which are in both, and a list of the names of benchmarks which regress
+
+    :param results: Benchmark results, from run_benchmarks
+    :param baseline: Baseline benchmark results
+    :param tolerance: Allowed slow down, as a fraction of the baseline
+                      minimum time
+    """
+    comparison = []
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        baseline_min = baseline['results'][name]['min']
+        change = result['min'] / baseline_min - 1
+        comparison.append((name, baseline_min, result['min'], change))
+        if change > tolerance:
+            regressions.append(name)
+    return comparison, regressions
+
+def __main():
+    """
+    Run the benchmarks from the command line
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark the model pipeline'
+    )
+    parser.add_argument(
+        '--output', default=None, help='output JSON file for the results'
+    )
+    parser.add_argument(
+        '--baseline', default=BASELINE_FILE,
+        help='baseline JSON file (default {0})'.format(BASELINE_FILE)
+    )
+    parser.add_argument(
+        '--save-baseline', action='store_true',
+        help='save the results as the baseline, in place of comparing'
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=TOLERANCE,
+        help='allowed slow down, as a fraction of the baseline minimum time '
+             '(default {0})'.format(TOLERANCE)
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=REPEAT,
+        help='number of timed runs of each benchmark (default {0})'.format(
+            REPEAT
+        )
+    )
+    parser.add_argument(
+        '--filter', default=None,
+        help='only run benchmarks with names containing this string'
+    )
+    args = parser.parse_args()
+    # run the benchmarks:
+    results = run_benchmarks(args.repeat, args.filter)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as results_out:
+            json.dump(results, results_out, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_out:
+            json.dump(results, baseline_out, indent=2)
+        return
+    # compare with the baseline:
+    if not os.path.exists(args.baseline):
+        sys.stderr.write(
+            'no baseline file {0}, save one on this machine with '
+            '--save-baseline\n'.format(args.baseline)
+        )
+        return
+    with open(args.baseline, 'r', encoding='utf-8') as baseline_in:
+        baseline = json.load(baseline_in)
+    comparison, regressions = compare_results(
+        results, baseline, args.tolerance
+    )
+    sys.stdout.write('\n{0:<32} {1:>12} {2:>12} {3:>8}\n'.format(
+        'benchmark', 'baseline ms', 'min ms', 'change'
+    ))
+    for name, baseline_min, min_time, change in comparison:
+        sys.stdout.write(
+            '{0:<32} {1:>12.2f} {2:>12.2f} {3:>+8.0%}{4}\n'.format(
+                name, baseline_min * 1000, min_time * 1000, change,
+                ' REGRESSION' if name in regressions else ''
+            )
+        )
+    if regressions:
+        sys.stderr.write(
+            '{0} benchmarks regressed by more than {1:.0%}\n'.format(
+                len(regressions), args.tolerance
+            )
+        )
+        sys.exit(1)
+
+if __name__ == '__main__':
+    __main()
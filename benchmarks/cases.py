@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+Canonical eruptions and benchmark cases for the model pipeline.
+"""
+
+# --- imports
+
+# std lib imports:
+import functools
+import os
+
+# third party imports:
+from fair.RCPs import rcp45
+import numpy as np
+
+# local imports:
+from eva_h.postproc import postproc
+from eva_h.so2injection_8boxes import so2injection_8boxes
+from eva_h.solvers import solve_so4_mass, FALLBACK_METHOD, PROPAGATOR
+from eva_h.static_data import warm_up
+from fair_emulator import emulate_fair
+from fair_runs import run_fair, volcanic_background
+from model import (
+    check_params, data_to_nc, run_model, FAIR_WINDOW_YEARS, NC_ENCODING,
+    OUTPUT_GLOBAL, STAGE_CACHES, __setup_run
+)
+from sweep import DEFAULT_PARAMS
+
+# --- global variables
+
+# path to eva_h directory:
+EVA_H_DIR = os.sep.join([
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'eva_h'
+])
+# canonical eruptions, as request parameters which update the default web
+# page values:
+ERUPTIONS = {
+    'default': {},
+    'pinatubo': {'lat': '15.1', 'year': '1991', 'month': '6',
+                 'so2_mass': '18', 'so2_height': '25'},
+    'high_latitude': {'lat': '58.3', 'year': '1912', 'month': '6',
+                      'so2_mass': '10', 'so2_height': '16',
+                      'tropo_height': '10'},
+    'tiny_mass': {'so2_mass': '0.01'}
+}
+# numbers of wavelengths for post processing benchmarks:
+WAVELENGTH_COUNTS = [1, 3, 10, 50]
+
+# ---
+
+def __wavelengths(wavelength_count):
+    """
+    Return wavelengths for post processing, in um, including 550nm
+
+    :param wavelength_count: Number of wavelengths
+    """
+    return np.unique(np.concatenate([
+        [0.55], np.linspace(0.3, 2.0, wavelength_count - 1)
+    ]))
+
+def __model_run(request_params):
+    """
+    Return checked model parameters and the model run set up for request
+    parameters
+
+    :param request_params: Model request parameters
+    """
+    status, user_params, err_msg = check_params(request_params)
+    if not status:
+        raise ValueError(err_msg)
+    return user_params, __setup_run(EVA_H_DIR, user_params)
+
+def __fair_forcing(request_params, user_params):
+    """
+    Return the model years, annual mean EVA_H radiative forcing anomaly and
+    FAIR volcanic forcing with the anomaly added, for a model run
+
+    :param request_params: Model request parameters
+    :param user_params: Checked model parameters
+    """
+    model_data = run_model(
+        EVA_H_DIR, dict(request_params, output=OUTPUT_GLOBAL), arrays=True
+    )['data']
+    rf_anom = model_data['fair_rf'] - model_data['fair_rf_wo']
+    model_mask = (model_data['fair_years'] >= user_params['year'].min()) & \
+        (rf_anom != 0)
+    model_years = model_data['fair_years'][model_mask]
+    model_rf_means = rf_anom[model_mask]
+    volcanic_forcing = volcanic_background(user_params['year'])
+    volcanic_forcing[
+        np.searchsorted(rcp45.Emissions.year, model_years)
+    ] += model_rf_means
+    return model_years, model_rf_means, volcanic_forcing
+
+def __run_model_uncached(request_params):
+    """
+    Run the model end to end, clearing the stage caches first
+
+    :param request_params: Model request parameters
+    """
+    for stage_cache in STAGE_CACHES.values():
+        stage_cache.clear()
+    return run_model(EVA_H_DIR, request_params)
+
+def __selected(name, name_filter):
+    """
+    Return True if a benchmark is selected by a name filter
+
+    :param name: Benchmark name
+    :param name_filter: Optional string, only benchmarks with names
+                        containing this string are selected
+    """
+    return (name_filter is None) or (name_filter in name)
+
+def benchmark_cases(name_filter=None):
+    """
+    Return a dict of benchmark functions, which take no arguments, keyed by
+    benchmark name
+
+    The inputs of each benchmark, e.g. solved sulfate masses, are only
+    computed if the benchmark is selected.
+
+    :param name_filter: Optional string, only benchmarks with names
+                        containing this string are returned
+    """
+    # load static data, so that file access is not timed:
+    warm_up(EVA_H_DIR)
+    cases = {}
+    for eruption_name, eruption_params in ERUPTIONS.items():
+        # names of the selected benchmarks for this eruption. post
+        # processing, for each number of wavelengths, and netcdf encoding,
+        # are for the default eruption only:
+        stage_names = [
+            'injection', 'solve_{0}'.format(PROPAGATOR),
+            'solve_{0}'.format(FALLBACK_METHOD), 'fair', 'fair_emulator',
+            'run_model'
+        ]
+        names = ['{0}/{1}'.format(i, eruption_name) for i in stage_names]
+        if eruption_name == 'default':
+            names += ['postproc/wl{0}'.format(i) for i in WAVELENGTH_COUNTS]
+            names.append('data_to_nc/wl3')
+        names = [i for i in names if __selected(i, name_filter)]
+        if not names:
+            continue
+        request_params = dict(DEFAULT_PARAMS, **eruption_params)
+        user_params, model_run = __model_run(request_params)
+        model_params = model_run['model_params']
+        inmass, intime = model_run['inmass'], model_run['intime']
+        tspan, tref = model_run['tspan'], model_run['tref']
+        # stage benchmarks:
+        cases['injection/' + eruption_name] = functools.partial(
+            so2injection_8boxes, EVA_H_DIR, model_params.h1lim,
+            model_params.h2lim, model_params.latlim, user_params
+        )
+        for method in [PROPAGATOR, FALLBACK_METHOD]:
+            cases['solve_{0}/{1}'.format(method, eruption_name)] = \
+                functools.partial(
+                    solve_so4_mass, inmass, intime, model_params, tspan,
+                    tref, method=method
+                )
+        if any(i.startswith('fair') for i in names):
+            model_years, model_rf_means, volcanic_forcing = __fair_forcing(
+                request_params, user_params
+            )
+            end_year = user_params['year'].max() + FAIR_WINDOW_YEARS
+            cases['fair/' + eruption_name] = functools.partial(
+                run_fair, volcanic_forcing, end_year
+            )
+            cases['fair_emulator/' + eruption_name] = functools.partial(
+                emulate_fair, user_params['year'], model_years,
+                model_rf_means, end_year
+            )
+        cases['run_model/' + eruption_name] = functools.partial(
+            __run_model_uncached, request_params
+        )
+        # post processing and netcdf encoding need the solved sulfate mass:
+        if not any(i.startswith(('postproc', 'data_to_nc')) for i in names):
+            continue
+        so4_mass = solve_so4_mass(inmass, intime, model_params, tspan, tref)
+        for wavelength_count in WAVELENGTH_COUNTS:
+            cases['postproc/wl{0}'.format(wavelength_count)] = \
+                functools.partial(
+                    postproc, EVA_H_DIR, so4_mass, model_params,
+                    model_params.mstar, model_params.R_reff,
+                    __wavelengths(wavelength_count)
+                )
+        if 'data_to_nc/wl3' in names:
+            wavelengths = __wavelengths(3)
+            _, saod, _, ext, ssa, asy, lat, alt = postproc(
+                EVA_H_DIR, so4_mass, model_params, model_params.mstar,
+                model_params.R_reff, wavelengths
+            )
+            cases['data_to_nc/wl3'] = functools.partial(
+                data_to_nc, model_run['model_time_dates'], lat, alt,
+                wavelengths * 1000, ext, ssa, asy, saod, NC_ENCODING
+            )
+    # return the selected benchmark functions:
+    return {i: j for i, j in cases.items() if __selected(i, name_filter)}
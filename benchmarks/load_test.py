@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load test for the web app, replaying a mix of /model requests.
+
+Requests are sent by a number of concurrent clients, each sending its next
+request when the last one finishes. The mix of requests is random, with
+configurable numbers of wavelengths, fraction of requests with the nc flag,
+for which the NetCDF data is also downloaded, and fraction of requests
+which repeat earlier parameters, which are served from the result store.
+
+The app is run either in this process, through its WSGI interface, or with
+gunicorn, for each of a set of worker and thread settings. Throughput,
+latency percentiles and the peak memory of each worker are reported. For
+example:
+
+    python -m benchmarks.load_test --target gunicorn --settings 1x1,4x1,4x4
+
+Parameters for new requests are drawn at random, so are not in the result
+store, unless a seed is given and the same requests have been run before.
+"""
+
+# --- imports
+
+# std lib imports:
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# --- global variables
+
+# repository root directory, from which gunicorn is run:
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# default request mix. number of wavelengths for each request, chosen at
+# random, fraction of requests with the nc flag, and fraction of requests
+# which repeat the parameters of an earlier request:
+WAVELENGTH_COUNTS = [1, 3, 10]
+NC_FRACTION = 0.05
+REPEAT_FRACTION = 0.3
+# default number of requests and concurrent clients:
+REQUEST_COUNT = 200
+CONCURRENCY = 4
+# default gunicorn settings, as workersxthreads:
+SETTINGS = '4x1'
+# ranges of random eruption parameters for new requests:
+PARAM_RANGES = {
+    'lat': (-60, 60),
+    'year': (1850, 2050),
+    'month': (1, 12),
+    'so2_mass': (0.1, 50),
+    'so2_height': (18, 35)
+}
+# fixed parameters for all requests:
+FIXED_PARAMS = {
+    'tropo_height': '16',
+    'aerosol_timescale': '8',
+    'rad_eff': '-21.5'
+}
+# seconds between worker memory samples:
+MEMORY_INTERVAL = 0.5
+# seconds to wait for gunicorn to start:
+START_TIMEOUT = 120
+# seconds to wait for a response:
+REQUEST_TIMEOUT = 300
+
+# ---
+
+def request_mix(count, wavelength_counts=None, nc_fraction=NC_FRACTION,
+                repeat_fraction=REPEAT_FRACTION, seed=None):
+    """
+    Return a list of random /model request parameters
+
+    :param count: Number of requests
+    :param wavelength_counts: List of numbers of wavelengths, one of which
+                              is chosen at random for each new request
+    :param nc_fraction: Fraction of new requests with the nc flag
+    :param repeat_fraction: Fraction of requests which repeat the
+                            parameters of an earlier request
+    :param seed: Optional random seed
+    """
+    if wavelength_counts is None:
+        wavelength_counts = WAVELENGTH_COUNTS
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        if requests and (rng.random() < repeat_fraction):
+            requests.append(rng.choice(requests))
+            continue
+        request_params = dict(FIXED_PARAMS)
+        for param_name, param_range in PARAM_RANGES.items():
+            if param_name in ['year', 'month']:
+                request_params[param_name] = str(rng.randint(*param_range))
+            else:
+                request_params[param_name] = str(round(
+                    rng.uniform(*param_range), 3
+                ))
+        # evenly spaced wavelengths, in nm. 550nm is always added by the
+        # model:
+        wavelength_count = rng.choice(wavelength_counts)
+        request_params['wavelengths'] = '[{0}]'.format(','.join(
+            str(round(300 + i * 1700 / max(wavelength_count - 1, 1)))
+            for i in range(wavelength_count)
+        ) if wavelength_count > 1 else '550')
+        if rng.random() < nc_fraction:
+            request_params['nc'] = '1'
+        requests.append(request_params)
+    return requests
+
+class WsgiTarget:
+    """
+    Send requests to the app in this process, through its WSGI interface
+    """
+    def __init__(self):
+        # import here, as loading the app loads the static model data:
+        from app import app
+        self.app = app
+        # test clients are per thread:
+        self.__local = threading.local()
+
+    def request(self, method, url, data=None):
+        """
+        Send a request, returning the status code and response body
+
+        :param method: HTTP method
+        :param url: Request url path
+        :param data: Optional dict of form data
+        """
+        client = getattr(self.__local, 'client', None)
+        if client is None:
+            client = self.app.test_client()
+            self.__local.client = client
+        response = client.open(url, method=method, data=data)
+        return response.status_code, response.get_data()
+
+class HttpTarget:
+    """
+    Send requests to the app over HTTP
+
+    :param base_url: Base url of the app, e.g. http://127.0.0.1:8080
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, url, data=None):
+        """
+        Send a request, returning the status code and response body
+
+        :param method: HTTP method
+        :param url: Request url path
+        :param data: Optional dict of form data
+        """
+        if data is not None:
+            data = urllib.parse.urlencode(data).encode()
+        http_request = urllib.request.Request(
+            self.base_url + url, data=data, method=method
+        )
+        try:
+            with urllib.request.urlopen(
+                http_request, timeout=REQUEST_TIMEOUT
+            ) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as err_msg:
+            return err_msg.code, err_msg.read()
+
+def __send(target, request_params):
+    """
+    Send a /model request, and download the NetCDF data if requested,
+    returning a list of (request type, seconds, success) tuples
+
+    :param target: WsgiTarget or HttpTarget
+    :param request_params: Model request parameters
+    """
+    timings = []
+    start_time = time.perf_counter()
+    try:
+        status, body = target.request('POST', '/model', request_params)
+        result = json.loads(body) if status == 200 else {}
+    except (OSError, ValueError):
+        status, result = None, {}
+    success = result.get('status') == 0
+    timings.append(('model', time.perf_counter() - start_time, success))
+    nc_url = result.get('data', {}).get('nc_url')
+    if success and (nc_url is not None):
+        start_time = time.perf_counter()
+        try:
+            status, _ = target.request('GET', nc_url)
+        except OSError:
+            status = None
+        timings.append(
+            ('model_nc', time.perf_counter() - start_time, status == 200)
+        )
+    return timings
+
+def __rss(pid):
+    """
+    Return the resident memory of a process, in bytes, or None if the
+    process has stopped
+
+    :param pid: Process id
+    """
+    try:
+        with open('/proc/{0}/status'.format(pid), 'r',
+                  encoding='utf-8') as status_in:
+            for line in status_in:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+def __child_pids(pid):
+    """
+    Return the ids of the child processes of a process
+
+    :param pid: Process id
+    """
+    child_pids = []
+    for proc_dir in os.listdir('/proc'):
+        if not proc_dir.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(proc_dir), 'r',
+                      encoding='utf-8') as stat_in:
+                # the parent id follows the bracketed process name:
+                ppid = int(stat_in.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            child_pids.append(int(proc_dir))
+    return child_pids
+
+def __percentile(values, percent):
+    """
+    Return a percentile of a list of values, by linear interpolation
+
+    :param values: List of values
+    :param percent: Percentile, 0 to 100
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * \
+        (position - lower)
+
+def run_load(target, requests, concurrency=CONCURRENCY, worker_pids=None):
+    """
+    Send requests with a number of concurrent clients, returning a dict of
+    throughput, latency percentiles and worker peak memory
+
+    :param target: WsgiTarget or HttpTarget
+    :param requests: List of model request parameters
+    :param concurrency: Number of concurrent clients
+    :param worker_pids: Function returning the ids of the processes serving
+                        requests, for memory sampling
+    """
+    # sample worker memory while the requests run, keeping the peak for
+    # each worker:
+    peak_rss = {}
+    sampling = threading.Event()
+    def sample_memory():
+        while not sampling.wait(MEMORY_INTERVAL):
+            for pid in worker_pids():
+                pid_rss = __rss(pid)
+                if pid_rss is not None:
+                    peak_rss[pid] = max(peak_rss.get(pid, 0), pid_rss)
+    sampler = None
+    if worker_pids is not None:
+        sampler = threading.Thread(target=sample_memory, daemon=True)
+        sampler.start()
+    # send the requests:
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        timings = [
+            j for i in pool.map(lambda i: __send(target, i), requests)
+            for j in i
+        ]
+    duration = time.perf_counter() - start_time
+    if sampler is not None:
+        sampling.set()
+        sampler.join()
+    # latency percentiles for each request type, in seconds:
+    latency = {}
+    for request_type in sorted(set(i[0] for i in timings)):
+        type_times = [i[1] for i in timings if i[0] == request_type]
+        latency[request_type] = {
+            'count': len(type_times),
+            'p50': __percentile(type_times, 50),
+            'p95': __percentile(type_times, 95),
+            'p99': __percentile(type_times, 99)
+        }
+    # return the statistics:
+    return {
+        'requests': len(requests),
+        'errors': sum(1 for i in timings if not i[2]),
+        'duration': duration,
+        'throughput': len(requests) / duration,
+        'latency': latency,
+        'worker_peak_rss': sorted(peak_rss.values())
+    }
+
+def __port_open(port):
+    """
+    Return True if a local port accepts connections
+
+    :param port: Port number
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as test_socket:
+        return test_socket.connect_ex(('127.0.0.1', port)) == 0
+
+def __free_port():
+    """
+    Return an unused local port number
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as test_socket:
+        test_socket.bind(('127.0.0.1', 0))
+        return test_socket.getsockname()[1]
+
+def run_gunicorn_load(workers, threads, requests, concurrency=CONCURRENCY):
+    """
+    Start gunicorn with a number of workers and threads, run the load test
+    against it, and stop it, returning the load test statistics
+
+    :param workers: Number of gunicorn worker processes
+    :param threads: Number of threads per worker
+    :param requests: List of model request parameters
+    :param concurrency: Number of concurrent clients
+    """
+    port = __free_port()
+    gunicorn = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers={0}'.format(workers),
+         '--threads={0}'.format(threads), '--worker-tmp-dir=/dev/shm',
+         '--timeout={0}'.format(REQUEST_TIMEOUT), '--log-level=warning',
+         '--no-control-socket', '--bind=127.0.0.1:{0}'.format(port),
+         'wsgi:app'],
+        cwd=ROOT_DIR, stdout=subprocess.DEVNULL
+    )
+    try:
+        # wait for the workers to start, and load the app:
+        target = HttpTarget('http://127.0.0.1:{0}'.format(port))
+        start_time = time.time()
+        while not __port_open(port):
+            if (gunicorn.poll() is not None) or \
+               (time.time() - start_time > START_TIMEOUT):
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.5)
+        target.request('GET', '/')
+        return run_load(
+            target, requests, concurrency,
+            lambda: __child_pids(gunicorn.pid)
+        )
+    finally:
+        gunicorn.terminate()
+        gunicorn.wait()
+
+def __print_stats(setting, stats):
+    """
+    Print load test statistics
+
+    :param setting: Description of the app setting
+    :param stats: Load test statistics, from run_load
+    """
+    sys.stdout.write(
+        '{0}: {1} requests, {2} errors, {3:.1f} s, {4:.2f} requests/s\n'
+        .format(setting, stats['requests'], stats['errors'],
+                stats['duration'], stats['throughput'])
+    )
+    for request_type, type_latency in stats['latency'].items():
+        sys.stdout.write(
+            '  {0:<9} {1:>5} p50 {2:>8.1f} ms  p95 {3:>8.1f} ms  '
+            'p99 {4:>8.1f} ms\n'.format(
+                request_type, type_latency['count'],
+                type_latency['p50'] * 1000, type_latency['p95'] * 1000,
+                type_latency['p99'] * 1000
+            )
+        )
+    if stats['worker_peak_rss']:
+        sys.stdout.write('  worker peak memory: {0} MB\n'.format(', '.join(
+            '{0:.0f}'.format(i / 1024 ** 2) for i in stats['worker_peak_rss']
+        )))
+
+def __main():
+    """
+    Run the load test from the command line
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.load_test',
+        description='Load test the web app with a mix of /model requests'
+    )
+    parser.add_argument(
+        '--target', choices=['wsgi', 'gunicorn'], default='wsgi',
+        help='run the app in this process, or with gunicorn (default wsgi)'
+    )
+    parser.add_argument(
+        '--settings', default=SETTINGS,
+        help='comma separated gunicorn settings, as workersxthreads '
+             '(default {0})'.format(SETTINGS)
+    )
+    parser.add_argument(
+        '--requests', type=int, default=REQUEST_COUNT,
+        help='number of requests (default {0})'.format(REQUEST_COUNT)
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=CONCURRENCY,
+        help='number of concurrent clients (default {0})'.format(
+            CONCURRENCY
+        )
+    )
+    parser.add_argument(
+        '--wavelength-counts', default=','.join(
+            str(i) for i in WAVELENGTH_COUNTS
+        ),
+        help='comma separated numbers of wavelengths (default {0})'.format(
+            ','.join(str(i) for i in WAVELENGTH_COUNTS)
+        )
+    )
+    parser.add_argument(
+        '--nc-fraction', type=float, default=NC_FRACTION,
+        help='fraction of requests with the nc flag (default {0})'.format(
+            NC_FRACTION
+        )
+    )
+    parser.add_argument(
+        '--repeat-fraction', type=float, default=REPEAT_FRACTION,
+        help='fraction of requests which repeat earlier parameters '
+             '(default {0})'.format(REPEAT_FRACTION)
+    )
+    parser.add_argument(
+        '--seed', type=int, default=None, help='random seed'
+    )
+    parser.add_argument(
+        '--output', default=None, help='output JSON file for the results'
+    )
+    args = parser.parse_args()
+    # a new request mix is drawn for each setting, so that new requests are
+    # not in the result store from an earlier setting:
+    def setting_requests(setting_index):
+        return request_mix(
+            args.requests,
+            [int(i) for i in args.wavelength_counts.split(',')],
+            args.nc_fraction, args.repeat_fraction,
+            None if args.seed is None else args.seed + setting_index
+        )
+    # run the load test for each setting:
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'target': args.target,
+        'concurrency': args.concurrency,
+        'runs': {}
+    }
+    if args.target == 'wsgi':
+        stats = run_load(
+            WsgiTarget(), setting_requests(0), args.concurrency,
+            lambda: [os.getpid()]
+        )
+        __print_stats('wsgi', stats)
+        results['runs']['wsgi'] = stats
+    else:
+        for setting_index, setting in enumerate(args.settings.split(',')):
+            workers, threads = (int(i) for i in setting.split('x'))
+            stats = run_gunicorn_load(
+                workers, threads, setting_requests(setting_index),
+                args.concurrency
+            )
+            __print_stats(setting, stats)
+            results['runs'][setting] = stats
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as results_out:
+            json.dump(results, results_out, indent=2)
+
+if __name__ == '__main__':
+    __main()
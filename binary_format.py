@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact binary encoding of model results.
+
+Model results are mostly numeric arrays, which are slow to convert to JSON
+text and large once converted. In the binary format, the arrays are sent as
+little endian float32 (or int32 for integer values) buffers, and everything
+else as a small JSON header. The coordinate arrays (wavelengths, times and
+latitudes) are small, and used as labels, so are sent as float64, so that
+e.g. a wavelength of 532.1 is not decoded as 532.0999755859375. The format
+is:
+
+    magic       4 bytes, b'V2CB'
+    header_len  uint32, little endian, length of the header in bytes
+    header      UTF-8 JSON, the result with arrays removed from the data,
+                plus an 'arrays' list describing each array
+    padding     zero bytes, so that array data starts at a multiple of 8
+    arrays      array data, each array starting at a multiple of 8 bytes
+
+Each entry in the header 'arrays' list has the 'path' of the array within
+the result data (a list of keys), its 'dtype' ('float32', 'float64' or
+'int32'), its 'shape', and the 'offset' of its data from the start of the
+array data. Arrays are in C order. static/js/home.js has a matching decoder.
+"""
+
+# --- imports
+
+# std lib imports:
+import json
+import struct
+
+# third party imports:
+import numpy as np
+
+# --- global variables
+
+# mime type of the binary format:
+MIME_TYPE = 'application/x-volc2clim-arrays'
+# format identifier at the start of the data:
+MAGIC = b'V2CB'
+# alignment of array data, in bytes:
+ALIGNMENT = 8
+# keys of coordinate arrays, which are sent as float64:
+FLOAT64_KEYS = ['wavelengths', 'time_years', 'lat']
+
+# ---
+
+def __pad_length(length):
+    """
+    Return the number of padding bytes needed after length bytes, for
+    alignment of the next array
+
+    :param length: Length of data in bytes
+    """
+    return -length % ALIGNMENT
+
+def __split_arrays(data, path, arrays):
+    """
+    Return a copy of a result data dict with numpy arrays removed, adding the
+    arrays, with their paths, to a list
+
+    :param data: Dict of result data
+    :param path: List of keys of this dict within the result data
+    :param arrays: List to which (path, array) tuples are added
+    """
+    header_data = {}
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            arrays.append((path + [key], value))
+        elif isinstance(value, dict):
+            header_data[key] = __split_arrays(value, path + [key], arrays)
+        else:
+            header_data[key] = value
+    return header_data
+
+def encode_result(result):
+    """
+    Encode a model result, as returned by run_model with arrays=True, in the
+    binary format, returning bytes
+
+    :param result: Model result dict
+    """
+    # separate the arrays from the rest of the result:
+    arrays = []
+    header = dict(result)
+    header['data'] = __split_arrays(result['data'], [], arrays)
+    # convert the arrays to little endian float32, float64 or int32, and get
+    # their offsets:
+    array_info = []
+    array_data = []
+    offset = 0
+    for path, values in arrays:
+        if np.issubdtype(values.dtype, np.integer):
+            dtype = 'int32'
+            values = np.ascontiguousarray(values, dtype='<i4')
+        elif path[-1] in FLOAT64_KEYS:
+            dtype = 'float64'
+            values = np.ascontiguousarray(values, dtype='<f8')
+        else:
+            dtype = 'float32'
+            values = np.ascontiguousarray(values, dtype='<f4')
+        array_info.append({
+            'path': path, 'dtype': dtype, 'shape': list(values.shape),
+            'offset': offset
+        })
+        array_data.append(values)
+        offset += values.nbytes + __pad_length(values.nbytes)
+    header['arrays'] = array_info
+    # encode the header:
+    header_json = json.dumps(header, separators=(',', ':')).encode()
+    header_end = len(MAGIC) + 4 + len(header_json)
+    # join everything together:
+    buffer = bytearray(header_end + __pad_length(header_end) + offset)
+    buffer[:header_end] = (MAGIC + struct.pack('<I', len(header_json)) +
+                           header_json)
+    data_start = header_end + __pad_length(header_end)
+    for info, values in zip(array_info, array_data):
+        if values.size:
+            array_start = data_start + info['offset']
+            buffer[array_start:array_start + values.nbytes] = \
+                memoryview(values).cast('B')
+    # return the encoded result:
+    return bytes(buffer)
@@ -16,22 +16,14 @@ parameters (coef and backinj)
 import numpy as np
 from numpy.matlib import repmat
 
-def eightboxequations(t,y,inmass,intime,coef,backinj):
+def transportmatrix(t,coef):
 
     '''
     t is the time (real number) in month after January 1st of a user-chosen
     year
-    dydt is the 8x1 vector containing the time derivative of the sulfate mass 
-    in each box (in Tg S/month)
-    y is the 8x1 vector containing the sulfate mass in each box (in Tg S)
-    inmass is a 8xNeru matrix containing the SO2 mass injected in the 8 boxes by
-    the Neru eruptions (in Tg S)
-    intime is a 1xNeru matrix containing the corresponding times of injections
-    (same unit as t)
-    coef is a 53x1 vector containing values for all model parameters (cf
-    parameterfile.m for units)
-    backinj is a 8x1 vector containing background injections in each box (in
-    Tg S/month)
+    C is the 8x8 matrix containing all transport terms, so that the time
+    derivative of the sulfate mass due to transport is C*y
+    coef contains values for all model parameters (cf parameters.py)
     '''
 
     # ==========================================================================
@@ -41,8 +33,6 @@ def eightboxequations(t,y,inmass,intime,coef,backinj):
     # parameterfile.m for details on each parameters and how they were combined
     # into a single vector.
 
-    A = coef.A              # SAOD - sulfate burden scaling factor
-    tauprod = coef.tauprod  # production timescales
     tauloss = coef.tauloss  # loss timescales
     taumixm = coef.taumixm  # average value of mixing timescales
     amix = coef.amix        # amplitude of mixing seasonal cycle
@@ -59,19 +49,8 @@ def eightboxequations(t,y,inmass,intime,coef,backinj):
     taumix = taumixm * (1+amix * np.cos((t-smix)*np.pi/6))
     tauowm = tauowmm * (1+aowm * np.cos((t-sowm)*np.pi/6))
 
-    #  ==========================================================================
-    #  2) Calculate the time derivative of sulfate mass
-    #  ==========================================================================
-
-    # This time derivative is calculated as dydt=C * y+ production + background
-    # The matrix C and term C*y encompasse all transport terms
-    # The term production correspond to new sulfate producted from SO2
-    # injections
-    # The term background correspond to background sulfate injections
-
-
     # ==========================================================================
-    # 2.a) Build the matrix C
+    # 2) Build the matrix C
     # ==========================================================================
     
     # Initiate the matrix with all terms being 0. We will specify non-zero terms
@@ -163,6 +142,51 @@ def eightboxequations(t,y,inmass,intime,coef,backinj):
     C[i,4] = 1/taumix[5]+1/tauowm[5]
     C[i,7] = -(1/tauloss[i])-1/taumix[5]
 
+    return C
+
+def eightboxequations(t,y,inmass,intime,coef,backinj):
+
+    '''
+    t is the time (real number) in month after January 1st of a user-chosen
+    year
+    dydt is the 8x1 vector containing the time derivative of the sulfate mass 
+    in each box (in Tg S/month)
+    y is the 8x1 vector containing the sulfate mass in each box (in Tg S)
+    inmass is a 8xNeru matrix containing the SO2 mass injected in the 8 boxes by
+    the Neru eruptions (in Tg S)
+    intime is a 1xNeru matrix containing the corresponding times of injections
+    (same unit as t)
+    coef is a 53x1 vector containing values for all model parameters (cf
+    parameterfile.m for units)
+    backinj is a 8x1 vector containing background injections in each box (in
+    Tg S/month)
+    '''
+
+    # ==========================================================================
+    # 1) "unwrap" vector containing model parameters
+    # ==========================================================================
+
+    tauprod = coef.tauprod  # production timescales
+
+    #  ==========================================================================
+    #  2) Calculate the time derivative of sulfate mass
+    #  ==========================================================================
+
+    # This time derivative is calculated as dydt=C * y+ production + background
+    # The matrix C and term C*y encompasse all transport terms
+    # The term production correspond to new sulfate producted from SO2
+    # injections
+    # The term background correspond to background sulfate injections
+
+
+    # ==========================================================================
+    # 2.a) Build the matrix C
+    # ==========================================================================
+
+    # The matrix C encompasses all transport terms, see transportmatrix
+
+    C = transportmatrix(t,coef)
+
 
 
     # ==========================================================================
@@ -208,3 +232,149 @@ def eightboxequations(t,y,inmass,intime,coef,backinj):
     #  mass of sulfate in the 8 boxes.
 
     return dydt
+
+class EightBoxRHS:
+
+    '''
+    Right hand side of the eight box equations, for use with solve_ivp, as
+    an alternative to eightboxequations which rebuilds every term at every
+    evaluation.
+
+    C is linear in the reciprocal mixing and one-way mixing timescales, so
+    it is split once per run into a constant loss part and one structure
+    matrix per mixing timescale. At each evaluation only the seasonal
+    reciprocal timescales are updated (and nothing at all without seasonal
+    cycles), and results are written to preallocated arrays.
+
+    inmass, intime, coef and backinj are as for eightboxequations. The
+    analytic Jacobian of the system is C, available from jac for the
+    implicit solve_ivp methods (Radau, BDF and LSODA).
+
+    When integrating piecewise between injection times, nerupt can be set
+    to the number of eruptions (in injection time order) whose SO2 sources
+    are on, so that a source does not switch on at the end of a piece. If
+    nerupt is None, sources are on from their injection time.
+    '''
+
+    def __init__(self,inmass,intime,coef,backinj):
+
+        taumixm = np.asarray(coef.taumixm, dtype=float)
+        tauowmm = np.asarray(coef.tauowmm, dtype=float)
+        self.amix = np.asarray(coef.amix, dtype=float)
+        self.smix = np.asarray(coef.smix, dtype=float)
+        self.aowm = np.asarray(coef.aowm, dtype=float)
+        self.sowm = np.asarray(coef.sowm, dtype=float)
+        self.seasonal = bool(np.any(self.amix) or np.any(self.aowm))
+
+        # Structure matrices, flattened: C with all mixing turned off, and the
+        # change in C per unit reciprocal timescale for each mixing and one-way
+        # mixing box pair
+
+        nomix = np.ones(6)*np.inf
+        self.Closs = transportmatrix(
+            0,_TransportParams(coef.tauloss,nomix,nomix)).ravel()
+        self.Cmix = np.zeros((6,64))
+        self.Cowm = np.zeros((6,64))
+        for k in range(6):
+            unit = nomix.copy()
+            unit[k] = 1
+            self.Cmix[k] = transportmatrix(
+                0,_TransportParams(coef.tauloss,unit,nomix)).ravel()
+            self.Cowm[k] = transportmatrix(
+                0,_TransportParams(coef.tauloss,nomix,unit)).ravel()
+        self.Cmix -= self.Closs
+        self.Cowm -= self.Closs
+
+        # Mean reciprocal timescales, and the constant matrix C without
+        # seasonal cycles
+
+        self.rmixm = 1/taumixm
+        self.rowmm = 1/tauowmm
+        self.C = transportmatrix(0,coef)
+
+        # SO2 sources, ordered by injection time, and background injections
+
+        order = np.argsort(np.atleast_1d(intime), kind='stable')
+        self.intime = np.atleast_1d(np.asarray(intime, dtype=float))[order]
+        self.inmass = np.asarray(inmass, dtype=float)[:,order]
+        self.rtauprod = (1/np.asarray(coef.tauprod, dtype=float))[:,np.newaxis]
+        self.backinj = np.asarray(backinj, dtype=float)
+
+        # Preallocated work arrays
+
+        self._rmix = np.zeros(6)
+        self._rowm = np.zeros(6)
+        self._decay = np.zeros(self.inmass.shape)
+        self._dydt = np.zeros(8)
+        self._C = np.zeros(64)
+        self._Cmix = np.zeros(64)
+
+        # Number of eruptions with sources on, or None to use the injection
+        # times
+
+        self.nerupt = None
+
+        # Number of right hand side and Jacobian evaluations
+
+        self.nfev = 0
+        self.njev = 0
+
+    def matrix(self,t):
+
+        '''
+        Return C at time t. Without seasonal cycles this is the constant C
+        calculated once per run, otherwise an updated work array.
+        '''
+
+        if not self.seasonal:
+            return self.C
+        # taumix = taumixm * (1+amix * cos((t-smix)*pi/6)), as reciprocals
+        np.multiply(self.rmixm, 1/(1+self.amix*np.cos((t-self.smix)*np.pi/6)),
+                    out=self._rmix)
+        np.multiply(self.rowmm, 1/(1+self.aowm*np.cos((t-self.sowm)*np.pi/6)),
+                    out=self._rowm)
+        C = self._C
+        np.matmul(self._rmix, self.Cmix, out=self._Cmix)
+        np.matmul(self._rowm, self.Cowm, out=C)
+        C += self._Cmix
+        C += self.Closs
+        return C.reshape(8,8)
+
+    def __call__(self,t,y):
+
+        self.nfev += 1
+        # sulfate production from the SO2 of eruptions which have occured
+        nerupt = self.nerupt
+        if nerupt is None:
+            nerupt = np.searchsorted(self.intime, t, side='right')
+        np.matmul(self.matrix(t), y, out=self._dydt)
+        self._dydt += self.backinj
+        if nerupt > 0:
+            decay = self._decay[:,:nerupt]
+            np.subtract(self.intime[:nerupt], t, out=decay)
+            decay *= self.rtauprod
+            np.exp(decay, out=decay)
+            decay *= self.inmass[:,:nerupt]
+            self._dydt += np.sum(decay, axis=1)*self.rtauprod[:,0]
+        return self._dydt.copy()
+
+    def jac(self,t,y):
+
+        self.njev += 1
+        return self.matrix(t).copy()
+
+class _TransportParams:
+
+    '''
+    Minimal set of parameters for transportmatrix, used to build the
+    structure matrices of EightBoxRHS
+    '''
+
+    def __init__(self,tauloss,taumixm,tauowmm):
+        self.tauloss = np.asarray(tauloss, dtype=float)
+        self.taumixm = np.asarray(taumixm, dtype=float)
+        self.amix = np.zeros(6)
+        self.smix = np.zeros(6)
+        self.tauowmm = np.asarray(tauowmm, dtype=float)
+        self.aowm = np.zeros(6)
+        self.sowm = np.zeros(6)
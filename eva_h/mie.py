@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batched Mie look-up table interpolation for the EVA_H post processing.
+
+The look-up tables are interpolated linearly in wavelength and effective
+radius, which is what the first order RectBivariateSpline interpolators do,
+with values outside the tables taken from the nearest table edge. The
+tables are first interpolated to the requested wavelengths, then the
+interpolation weights for the effective radius at each point are calculated
+once and used for all tables and wavelengths.
+"""
+
+# --- imports
+
+# third party imports:
+import numpy as np
+
+# --- global variables
+
+# reference wavelength for extinction ratios, in um:
+WL_REF = 0.525
+# maximum effective radius used for look-up table interpolation, in um:
+REFF_MAX = 1.29
+
+# ---
+
+def __interp_weights(grid, values):
+    """
+    Return index of lower grid point and weight of upper grid point for
+    linear interpolation, clamping values to the grid
+
+    :param grid: Numpy array of increasing grid values
+    :param values: Numpy array of values to interpolate to
+    """
+    values = np.clip(values, grid[0], grid[-1])
+    index = np.searchsorted(grid, values, side='right') - 1
+    index = np.clip(index, 0, grid.size - 2)
+    weight = (values - grid[index]) / (grid[index + 1] - grid[index])
+    return index, weight
+
+def __interp_wl(table, wl_index, wl_weight):
+    """
+    Interpolate a (wavelength, effective radius) look-up table to the
+    requested wavelengths
+
+    :param table: Numpy array look-up table
+    :param wl_index: Index of lower wavelength grid points
+    :param wl_weight: Weight of upper wavelength grid points
+    """
+    return (table[wl_index] * (1 - wl_weight)[:, np.newaxis] +
+            table[wl_index + 1] * wl_weight[:, np.newaxis])
+
+def __interp_reff(table, reff_index, reff_weight):
+    """
+    Interpolate a (wavelength, effective radius) table to the effective
+    radius at each point, returning a (point, wavelength) array
+
+    :param table: Numpy array table, interpolated to requested wavelengths
+    :param reff_index: Index of lower effective radius grid points
+    :param reff_weight: Weight of upper effective radius grid points
+    """
+    return (table[:, reff_index].T * (1 - reff_weight)[:, np.newaxis] +
+            table[:, reff_index + 1].T * reff_weight[:, np.newaxis])
+
+def mie_optical_properties(static_data, ext525, reff, wl_req, full=True):
+    """
+    Calculate extinction, single scattering albedo and scattering asymmetry
+    factor at the requested wavelengths
+
+    Points where the extinction at 525nm or the effective radius are NaNs are
+    NaNs in the output arrays, which have the shape of ext525 with a trailing
+    wavelength dimension.
+
+    If full is False, only the extinction is calculated, and single
+    scattering albedo and scattering asymmetry factor are returned as None.
+    Extinction is then only interpolated where the extinction at 525nm is
+    not 0, as it is 0 elsewhere.
+
+    :param static_data: StaticData object holding the Mie look-up tables
+    :param ext525: Numpy array of extinction at 525nm
+    :param reff: Numpy array of effective radius, same shape as ext525
+    :param wl_req: Numpy array of requested wavelengths, in um
+    :param full: Whether to calculate all optical properties
+    """
+    # preallocate memory for EXT, SSA and ASY:
+    out_shape = ext525.shape + (len(wl_req),)
+    ext = np.full(out_shape, np.nan)
+    # ignore points where the extinction at 525nm or effective radius are
+    # NaNs:
+    mask = (~np.isnan(ext525)) & (~np.isnan(reff))
+    if not full:
+        ext[mask] = 0.0
+        mask &= (ext525 != 0)
+    # interpolation weights for the requested wavelengths, with the
+    # reference wavelength appended:
+    wl_index, wl_weight = __interp_weights(
+        static_data.wlgrid_mie, np.append(wl_req, WL_REF)
+    )
+    # interpolation weights for the effective radius at each point:
+    reff_index, reff_weight = __interp_weights(
+        static_data.reffgrid_mie, np.minimum(reff[mask], REFF_MAX)
+    )
+    # calculate the ratio of extinction at desired wavelengths to extinction
+    # at 525nm, and multiply by extinction at 525nm:
+    extrat = __interp_reff(
+        __interp_wl(static_data.extrat_mie, wl_index, wl_weight),
+        reff_index, reff_weight
+    )
+    ext[mask] = ext525[mask][:, np.newaxis] * (extrat[:, :-1] /
+                                              extrat[:, -1:])
+    if not full:
+        return ext, None, None
+    # calculate SSA and ASY:
+    ssa = np.full(out_shape, np.nan)
+    asy = np.full(out_shape, np.nan)
+    ssa[mask] = __interp_reff(
+        __interp_wl(static_data.ssa_mie, wl_index[:-1], wl_weight[:-1]),
+        reff_index, reff_weight
+    )
+    asy[mask] = __interp_reff(
+        __interp_wl(static_data.asy_mie, wl_index[:-1], wl_weight[:-1]),
+        reff_index, reff_weight
+    )
+    # return the values:
+    return ext, ssa, asy
+
+def mie_weighted_extinction(static_data, ext525, reff, wl_req, weights):
+    """
+    Calculate the weighted sum of extinction at the requested wavelengths
+    over all but the first dimension of ext525, returning a (first
+    dimension, wavelength) array
+
+    This gives the same values as summing the output of
+    mie_optical_properties, but the extinction is only calculated where the
+    extinction at 525nm is not 0, and the array of extinction at all points
+    and wavelengths is not made.
+
+    :param static_data: StaticData object holding the Mie look-up tables
+    :param ext525: Numpy array of extinction at 525nm
+    :param reff: Numpy array of effective radius, same shape as ext525
+    :param wl_req: Numpy array of requested wavelengths, in um
+    :param weights: Numpy array of weights, which broadcasts to the shape of
+                    ext525
+    """
+    # points where the extinction is not 0, and the extinction at 525nm and
+    # effective radius are not NaNs:
+    mask = (~np.isnan(ext525)) & (~np.isnan(reff)) & (ext525 != 0)
+    # interpolation weights for the requested wavelengths, with the
+    # reference wavelength appended:
+    wl_index, wl_weight = __interp_weights(
+        static_data.wlgrid_mie, np.append(wl_req, WL_REF)
+    )
+    # interpolation weights for the effective radius at each point:
+    reff_index, reff_weight = __interp_weights(
+        static_data.reffgrid_mie, np.minimum(reff[mask], REFF_MAX)
+    )
+    # weighted extinction at each point, (point, wavelength):
+    extrat = __interp_reff(
+        __interp_wl(static_data.extrat_mie, wl_index, wl_weight),
+        reff_index, reff_weight
+    )
+    point_ext = (ext525 * weights)[mask][:, np.newaxis] * (extrat[:, :-1] /
+                                                           extrat[:, -1:])
+    # sum the points for each index of the first dimension:
+    first_index = np.nonzero(mask)[0]
+    return np.stack([
+        np.bincount(first_index, weights=point_ext[:, i],
+                    minlength=ext525.shape[0])
+        for i in range(len(wl_req))
+    ], axis=1)
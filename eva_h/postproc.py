@@ -8,12 +8,9 @@
 
 #import some packages and define basic functions
 
-import os
 import numpy as np
-from numpy.matlib import repmat
-from scipy.interpolate import interp2d, RectBivariateSpline
-import scipy.io as io
-import netCDF4 as nc
+from eva_h.mie import mie_optical_properties, mie_weighted_extinction
+from eva_h.static_data import get_static_data
 
 def cosd(x):
     I = x/180.
@@ -23,7 +20,22 @@ def cosd(x):
     return y
 
 #This is where the job gets done...
-def postproc(eva_h_dir,SO4mass,modelpara,mstar,R_reff,wl_req):
+def postproc(eva_h_dir,SO4mass,modelpara,mstar,R_reff,wl_req,full=True):
+
+    # The post processing is done in two steps, which can also be run
+    # separately: the spatial distribution of extinction at 525nm and
+    # effective radius, which depends only on the sulfate mass, and the
+    # optical properties at the requested wavelengths
+
+    # If full is False, only the global mean and time-latitude SAOD are
+    # calculated, and ext, ssa and asy are returned as None
+
+    ext525, reff, lat, alt = postproc_spatial(eva_h_dir,SO4mass,modelpara,mstar,R_reff)
+    gmsaod, saod, ext, ssa, asy = postproc_optics(eva_h_dir,ext525,reff,wl_req,full)
+
+    return gmsaod, saod, reff, ext, ssa, asy, lat, alt
+
+def postproc_spatial(eva_h_dir,SO4mass,modelpara,mstar,R_reff):
 
 
     # ==========================================================================
@@ -41,7 +53,7 @@ def postproc(eva_h_dir,SO4mass,modelpara,mstar,R_reff,wl_req):
     # global mean SAOD at 525nm with 2/3 scaling applied for sulfate mass larger
     # than the critical mass mstar.
 
-    waod = modelpara.A*SO4mass*repmat(np.reshape(gmsaod525/gmsaod525_lin,(gmsaod525.shape[0],1)),1, 8)
+    waod = modelpara.A*SO4mass*(gmsaod525/gmsaod525_lin)[:,np.newaxis]
     
     # area-weighted AOD at 525nm in each box, calculated as the mass of sulfate
     # in each box multiplied by the SAOD-sulfate mass scaling factor, and
@@ -61,34 +73,33 @@ def postproc(eva_h_dir,SO4mass,modelpara,mstar,R_reff,wl_req):
     # effective radius
     # ==========================================================================
 
-    shape_func_mat = os.sep.join([eva_h_dir, 'shapefunctions.mat'])
-    shapemat = io.loadmat(shape_func_mat) #load shape functions
-    shapefunctions = shapemat['shapefunctions']
+    # static data sets (shape functions and Mie look-up tables) are loaded
+    # once per process. The shape functions are NaNs outside the
+    # stratosphere, and the registry also holds a copy where these are set
+    # to 0, which is equivalent to the nansum over boxes:
+    static_data = get_static_data(eva_h_dir)
+    shapefunctions = static_data.shapefunctions_masked
     
     # define latitude/altitude grid of the shape functions
     lat = np.arange(-87.5,88, 5)
     alt = np.arange(5, 40, 0.5)
- 
-    ext525 = np.ones((len(totmass),36,70))*np.nan #pre-allocate space for extinction at 525nm
-    massdist = np.ones((len(totmass),36,70))*np.nan #pre-allocate space for sulfate mass
-    for i in range(len(totmass)):
-        # %At each timestep, calculate the extinction at 525nm as the sum, over the
-        # %8 boxes, of the product of the area-weighted AOD in the box by the shape
-        # %function of the same box (cf. companion paper for more details on these
-        # %shape functions and how they were derived). The shape functions return
-        # %extinction in /km
-        ext525[i,:,:] = np.squeeze(np.nansum(np.transpose(np.tile(np.reshape(waod[i,:],(8,1)),(36, 1, 70)),axes=(0,2,1))*shapefunctions,axis=2))
-    
-        # Assume that spatial distribution of sulfate mass is the same as that
-        # of extinction
-        massdist[i,:,:] = np.squeeze(np.nansum(np.transpose(np.tile(np.reshape(SO4mass[i,:], (8,1)), (36, 1, 70)), axes=(0,2,1))*shapefunctions,axis=2))
-
 
+    # At each timestep, calculate the extinction at 525nm as the sum, over the
+    # 8 boxes, of the product of the area-weighted AOD in the box by the shape
+    # function of the same box (cf. companion paper for more details on these
+    # shape functions and how they were derived). The shape functions return
+    # extinction in /km
+    # Assume that spatial distribution of sulfate mass is the same as that
+    # of extinction
+    # Both are calculated for all timesteps with a single contraction over the
+    # box dimension
+    ext525, massdist = np.tensordot(np.stack((waod, SO4mass)), shapefunctions,
+                                    axes=([2], [2]))
 
     # Calculate weight (cos(latitude)*mass) to calculate global mean
     # mass-weighted average
-    latweight = np.transpose(np.tile(np.reshape(cosd(lat),(lat.shape[0],1)),( 70, 1, len(totmass))), axes=(2,1,0))
-    latweight = latweight*massdist/np.transpose(np.tile(np.reshape(np.sum(np.sum(latweight*massdist,axis=1),axis=1), (latweight.shape[0],1)), (massdist.shape[1],1,massdist.shape[2])),axes=(1,0,2))
+    latweight = cosd(lat)[np.newaxis,:,np.newaxis]*massdist
+    latweight /= np.sum(latweight,axis=(1,2))[:,np.newaxis,np.newaxis]
 
     # Assume that local effective radius follows the same spatial distribution
     # as sulfate mass, raised to power 1/3.
@@ -98,10 +109,19 @@ def postproc(eva_h_dir,SO4mass,modelpara,mstar,R_reff,wl_req):
     # Re-scale the effective radius so that the global mean average follows the
     # scaling introduced in the paper, with a minimum value of 0.1um for local
     # effective radius
-    gmreff_scale = np.squeeze(np.nansum(np.nansum(reff*latweight,axis=1),axis=1))
-    reff = 0.101+reff*np.transpose(np.tile(np.reshape((gmreff-0.101)/gmreff_scale,(gmreff_scale.shape[0],1)),(36,1, 70)), axes=(1,0,2))
+    gmreff_scale = np.nansum(reff*latweight,axis=(1,2))
+    reff *= ((gmreff-0.101)/gmreff_scale)[:,np.newaxis,np.newaxis]
+    reff += 0.101
+
 
+    return ext525, reff, lat, alt
 
+def postproc_optics(eva_h_dir,ext525,reff,wl_req,full=True):
+
+    # static data sets and latitude grid of the shape functions (see
+    # postproc_spatial)
+    static_data = get_static_data(eva_h_dir)
+    lat = np.arange(-87.5,88, 5)
 
     # ==========================================================================
     # 3) Calculate time, altitude, latitude and wavelength dependent extinction,
@@ -109,53 +129,18 @@ def postproc(eva_h_dir,SO4mass,modelpara,mstar,R_reff,wl_req):
     # scattering asymmetry factor
     # ==========================================================================
 
-    #Read Mie look-up tables:
-    lookup_nc = os.sep.join([eva_h_dir, 'eva_Mie_lookuptables.nc'])
-    ncid = nc.Dataset(lookup_nc)
-
-    # a) Read effective radius and wavelength grid, and reformat them for
-    # use as input for the 2D interpolation function later
-    reffgrid_mie = ncid['reff'][:]
-    wlgrid_mie = ncid['wl'][:]
-    #[Xwl,Yreff] = np.meshgrid(wlgrid_mie,reffgrid_mie);
-    
-    # b) Read calculated parameters, which are 2D array, with one dimension for
-    # effective radius and the other one for wavelength.
-    
-    extrat_mie = ncid['extrat'][:] #ratio of extinction to extinction at 550nm (EXT)
-    ssa_mie = ncid['ssa'][:] #single scattering albedo (SSA)
-    asy_mie = ncid['asy'][:] #scattering asymmetry factor (ASY)
-    
-    # preallocate memory for calculating EXT, SSA and ASY
-    ext=np.ones((ext525.shape[0],ext525.shape[1],ext525.shape[2],len(wl_req)))*np.nan
-    ssa=np.ones(ext.shape)*np.nan
-    asy=np.ones(ext.shape)*np.nan
-
-    # c) Loop through latitude, altitude and wavelength to calculate them. All
+    # The Mie look-up tables (EXT, SSA and ASY as 2D arrays, with one
+    # dimension for wavelength and the other one for effective radius) and
+    # their linear interpolators are held in the static data registry. All
     # calculations are done by linearly interpolating the Mie lookup tables at
-    # the requested wavelength and the effective radius outputted by the model.
-    extint = RectBivariateSpline(wlgrid_mie,reffgrid_mie,extrat_mie, kx=1, ky=1)
-    ssaint = RectBivariateSpline(wlgrid_mie,reffgrid_mie,ssa_mie, kx=1, ky=1)
-    asyint = RectBivariateSpline(wlgrid_mie,reffgrid_mie,asy_mie, kx=1, ky=1)
-    
-    for ilat in range(len(lat)):
-        for ialt in range(len(alt)):
-            for iwl in range(len(wl_req)):
-                # ignore points in time where the extinction at 525nm or
-                # effective radius are NaNs
-                mask = (~np.isnan(np.squeeze(ext525[:,ilat,ialt]))) & (~ np.isnan(np.squeeze(reff[:,ilat,ialt])))
-                # Calculate the raio of extinction at desired wavelength to
-                # extinction at 525nm
-                temp = np.minimum(reff[mask,ilat,ialt],1.29)               
-                ratio525 = np.squeeze(extint.ev(wl_req[iwl],temp))/np.squeeze(extint.ev(0.525, temp))
-                # multiple above ratio by extinction at 525nm
-                ext[mask,ilat,ialt,iwl] = ext525[mask,ilat,ialt] * ratio525
-                # calculate SSA and ASY
-                ssa[mask,ilat,ialt,iwl] = np.squeeze(ssaint.ev(wl_req[iwl], temp))
-                asy[mask,ilat,ialt,iwl] = np.squeeze(asyint.ev(wl_req[iwl], temp))
-            
-            
-    ssa = np.minimum(ssa, 1.0)
+    # the requested wavelengths and the effective radius outputted by the
+    # model, for all times, latitudes, altitudes and wavelengths at once.
+    # Only the extinction is needed for the SAOD, so SSA and ASY are only
+    # calculated if the full optical properties are requested
+    ext, ssa, asy = mie_optical_properties(static_data, ext525, reff, wl_req, full)
+
+    if full:
+        ssa = np.minimum(ssa, 1.0)
 
     # Calculate stratospheric aerosol optical depth. These are simply the sum of
     # extinction along vertical dimension, multiplied by 0.5 because the
@@ -164,10 +149,26 @@ def postproc(eva_h_dir,SO4mass,modelpara,mstar,R_reff,wl_req):
     saod = np.nansum(ext,axis=2)*0.5
 
     # Calculate weights (cosinus(latitude)) for calculating global mean 
-    latweight = np.transpose(np.tile(np.reshape(cosd(lat),(lat.shape[0],1)),(len(wl_req), 1, len(totmass))),axes=(2,1,0))
-    latweight = latweight/np.squeeze(np.sum(latweight[0,:,0],axis=0))
+    latweight = cosd(lat)/np.sum(cosd(lat))
     # Calculate global mean SAOD
-    gmsaod = np.nansum(saod*latweight,axis=1)
+    gmsaod = np.nansum(saod*latweight[np.newaxis,:,np.newaxis],axis=1)
 
+    if not full:
+        ext = None
 
-    return gmsaod, saod, reff, ext, ssa, asy, lat, alt
+    return gmsaod, saod, ext, ssa, asy
+
+def postproc_global(eva_h_dir,ext525,reff,wl_req):
+
+    # Global mean SAOD only, as calculated by postproc_optics. The global mean
+    # is the sum of extinction weighted by the vertical grid spacing (0.5km)
+    # and the latitude weights, so it is summed directly over the points where
+    # extinction is not 0, without calculating the extinction at every
+    # time, latitude, altitude and wavelength
+    static_data = get_static_data(eva_h_dir)
+    lat = np.arange(-87.5,88, 5)
+    latweight = cosd(lat)/np.sum(cosd(lat))
+    gmsaod = mie_weighted_extinction(static_data, ext525, reff, wl_req,
+                                     0.5*latweight[np.newaxis,:,np.newaxis])
+
+    return gmsaod
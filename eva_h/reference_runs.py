@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+Store of zero SO2 mass reference runs, keyed by start month.
+
+The reference run provides the background sulfate mass and global mean SAOD
+at 550nm, against which the volcanic anomaly is calculated. It depends only
+on the start month and solver method, so it can be calculated offline for
+every start month in the allowed range, using the default solver method,
+and shipped with the application:
+
+    python -m eva_h.reference_runs
+"""
+
+# --- imports
+
+# std lib imports:
+from multiprocessing import Pool
+import os
+import sys
+import threading
+
+# third party imports:
+import numpy as np
+
+# local imports:
+from eva_h.parameters import ModelParams
+from eva_h.postproc import postproc
+from eva_h.solvers import model_times, solve_so4_mass, PROPAGATOR
+
+# --- global variables
+
+# reference run file name within the eva_h directory:
+REF_FILE = 'eva_reference_runs.npz'
+# first and last start months in the store, in months since year 0:
+MONTH_MIN = 1800 * 12
+MONTH_MAX = 2050 * 12 + 11
+# length of each reference run, in months:
+RUN_MONTHS = 5 * 12
+
+# loaded reference runs, keyed by eva_h directory:
+__REF_RUNS = {}
+# lock used when loading reference runs:
+__REF_RUNS_LOCK = threading.Lock()
+
+# ---
+
+def compute_reference_run(eva_h_dir, tspan, method=PROPAGATOR):
+    """
+    Run the model with no volcanic SO2 injection
+
+    Returns sulfate mass, (time, box), and global mean SAOD at 550nm, (time).
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param tspan: Model start and end times, in months since year 0
+    :param method: Solver method
+    """
+    # init the model parameters:
+    model_params = ModelParams()
+    # model output times:
+    tref = model_times(tspan)[0]
+    # zero mass injection at the start time:
+    inmass = np.zeros((8, 1))
+    intime = np.array([tspan[0]])
+    # run the model:
+    so4_mass_ref = solve_so4_mass(
+        inmass, intime, model_params, tspan, tref, method=method
+    )
+    # run the post processing, at 550nm only:
+    gmsaod_ref = postproc(
+        eva_h_dir, so4_mass_ref, model_params, model_params.mstar,
+        model_params.R_reff, np.array([550]) / 1000, full=False
+    )[0]
+    # return the sulfate mass and global mean saod:
+    return so4_mass_ref, gmsaod_ref[:, 0]
+
+def __compute_month(args):
+    """
+    Pool helper for computing the reference run for a single start month
+
+    :param args: Tuple of eva_h directory and start month
+    """
+    eva_h_dir, start_month = args
+    return compute_reference_run(
+        eva_h_dir, [start_month, start_month + RUN_MONTHS]
+    )
+
+def build_reference_runs(eva_h_dir, ref_file=None, processes=None):
+    """
+    Calculate reference runs for all start months and save to file
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param ref_file: Output file, defaults to REF_FILE in eva_h_dir
+    :param processes: Number of worker processes, defaults to cpu count
+    """
+    if ref_file is None:
+        ref_file = os.sep.join([eva_h_dir, REF_FILE])
+    # all start months:
+    start_months = np.arange(MONTH_MIN, MONTH_MAX + 1)
+    # run the model for each start month:
+    with Pool(processes) as pool:
+        ref_runs = pool.map(
+            __compute_month, [(eva_h_dir, i) for i in start_months],
+            chunksize=16
+        )
+    # sulfate mass is diagnostic only, so is stored at single precision:
+    so4_mass_ref = np.array([i[0] for i in ref_runs], dtype=np.float32)
+    gmsaod_ref = np.array([i[1] for i in ref_runs])
+    # save the data:
+    np.savez_compressed(
+        ref_file, start_months=start_months, run_months=RUN_MONTHS,
+        method=PROPAGATOR,
+        so4_mass_ref=so4_mass_ref, gmsaod_ref=gmsaod_ref
+    )
+
+def __load_reference_runs(eva_h_dir):
+    """
+    Load stored reference runs, returning None if there is no stored data
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    """
+    ref_file = os.sep.join([eva_h_dir, REF_FILE])
+    if not os.path.exists(ref_file):
+        return None
+    with np.load(ref_file) as ref_data:
+        ref_runs = {i: ref_data[i] for i in ref_data.files}
+    # the arrays are shared between requests, so make them read only:
+    for i in ref_runs.values():
+        i.flags.writeable = False
+    return ref_runs
+
+def get_reference_run(eva_h_dir, tspan, method=PROPAGATOR):
+    """
+    Return sulfate mass and global mean SAOD at 550nm for a reference run
+
+    Stored values are used where available, loading the store on first use,
+    otherwise the reference run is calculated.
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param tspan: Model start and end times, in months since year 0
+    :param method: Solver method
+    """
+    # stored data is keyed by full path:
+    data_key = os.path.realpath(eva_h_dir)
+    if data_key not in __REF_RUNS:
+        with __REF_RUNS_LOCK:
+            if data_key not in __REF_RUNS:
+                __REF_RUNS[data_key] = __load_reference_runs(eva_h_dir)
+    ref_runs = __REF_RUNS[data_key]
+    # check if this run is in the store:
+    start_month = int(tspan[0])
+    if (ref_runs is not None) and \
+       (str(ref_runs['method']) == method) and \
+       (int(tspan[1]) - start_month == int(ref_runs['run_months'])) and \
+       (ref_runs['start_months'][0] <= start_month <=
+        ref_runs['start_months'][-1]):
+        ref_index = start_month - ref_runs['start_months'][0]
+        return (ref_runs['so4_mass_ref'][ref_index].astype(float),
+                ref_runs['gmsaod_ref'][ref_index])
+    # not stored, calculate the reference run:
+    return compute_reference_run(eva_h_dir, tspan, method=method)
+
+if __name__ == '__main__':
+    # build the store in the eva_h directory, or the directory given:
+    if len(sys.argv) > 1:
+        build_reference_runs(sys.argv[1])
+    else:
+        build_reference_runs(os.path.dirname(os.path.realpath(__file__)))
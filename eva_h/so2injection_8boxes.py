@@ -18,12 +18,15 @@ each box of the model and the time of injection.
 
 #Import a few packages and define basic functions
 
-import os
 import numpy as np
 from numpy.matlib import repmat
-import scipy.io as io
-from scipy.integrate import quad
-import pandas as pd
+from scipy.special import erf
+from eva_h.static_data import get_static_data
+
+def gaussint(xmin, xmax, x0, dx):
+    # Integral of exp(-((x-x0)/dx)**2) from xmin to xmax, for arrays of limits
+    # and centres
+    return 0.5 * np.sqrt(np.pi) * dx * (erf((xmax-x0)/dx) - erf((xmin-x0)/dx))
 
 def cosd(x):
     I = x/180.
@@ -45,9 +48,8 @@ def so2injection_8boxes(eva_h_dir,h1lim,h2lim,latlim,user_params):
 # Load data for tropopause height from NCEP/NCAR reanalysis
 # ==========================================================================
 
-    tropo_mat = os.sep.join([eva_h_dir, 'ncep_tropo.mat'])
-    tropo = io.loadmat(tropo_mat) # zonal mean tropopause height for 1979-2016 
-    tropoheight = tropo['tropoheight']
+    # zonal mean tropopause height for 1979-2016, loaded once per process:
+    tropoheight = get_static_data(eva_h_dir).tropoheight
     
     # Define and time corresponding to NCEP tropopause
     lat = np.arange(-90,92.5, 2.5)
@@ -67,147 +69,73 @@ def so2injection_8boxes(eva_h_dir,h1lim,h2lim,latlim,user_params):
     erulat = user_params['lat']
     erudate = user_params['month']
     timelist = erudate
-    so2mass = user_params['so2_mass']
     # convert mass from Tg to kt:
-    so2mass *= 1e3
+    so2mass = user_params['so2_mass'] * 1e3
     eruheight = user_params['so2_height']
     erutropo = user_params['tropo_height']
-    eruhstar = eruheight / erutropo
     # convert mass from kt so2 to tg of S:
     so2mass = (10**(-3)) * (0.50052) * so2mass
 
     # ==========================================================================
-    # Main loop
+    # Define parameters and distribution functions for all SO2 injections
     # ==========================================================================
-    
-    # Pre-allocate memory for list of mass injected in each box
-    injec=np.zeros((len(erudate),8))
-
-    # Loop through all eruptions
-    for i in range(len(erudate)):
-
-        # ==========================================================================
-        # Define parameters and distribution function for SO2 injection #i
-        # ==========================================================================  
-        h0 = eruheight[i] #height
-        l0 = erulat[i] #latitude
-        dh = 1.2  # vertical thickness of the eruption cloud, in km
-        dl = 7  # latitudinal extent of the eruption cloud, in degree
-        
-        def so2latdist(l):
-            return np.exp(-((l-l0)/dl)**2) #vertical distribution function (gaussian)
-        
-        def so2hgtdist(h):
-            return np.exp(-((h-h0)/dh)**2) #latitudinal distribution function  (gaussian)
-        
-        # Find height of tropopause in latitudinal band
-        ert = np.argmin(abs(erudate[i] - tropotime))
-        SHtrop = climtropoheight[ert,0]
-        Ttrop=climtropoheight[ert,1]
-        NHtrop=climtropoheight[ert,2]
-
-        # For the band where the eruption occur, use local tropopause height at
-        # volcano location
-        if erulat[i] < -latlim:
-            SHtrop = erutropo[i]
-        elif erulat[i] > latlim:
-            NHtrop = erutropo[i]
-        else:
-            Ttrop=erutropo[i];   
-
-
-        
-        #==========================================================================
-        #For each box, calculate the mass injected by eruption #i
-        #========================================================================== 
-        
-    
 
-        # Box 1
-
-        # 1) set integration limits for the box
-
-        lmin = -np.inf 
-        lmax = -latlim #latitudinal limits; box 1 comprise latitudes south of -latlim
-        hmin = h2lim 
-        hmax = h0+100*dh #vertical limits; box one is above h2lim
-
-        # 2) Calculate injected mass in this box by multiplying the mass injected by
-        # the eruption by the product of the distribution functions integrated over the box
-        # limit, and normalized by their quads over the entire domain.
-        # Essentially, this is calculating the fraction of mass injected in a box
-        # and multiplying by the mass injected by the eruption.
-        injec[i,0] = so2mass[i] * (quad(so2latdist,lmin,lmax, epsabs=1.0e-10)[0] *
-                                   quad(so2hgtdist,hmin,hmax,epsabs=1.0e-10)[0]) / (quad(so2hgtdist,h0-100*dh,h0+100*dh, epsabs=1.0e-10)[0]*
-                                                                      quad(so2latdist,l0-100*dl,l0+100*dl, epsabs=1.0e-10)[0])
-
-
-        # Box 2
-        lmin = -latlim 
-        lmax = latlim
-        hmin = h2lim 
-        hmax = h0+100*dh
-        injec[i,1] = so2mass[i] * (quad(so2latdist,lmin,lmax, epsabs=1.0e-10)[0] * 
-                                   quad(so2hgtdist,hmin,hmax, epsabs=1.0e-10)[0])/(quad(so2hgtdist,h0-100*dh,h0+100*dh, epsabs=1.0e-10)[0]*
-                                                                    quad(so2latdist,l0-100*dl,l0+100*dl, epsabs=1.0e-10)[0])
-
-        # Box 3
-        lmin = latlim 
-        lmax = l0+100*dl
-        hmin = h2lim 
-        hmax = h0+100*dh
-        injec[i,2] = so2mass[i] * (quad(so2latdist,lmin,lmax, epsabs=1.0e-10)[0] * 
-                                   quad(so2hgtdist,hmin,hmax, epsabs=1.0e-10)[0])/(quad(so2hgtdist,h0-100*dh,h0+100*dh, epsabs=1.0e-10)[0]*
-                                                                    quad(so2latdist,l0-100*dl,l0+100*dl, epsabs=1.0e-10)[0])
-
-
-        # Box 4
-        lmin = l0-100*dl 
-        lmax = -latlim
-        hmin = Ttrop 
-        hmax = h2lim # the bottom of boxes 4-6 is the tropical tropopause height
-        injec[i,3] = so2mass[i] * (quad(so2latdist,lmin,lmax, epsabs=1.0e-10)[0] * 
-                                   quad(so2hgtdist,hmin,hmax, epsabs=1.0e-10)[0])/(quad(so2hgtdist,h0-100*dh,h0+100*dh, epsabs=1.0e-10)[0]*
-                                                                    quad(so2latdist,l0-100*dl,l0+100*dl, epsabs=1.0e-10)[0])
-
-        # Box 5
-        lmin = -latlim 
-        lmax = +latlim
-        hmin = Ttrop 
-        hmax=h2lim
-        injec[i,4] = so2mass[i] * (quad(so2latdist,lmin,lmax, epsabs=1.0e-10)[0] * 
-                                   quad(so2hgtdist,hmin,hmax, epsabs=1.0e-10)[0])/(quad(so2hgtdist,h0-100*dh,h0+100*dh, epsabs=1.0e-10)[0]*
-                                                                    quad(so2latdist,l0-100*dl,l0+100*dl, epsabs=1.0e-10)[0])
-
-        # Box 6
-        lmin = latlim  
-        lmax = l0+100*dl
-        hmin = Ttrop 
-        hmax = h2lim
-        injec[i,5] = so2mass[i] * (quad(so2latdist,lmin,lmax, epsabs=1.0e-10)[0] * 
-                                   quad(so2hgtdist,hmin,hmax, epsabs=1.0e-10)[0])/(quad(so2hgtdist,h0-100*dh,h0+100*dh, epsabs=1.0e-10)[0]*
-                                                                    quad(so2latdist,l0-100*dl,l0+100*dl, epsabs=1.0e-10)[0])
-
-        # Box 7
-        lmin = -l0-100*dl 
-        lmax = -latlim
-        hmin = SHtrop 
-        hmax = Ttrop #the bottom of box 7 is the SH tropopause height
-        injec[i,6] = so2mass[i] * (quad(so2latdist,lmin,lmax, epsabs=1.0e-10)[0] * 
-                                   quad(so2hgtdist,hmin,hmax, epsabs=1.0e-10)[0])/(quad(so2hgtdist,h0-100*dh,h0+100*dh, epsabs=1.0e-10)[0]*
-                                                                    quad(so2latdist,l0-100*dl,l0+100*dl, epsabs=1.0e-10)[0])
-
-
-        # Box 8
-        lmin = latlim 
-        lmax = l0+100*dl
-        hmin = NHtrop 
-        hmax = Ttrop  #the bottom of box 8 is the NH tropopause height
-        injec[i,7] = so2mass[i] * (quad(so2latdist,lmin,lmax, epsabs=1.0e-10)[0] * 
-                                   quad(so2hgtdist,hmin,hmax, epsabs=1.0e-10)[0])/(quad(so2hgtdist,h0-100*dh,h0+100*dh, epsabs=1.0e-10)[0]*
-                                                                    quad(so2latdist,l0-100*dl,l0+100*dl, epsabs=1.0e-10)[0])
-
-
-    injec = injec.transpose()
+    h0 = eruheight #height
+    l0 = erulat #latitude
+    dh = 1.2  # vertical thickness of the eruption cloud, in km
+    dl = 7  # latitudinal extent of the eruption cloud, in degree
+
+    # The latitudinal and vertical distribution functions are gaussians,
+    # exp(-((l-l0)/dl)**2) and exp(-((h-h0)/dh)**2). Their integrals over the
+    # box limits have exact expressions in terms of the error function, so
+    # are calculated for all eruptions at once, without numerical quadrature.
+
+    # Find height of tropopause in latitudinal band
+    ert = np.argmin(np.abs(erudate[:,np.newaxis] - tropotime), axis=1)
+    SHtrop = climtropoheight[ert,0]
+    Ttrop = climtropoheight[ert,1]
+    NHtrop = climtropoheight[ert,2]
+
+    # For the band where the eruption occur, use local tropopause height at
+    # volcano location
+    SHtrop = np.where(erulat < -latlim, erutropo, SHtrop)
+    NHtrop = np.where(erulat > latlim, erutropo, NHtrop)
+    Ttrop = np.where((-latlim <= erulat) & (erulat <= latlim), erutropo, Ttrop)
+
+    #==========================================================================
+    #For each box, calculate the mass injected by all eruptions
+    #==========================================================================
+
+    # Integration limits for each box. Boxes 1-3 comprise latitudes south of
+    # -latlim, between -latlim and latlim, and north of latlim, and are above
+    # h2lim. The bottom of boxes 4-6 is the tropical tropopause height, and the
+    # bottom of boxes 7 and 8 are the SH and NH tropopause heights. Each entry
+    # is (lmin, lmax, hmin, hmax):
+    boxlims = [
+        (-np.inf, -latlim, h2lim, h0+100*dh), # Box 1
+        (-latlim, latlim, h2lim, h0+100*dh), # Box 2
+        (latlim, l0+100*dl, h2lim, h0+100*dh), # Box 3
+        (l0-100*dl, -latlim, Ttrop, h2lim), # Box 4
+        (-latlim, +latlim, Ttrop, h2lim), # Box 5
+        (latlim, l0+100*dl, Ttrop, h2lim), # Box 6
+        (-l0-100*dl, -latlim, SHtrop, Ttrop), # Box 7
+        (latlim, l0+100*dl, NHtrop, Ttrop) # Box 8
+    ]
+
+    # Integrals of the distribution functions over the entire domain, which
+    # normalise the integrals over each box
+    latnorm = gaussint(l0-100*dl, l0+100*dl, l0, dl)
+    hgtnorm = gaussint(h0-100*dh, h0+100*dh, h0, dh)
+
+    # Calculate injected mass in each box by multiplying the mass injected by
+    # the eruption by the product of the distribution functions integrated over
+    # the box limit, and normalized by their integrals over the entire domain.
+    # Essentially, this is calculating the fraction of mass injected in a box
+    # and multiplying by the mass injected by the eruption.
+    injec = np.zeros((8,len(erudate)))
+    for ibox, (lmin, lmax, hmin, hmax) in enumerate(boxlims):
+        injec[ibox,:] = so2mass * (gaussint(lmin, lmax, l0, dl) *
+                                   gaussint(hmin, hmax, h0, dh)) / (hgtnorm *
+                                                                    latnorm)
 
     return injec, timelist
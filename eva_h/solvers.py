@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time grid and sulfate mass solvers for the EVA_H eight box model.
+
+The eight box equations are linear, dy/dt = C(t)*y + S(t) + backinj, where
+the SO2 source S is a sum of decaying exponentials. Without seasonal cycles
+in mixing, C is constant and the solution at any time can be written down
+exactly from the eigendecomposition of C, which is the default
+'propagator' method. Otherwise, the equations are integrated numerically
+with solve_ivp, which can also be requested explicitly. The SO2 source
+switches on abruptly at each injection time, so the integration is split
+into pieces between injection times, and each piece is evaluated at the
+output times from the solve_ivp dense output. The implicit solve_ivp
+methods are given the analytic Jacobian, C.
+
+Function evaluation counts for each method can be compared for a single
+eruption with:
+
+    python -m eva_h.solvers
+"""
+
+# --- imports
+
+# std lib imports:
+import datetime
+import os
+import sys
+import time
+
+# third party imports:
+import numpy as np
+from scipy.integrate import solve_ivp
+
+# local imports:
+from eva_h.eightboxequations import EightBoxRHS, transportmatrix
+from eva_h.parameters import ModelParams
+from eva_h.so2injection_8boxes import so2injection_8boxes
+
+# --- global variables
+
+# initial sulfate mass in each box, in Tg S:
+IC = np.array([0.0126, 0.0468, 0.0152, 0.0192, 0.0359, 0.0218, 0.0349, 0.0417])
+# exact solver method name:
+PROPAGATOR = 'propagator'
+# numerical method used when the exact solver can not be used:
+FALLBACK_METHOD = 'RK45'
+# available solver methods:
+SOLVER_METHODS = [PROPAGATOR, 'RK45', 'Radau', 'BDF', 'LSODA']
+# solve_ivp methods which use the Jacobian:
+IMPLICIT_METHODS = ['Radau', 'BDF', 'LSODA']
+
+# ---
+
+def model_times(tspan):
+    """
+    Return model output times in months, and the corresponding date strings
+
+    :param tspan: Model start and end times, in months since year 0
+    """
+    # init arrays for model dates:
+    tref = []
+    model_time_dates = []
+    # create time range, where each step is the first day of each month in the
+    # range:
+    for i in np.arange(tspan[0], tspan[1] + 1):
+        # year for this time step:
+        step_yr = int(np.floor(i / 12))
+        # month for this time step:
+        step_month = int((i % 12) + 1)
+        # datetime for this time step:
+        step_dt = datetime.datetime(step_yr, step_month, 1)
+        # day of year for this time step:
+        step_doy = step_dt.timetuple().tm_yday - 1
+        # decimal year for this time step:
+        if (step_yr % 4) == 0:
+            step_dy = step_yr + (step_doy / 365)
+        else:
+            step_dy = step_yr + (step_doy / 366)
+        # date string for this time step:
+        step_str = step_dt.strftime('%Y-%m-%d')
+        # store the date and date string:
+        tref.append(step_dy)
+        model_time_dates.append(step_str)
+    # convert tref to numpy array in months:
+    tref = np.array(tref) * 12
+    # return the times and dates:
+    return tref, model_time_dates
+
+def constant_transport(model_params):
+    """
+    Check if the transport matrix is constant, i.e. there is no seasonal
+    cycle in mixing or one-way mixing
+
+    :param model_params: ModelParams object
+    """
+    return (not np.any(model_params.amix)) and (not np.any(model_params.aowm))
+
+def __expdiff(lam, mu, t):
+    """
+    Return (exp(lam * t) - exp(mu * t)) / (lam - mu), which is the integral
+    from 0 to t of exp(lam * (t - s)) * exp(mu * s), accurately for lam close
+    to mu, and t where lam equals mu
+
+    :param lam: Numpy array of rates
+    :param mu: Numpy array of rates, broadcastable against lam
+    :param t: Numpy array of times, broadcastable against lam
+    """
+    lam, mu, t = np.broadcast_arrays(lam, mu, t)
+    diff = lam - mu
+    # use whichever of lam or mu is the slower decaying as the reference, so
+    # that neither exponential can overflow:
+    lam_ref = np.real(diff) > 0
+    rate = np.where(lam_ref, lam, mu)
+    diff = np.where(lam_ref, -diff, diff)
+    zero_diff = diff == 0
+    safe_diff = np.where(zero_diff, 1, diff)
+    return np.exp(rate * t) * np.where(
+        zero_diff, t, np.expm1(diff * t) / safe_diff
+    )
+
+def solve_so4_mass_propagator(inmass, intime, model_params, tspan, tref):
+    """
+    Return sulfate mass at times tref, from the exact solution of the eight
+    box equations with a constant transport matrix
+
+    :param inmass: SO2 mass injected in each box, (8, Neru), in Tg S
+    :param intime: Injection times, (Neru), in months
+    :param model_params: ModelParams object
+    :param tspan: Model start and end times, in months
+    :param tref: Output times, in months
+    """
+    # a batch of one run:
+    return solve_so4_mass_propagator_batch(
+        np.asarray(inmass, dtype=float)[np.newaxis],
+        np.atleast_1d(np.asarray(intime, dtype=float))[np.newaxis],
+        model_params, model_params.tauprod[np.newaxis],
+        np.asarray(tspan, dtype=float)[np.newaxis],
+        np.asarray(tref, dtype=float)[np.newaxis]
+    )[0]
+
+def solve_so4_mass_propagator_batch(inmass, intime, model_params, tauprod,
+                                    tspan, tref):
+    """
+    Return sulfate mass at times tref for a batch of runs, (run, time, box),
+    from the exact solution of the eight box equations with a constant
+    transport matrix
+
+    All runs share the transport and background injection parameters of
+    model_params, and each run has its own production timescales, SO2
+    injections and times.
+
+    :param inmass: SO2 mass injected in each box, (run, 8, Neru), in Tg S
+    :param intime: Injection times, (run, Neru), in months
+    :param model_params: ModelParams object
+    :param tauprod: Production timescales, (run, 8), in months
+    :param tspan: Model start and end times, (run, 2), in months
+    :param tref: Output times, (run, time), in months
+    """
+    # eigendecomposition of the transport matrix, C = V * diag(lam) * V^-1:
+    lam, vec = np.linalg.eig(transportmatrix(tspan[0, 0], model_params))
+    vec_inv = np.linalg.inv(vec)
+    # time since start, with a trailing axis:
+    t_start = tspan[:, 0]
+    t = (tref - t_start[:, np.newaxis])[:, :, np.newaxis]
+    # in the eigenbasis, each component decays from its initial value, and
+    # the constant background injections add (exp(lam * t) - 1) / lam:
+    z = (np.exp(lam * t) * np.matmul(vec_inv, IC) +
+         __expdiff(lam, 0, t) * np.matmul(vec_inv, model_params.backinj))
+    # the SO2 from each eruption decays with the production timescale of each
+    # box, producing sulfate at rate mass / tauprod. eruptions before the
+    # start time have already partly decayed:
+    t_src = np.maximum(intime, t_start[:, np.newaxis])
+    src = (inmass / tauprod[:, :, np.newaxis] *
+           np.exp(-(t_src - intime)[:, np.newaxis, :] /
+                  tauprod[:, :, np.newaxis]))
+    # time since source start, (run, time, eruption). sources have no effect
+    # before they start:
+    t_erupt = tref[:, :, np.newaxis] - t_src[:, np.newaxis, :]
+    src_on = t_erupt >= 0
+    t_erupt = np.where(src_on, t_erupt, 0)
+    # response of each eigen component to each box source, (run, time,
+    # component, box, eruption):
+    response = __expdiff(
+        lam[np.newaxis, np.newaxis, :, np.newaxis, np.newaxis],
+        -1 / tauprod[:, np.newaxis, np.newaxis, :, np.newaxis],
+        t_erupt[:, :, np.newaxis, np.newaxis, :]
+    )
+    z = z + np.einsum(
+        'ntkje,kj,nje,nte->ntk', response, vec_inv, src, src_on
+    )
+    # back to box masses:
+    so4_mass = np.real(np.matmul(z, vec.T))
+    # return the sulfate mass:
+    return so4_mass
+
+def solve_so4_mass(inmass, intime, model_params, tspan, tref,
+                   method=PROPAGATOR):
+    """
+    Solve the eight box equations and return sulfate mass at times tref
+
+    The exact propagator is used if the transport matrix is constant,
+    otherwise the equations are integrated with solve_ivp, using
+    FALLBACK_METHOD if the propagator was requested.
+
+    At output times up to an injection time, the injected SO2 has not yet
+    produced any sulfate, so the sulfate mass is the background value.
+    Before the propagator was the default, sulfate mass was interpolated
+    from the solve_ivp output with PCHIP, which gave a spurious value at the
+    first output time, e.g. a first global mean SAOD of 0.41, in place of the
+    background 0.004, for a 300 Tg eruption with a one month timescale.
+
+    :param inmass: SO2 mass injected in each box, (8, Neru), in Tg S
+    :param intime: Injection times, (Neru), in months
+    :param model_params: ModelParams object
+    :param tspan: Model start and end times, in months
+    :param tref: Output times, in months
+    :param method: PROPAGATOR, or a solve_ivp method name
+    """
+    # use the exact solution where possible:
+    if method == PROPAGATOR:
+        if constant_transport(model_params):
+            return solve_so4_mass_propagator(
+                inmass, intime, model_params, tspan, tref
+            )
+        method = FALLBACK_METHOD
+    # run the model:
+    so4_mass = solve_so4_mass_ivp(
+        inmass, intime, model_params, tspan, tref, method
+    )[0]
+    # return the sulfate mass:
+    return so4_mass
+
+def solve_so4_mass_ivp(inmass, intime, model_params, tspan, tref, method):
+    """
+    Integrate the eight box equations with solve_ivp, piecewise between
+    injection times, returning sulfate mass at times tref and a dict of
+    solve_ivp evaluation counts
+
+    Output times before the start time are found by integrating backwards
+    from the initial conditions.
+
+    :param inmass: SO2 mass injected in each box, (8, Neru), in Tg S
+    :param intime: Injection times, (Neru), in months
+    :param model_params: ModelParams object
+    :param tspan: Model start and end times, in months
+    :param tref: Output times, in months
+    :param method: solve_ivp method name
+    """
+    # right hand side of the equations:
+    rhs = EightBoxRHS(inmass, intime, model_params, model_params.backinj)
+    # implicit methods use the analytic jacobian:
+    ivp_kwargs = {}
+    if method in IMPLICIT_METHODS:
+        ivp_kwargs['jac'] = rhs.jac
+    # init output arrays:
+    tref = np.asarray(tref, dtype=float)
+    so4_mass = np.zeros((tref.size, IC.size))
+    stats = {'nfev': 0, 'njev': 0, 'nlu': 0}
+    # output times may fall either side of tspan, so the integration runs
+    # from the earliest to the latest of these. split the integration at
+    # the start time and at injection times within the run. output times
+    # before the start time are in piece -1, which is integrated backwards:
+    t_start = tspan[0]
+    t_end = max(tspan[1], np.max(tref))
+    t_breaks = np.unique(np.concatenate([
+        [t_start],
+        rhs.intime[(rhs.intime > t_start) & (rhs.intime < t_end)], [t_end]
+    ]))
+    tref_piece = np.minimum(
+        np.searchsorted(t_breaks, tref, side='right') - 1, t_breaks.size - 2
+    )
+    # solve each piece:
+    pieces = [(i, t_breaks[i:i + 2]) for i in range(t_breaks.size - 1)]
+    if np.min(tref) < t_start:
+        pieces.insert(0, (-1, [t_start, np.min(tref)]))
+    y_start = IC
+    for i, piece_span in pieces:
+        # sources which are on throughout this piece:
+        if i < 0:
+            rhs.nerupt = np.searchsorted(rhs.intime, t_start, side='left')
+        else:
+            rhs.nerupt = np.searchsorted(
+                rhs.intime, piece_span[0], side='right'
+            )
+        sol = solve_ivp(
+            rhs, piece_span, IC if i < 0 else y_start, method=method,
+            rtol=1e-4, atol=1e-8, dense_output=True, **ivp_kwargs
+        )
+        # evaluate at the output times in this piece:
+        piece_mask = tref_piece == i
+        so4_mass[piece_mask] = sol.sol(tref[piece_mask]).T
+        for j in stats:
+            stats[j] += getattr(sol, j)
+        # the next piece starts from the end of this one:
+        if i >= 0:
+            y_start = sol.y[:, -1]
+    # return the sulfate mass and evaluation counts:
+    return so4_mass, stats
+
+def compare_methods(inmass, intime, model_params, tspan, tref,
+                    methods=SOLVER_METHODS):
+    """
+    Run each solver method, returning a dict of function evaluation counts,
+    run time and maximum difference in sulfate mass from the first method
+
+    :param inmass: SO2 mass injected in each box, (8, Neru), in Tg S
+    :param intime: Injection times, (Neru), in months
+    :param model_params: ModelParams object
+    :param tspan: Model start and end times, in months
+    :param tref: Output times, in months
+    :param methods: List of solver methods
+    """
+    stats = {}
+    so4_mass_first = None
+    for method in methods:
+        t_start = time.perf_counter()
+        if method == PROPAGATOR:
+            so4_mass = solve_so4_mass_propagator(
+                inmass, intime, model_params, tspan, tref
+            )
+            method_stats = {'nfev': 0, 'njev': 0, 'nlu': 0}
+        else:
+            so4_mass, method_stats = solve_so4_mass_ivp(
+                inmass, intime, model_params, tspan, tref, method
+            )
+        method_stats['time'] = time.perf_counter() - t_start
+        if so4_mass_first is None:
+            so4_mass_first = so4_mass
+        method_stats['max_diff'] = np.max(np.abs(so4_mass - so4_mass_first))
+        stats[method] = method_stats
+    return stats
+
+def __main(eva_h_dir):
+    """
+    Print solver method comparison for a Pinatubo like eruption
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    """
+    model_params = ModelParams()
+    user_params = {
+        'lat': np.array([15.]), 'year': np.array([1991]),
+        'month': np.array([(6 - 1) + 1991 * 12]),
+        'so2_mass': np.array([7.5]), 'so2_height': np.array([25.]),
+        'tropo_height': np.array([16.])
+    }
+    inmass, intime = so2injection_8boxes(
+        eva_h_dir, model_params.h1lim, model_params.h2lim,
+        model_params.latlim, user_params
+    )
+    tspan = [user_params['month'][0], user_params['month'][0] + 60]
+    tref = model_times(tspan)[0]
+    stats = compare_methods(inmass, intime, model_params, tspan, tref)
+    print('{0:>10} {1:>6} {2:>6} {3:>6} {4:>10} {5:>10}'.format(
+        'method', 'nfev', 'njev', 'nlu', 'time (ms)', 'max diff'
+    ))
+    for method, method_stats in stats.items():
+        print('{0:>10} {1:>6} {2:>6} {3:>6} {4:>10.2f} {5:>10.2e}'.format(
+            method, method_stats['nfev'], method_stats['njev'],
+            method_stats['nlu'], method_stats['time'] * 1000,
+            method_stats['max_diff']
+        ))
+
+if __name__ == '__main__':
+    # use the eva_h directory, or the directory given:
+    if len(sys.argv) > 1:
+        __main(sys.argv[1])
+    else:
+        __main(os.path.dirname(os.path.realpath(__file__)))
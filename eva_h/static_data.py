@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry for the static EVA_H data sets.
+
+The tropopause climatology, shape functions and Mie look-up tables never
+change, so they are read and validated once per process and then held in
+memory.
+"""
+
+# --- imports
+
+# std lib imports:
+import os
+import threading
+
+# third party imports:
+import netCDF4 as nc
+import numpy as np
+import scipy.io as io
+
+# --- global variables
+
+# data file names within the eva_h directory:
+TROPO_FILE = 'ncep_tropo.mat'
+SHAPE_FUNC_FILE = 'shapefunctions.mat'
+MIE_FILE = 'eva_Mie_lookuptables.nc'
+
+# expected shapes of the static arrays:
+TROPO_SHAPE = (73, 456)
+SHAPE_FUNC_SHAPE = (36, 70, 8)
+
+# loaded data, keyed by eva_h directory:
+__STATIC_DATA = {}
+# lock used when loading data:
+__STATIC_DATA_LOCK = threading.Lock()
+
+# ---
+
+class StaticData:
+    """
+    Container for the static EVA_H data sets
+
+    :param tropoheight: NCEP zonal mean tropopause height, (lat, month)
+    :param shapefunctions: Box shape functions, (lat, alt, box), NaNs outside
+                           the stratosphere
+    :param reffgrid_mie: Effective radius grid of the Mie look-up tables
+    :param wlgrid_mie: Wavelength grid of the Mie look-up tables
+    :param extrat_mie: Ratio of extinction to extinction at 550nm
+    :param ssa_mie: Single scattering albedo
+    :param asy_mie: Scattering asymmetry factor
+    """
+    def __init__(self, tropoheight, shapefunctions, reffgrid_mie, wlgrid_mie,
+                 extrat_mie, ssa_mie, asy_mie):
+        # store the arrays:
+        self.tropoheight = tropoheight
+        self.shapefunctions = shapefunctions
+        self.reffgrid_mie = reffgrid_mie
+        self.wlgrid_mie = wlgrid_mie
+        self.extrat_mie = extrat_mie
+        self.ssa_mie = ssa_mie
+        self.asy_mie = asy_mie
+        # shape functions with the NaNs outside the stratosphere set to 0:
+        self.shapefunctions_masked = np.nan_to_num(shapefunctions, nan=0.0)
+        # the arrays are shared between requests, so make them read only:
+        for i in [tropoheight, shapefunctions, self.shapefunctions_masked,
+                  reffgrid_mie, wlgrid_mie, extrat_mie, ssa_mie, asy_mie]:
+            i.flags.writeable = False
+
+def __check_shape(name, values, shape):
+    """
+    Raise a ValueError if an array does not have the expected shape
+
+    :param name: Name of the array, used in the error message
+    :param values: Numpy array to check
+    :param shape: Expected shape of the array
+    """
+    if values.shape != shape:
+        err_msg = 'unexpected shape for {0}: {1} (expected {2})'.format(
+            name, values.shape, shape
+        )
+        raise ValueError(err_msg)
+
+def load_static_data(eva_h_dir):
+    """
+    Read and validate the static EVA_H data sets
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    """
+    # zonal mean tropopause height for 1979-2016:
+    tropo_mat = os.sep.join([eva_h_dir, TROPO_FILE])
+    tropoheight = np.array(io.loadmat(tropo_mat)['tropoheight'], dtype=float)
+    __check_shape('tropoheight', tropoheight, TROPO_SHAPE)
+    # shape functions:
+    shape_func_mat = os.sep.join([eva_h_dir, SHAPE_FUNC_FILE])
+    shapefunctions = np.array(
+        io.loadmat(shape_func_mat)['shapefunctions'], dtype=float
+    )
+    __check_shape('shapefunctions', shapefunctions, SHAPE_FUNC_SHAPE)
+    # Mie look-up tables:
+    lookup_nc = os.sep.join([eva_h_dir, MIE_FILE])
+    with nc.Dataset(lookup_nc) as ncid:
+        mie_data = {
+            i: np.array(np.ma.filled(ncid[i][:], np.nan), dtype=float)
+            for i in ['reff', 'wl', 'extrat', 'ssa', 'asy']
+        }
+    # tables are (wavelength, effective radius):
+    mie_shape = (mie_data['wl'].size, mie_data['reff'].size)
+    for i in ['extrat', 'ssa', 'asy']:
+        __check_shape(i, mie_data[i], mie_shape)
+        if not np.all(np.isfinite(mie_data[i])):
+            raise ValueError('non-finite values in Mie table {0}'.format(i))
+    # interpolation in eva_h.mie needs strictly increasing grids:
+    for i in ['reff', 'wl']:
+        if not np.all(np.diff(mie_data[i]) > 0):
+            raise ValueError('Mie {0} grid is not increasing'.format(i))
+    # return the data:
+    return StaticData(
+        tropoheight, shapefunctions, mie_data['reff'], mie_data['wl'],
+        mie_data['extrat'], mie_data['ssa'], mie_data['asy']
+    )
+
+def get_static_data(eva_h_dir):
+    """
+    Return the static EVA_H data sets, loading them on first use
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    """
+    # data is keyed by full path:
+    data_key = os.path.realpath(eva_h_dir)
+    static_data = __STATIC_DATA.get(data_key)
+    if static_data is None:
+        with __STATIC_DATA_LOCK:
+            static_data = __STATIC_DATA.get(data_key)
+            if static_data is None:
+                static_data = load_static_data(eva_h_dir)
+                __STATIC_DATA[data_key] = static_data
+    # return the data:
+    return static_data
+
+def warm_up(eva_h_dir):
+    """
+    Load the static EVA_H data sets, so that model runs do no file access
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    """
+    get_static_data(eva_h_dir)
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+Linear impulse response emulator for the FAIR response to EVA_H volcanic
+forcing.
+
+The FAIR volcanic forcing output is the volcanic forcing input, so the
+forcing with the EVA_H anomaly added is exact. The temperature response to
+the anomaly is close to linear, so is emulated as the sum of the responses
+to a unit forcing pulse in each year with a forcing anomaly. The response to
+a pulse depends on the background volcanic forcing, so the responses are
+precomputed with FAIR, around the background forcing for each eruption
+year, for pulses in each year of an EVA_H run from that eruption year, and
+stored in a table, which can be rebuilt with:
+
+    python fair_emulator.py
+
+The emulator can be checked against full FAIR runs for eruptions in every
+year in the allowed range, writing a report, with:
+
+    python fair_emulator.py --validate fair_emulator_validation.txt
+"""
+
+# --- imports
+
+# std lib imports:
+import argparse
+import datetime
+import os
+import threading
+
+# third party imports:
+from fair.RCPs import rcp45
+import numpy as np
+
+# local imports:
+from fair_runs import (
+    get_baseline, run_fair, volcanic_background, YEAR_MIN, YEAR_MAX
+)
+
+# --- global variables
+
+# path to response table:
+EMULATOR_FILE = os.sep.join([
+    os.path.dirname(os.path.realpath(__file__)), 'fair_emulator.npz'
+])
+# number of years after the eruption year for which pulse responses are
+# stored. eva_h forcing anomalies are for up to six calendar years after the
+# eruption year:
+PULSE_YEARS = 7
+# number of years of response to each pulse, which covers output up to 10
+# years after the last eruption, for eruptions up to 20 years apart:
+RESPONSE_YEARS = 32
+# size of the forcing pulse, in W m-2. volcanic forcing anomalies are
+# negative:
+PULSE_FORCING = -1.0
+# scalings of the validation forcing anomaly for single eruptions:
+VALIDATION_SCALES = [0.01, 0.1, 1.0, 3.0]
+# annual mean forcing anomaly, in W m-2, from the eruption year, used for
+# validation. this is the model output for an 18 Tg SO2 eruption at 15.1N
+# in june, at 25 km, with the default radiative efficiency:
+VALIDATION_FORCING = np.array([
+    -1.037, -1.9942, -0.9689, -0.2804, -0.0691, -0.0218
+])
+
+# loaded response table:
+__EMULATOR = {}
+# lock used when loading response table:
+__EMULATOR_LOCK = threading.Lock()
+
+# ---
+
+def __year_index(years):
+    """
+    Return index of years in rcp45 emissions years
+
+    :param years: Year, or array of years
+    """
+    return np.asarray(years, dtype=int) - int(rcp45.Emissions.year[0])
+
+def build_emulator(emulator_file=EMULATOR_FILE):
+    """
+    Run FAIR with a forcing pulse in each year of an EVA_H run from every
+    eruption year, and save the temperature response per unit forcing to
+    file
+
+    :param emulator_file: Output file
+    """
+    years = np.arange(YEAR_MIN, YEAR_MAX + 1)
+    response = np.zeros((years.size, PULSE_YEARS, RESPONSE_YEARS))
+    for i, eruption_year in enumerate(years):
+        # the responses are calculated around the background forcing for
+        # this eruption year:
+        base_forcing = volcanic_background(eruption_year)
+        base_temp = run_fair(
+            base_forcing, eruption_year + PULSE_YEARS + RESPONSE_YEARS - 2
+        )[1]
+        for j in range(PULSE_YEARS):
+            pulse_index = int(__year_index(eruption_year + j))
+            end_year = eruption_year + j + RESPONSE_YEARS - 1
+            pulse_forcing = base_forcing.copy()
+            pulse_forcing[pulse_index] += PULSE_FORCING
+            pulse_temp = run_fair(pulse_forcing, end_year)[1]
+            response[i, j] = \
+                (pulse_temp - base_temp[:pulse_temp.size])[pulse_index:] / \
+                PULSE_FORCING
+    np.savez_compressed(emulator_file, years=years, response=response)
+
+def __load_emulator():
+    """
+    Load stored response table
+    """
+    with np.load(EMULATOR_FILE) as emulator_data:
+        emulator = {i: emulator_data[i] for i in emulator_data.files}
+    # the arrays are shared between requests, so make them read only:
+    for i in emulator.values():
+        i.flags.writeable = False
+    return emulator
+
+def emulate_fair(eruption_years, model_years, model_rf_means, end_year):
+    """
+    Return emulated FAIR volcanic forcing and temperature, for rcp45
+    emissions years up to end_year, with the EVA_H volcanic forcing anomaly
+    added to the forcing without EVA_H volcanic forcing
+
+    The forcing anomaly may have a leading dimension of samples, in which
+    case the outputs have the same leading dimension. For each model year,
+    the response around the background forcing for the latest eruption in
+    or before that year is used, or, where that eruption was PULSE_YEARS or
+    more years before, the response from PULSE_YEARS - 1 years before.
+
+    :param eruption_years: Eruption year, or array of eruption years
+    :param model_years: Numpy array of model years
+    :param model_rf_means: Numpy array of annual mean radiative forcing
+                           anomaly, with model years as the last dimension
+    :param end_year: Last year of the output
+    """
+    if 'table' not in __EMULATOR:
+        with __EMULATOR_LOCK:
+            if 'table' not in __EMULATOR:
+                __EMULATOR['table'] = __load_emulator()
+    emulator = __EMULATOR['table']
+    eruption_years = np.unique(eruption_years)
+    # table row and pulse year for each model year:
+    row_years = eruption_years[np.maximum(
+        np.searchsorted(eruption_years, model_years, side='right') - 1, 0
+    )]
+    row_years = np.maximum(row_years, model_years - (PULSE_YEARS - 1))
+    # check the years are covered by the table:
+    if (model_years.min() < eruption_years.min()) or \
+       (row_years.min() < emulator['years'][0]) or \
+       (row_years.max() > emulator['years'][-1]) or \
+       (end_year - model_years.min() >= emulator['response'].shape[-1]):
+        raise ValueError('years not covered by the FAIR emulator')
+    # fair without eva_h updates:
+    forcing_a, temp_a = get_baseline(eruption_years)
+    year_count = int(__year_index(end_year)) + 1
+    # matrix of responses to forcing in each model year, (model year, year):
+    response = np.zeros((model_years.size, year_count))
+    for i, model_year in enumerate(model_years):
+        year_index = int(__year_index(model_year))
+        response[i, year_index:] = emulator['response'][
+            row_years[i] - emulator['years'][0], model_year - row_years[i],
+            :year_count - year_index
+        ]
+    # add the forcing anomaly and the temperature response:
+    forcing = np.broadcast_to(
+        forcing_a[:year_count], model_rf_means.shape[:-1] + (year_count,)
+    ).copy()
+    forcing[..., __year_index(model_years)] += model_rf_means
+    temp = temp_a[:year_count] + model_rf_means @ response
+    # return the values:
+    return forcing, temp
+
+def __validation_cases():
+    """
+    Return the validation cases, as a list of (description, list of
+    (eruption years, model years, forcing anomaly)) tuples
+    """
+    years = range(YEAR_MIN, YEAR_MAX + 1)
+    cases = []
+    # single eruptions in every year, at each scaling:
+    for scale in VALIDATION_SCALES:
+        cases.append(('single, scale {0}'.format(scale), [
+            (np.array([i]), i + np.arange(VALIDATION_FORCING.size),
+             VALIDATION_FORCING * scale) for i in years
+        ]))
+    # two eruptions, a few years apart:
+    for gap in [2, 8]:
+        pair_forcing = np.zeros(VALIDATION_FORCING.size + gap)
+        pair_forcing[:VALIDATION_FORCING.size] += VALIDATION_FORCING
+        pair_forcing[gap:] += VALIDATION_FORCING
+        cases.append(('two, {0} years apart'.format(gap), [
+            (np.array([i, i + gap]), i + np.arange(pair_forcing.size),
+             pair_forcing) for i in years if i + gap <= YEAR_MAX
+        ]))
+    return cases
+
+def validate_emulator(report_file=None):
+    """
+    Compare the emulator with full FAIR runs for eruptions in every year in
+    the allowed range, for scaled validation forcing anomalies, returning
+    the report as a string, and writing it to file if requested
+
+    :param report_file: Optional output file for the report
+    """
+    report_lines = [
+        'FAIR emulator validation, {0}'.format(
+            datetime.datetime.now().isoformat(timespec='seconds')
+        ),
+        '',
+        'Maximum absolute errors against full FAIR runs, over the output '
+        'window, for',
+        'eruptions starting in every year from {0} to {1}. The forcing '
+        'anomaly for'.format(YEAR_MIN, YEAR_MAX),
+        'each eruption is VALIDATION_FORCING multiplied by the scale '
+        '(default 1).',
+        '',
+        '{0:<22} {1:>14} {2:>14} {3:>10} {4:>12}'.format(
+            'eruptions', 'fair_rf (W/m2)', 'fair_temp (K)', 'worst year',
+            'peak dT (K)'
+        )
+    ]
+    for description, runs in __validation_cases():
+        # maximum absolute errors, the first eruption year of the worst
+        # temperature error, and the peak temperature response:
+        rf_error = 0.0
+        temp_error = 0.0
+        worst_year = None
+        peak_response = 0.0
+        for eruption_years, model_years, model_rf_means in runs:
+            end_year = eruption_years.max() + 10
+            window = slice(
+                int(__year_index(eruption_years.min() - 10)),
+                int(__year_index(end_year)) + 1
+            )
+            # full fair, as run for model output:
+            volcanic_forcing = volcanic_background(eruption_years)
+            volcanic_forcing[__year_index(model_years)] += model_rf_means
+            forcing_full, temp_full = run_fair(volcanic_forcing, end_year)
+            # emulated:
+            forcing_emu, temp_emu = emulate_fair(
+                eruption_years, model_years, model_rf_means, end_year
+            )
+            rf_error = max(
+                rf_error, np.abs(forcing_emu - forcing_full)[window].max()
+            )
+            run_temp_error = np.abs(temp_emu - temp_full)[window].max()
+            if run_temp_error >= temp_error:
+                temp_error = run_temp_error
+                worst_year = eruption_years.min()
+            temp_a = get_baseline(eruption_years)[1][:temp_full.size]
+            peak_response = max(
+                peak_response, np.abs(temp_full - temp_a)[window].max()
+            )
+        report_lines.append(
+            '{0:<22} {1:>14.3e} {2:>14.3e} {3:>10} {4:>12.4f}'.format(
+                description, rf_error, temp_error, worst_year, peak_response
+            )
+        )
+    report = '\n'.join(report_lines) + '\n'
+    if report_file is not None:
+        with open(report_file, 'w', encoding='utf-8') as report_out:
+            report_out.write(report)
+    return report
+
+def __main():
+    """
+    Build or validate the emulator from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Build or validate the FAIR emulator'
+    )
+    parser.add_argument(
+        '--validate', nargs='?', const='', default=None,
+        metavar='REPORT_FILE',
+        help='validate the emulator, optionally writing the report to file'
+    )
+    args = parser.parse_args()
+    if args.validate is None:
+        build_emulator()
+    else:
+        print(validate_emulator(args.validate or None), end='')
+
+if __name__ == '__main__':
+    __main()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+Code to run the FAIR model with volcanic forcing.
+
+The FAIR run without EVA_H volcanic forcing depends only on the eruption
+year(s), so is precomputed for every single eruption year in the allowed
+range and stored in a table, which can be rebuilt with:
+
+    python fair_runs.py
+"""
+
+# --- imports
+
+# std lib imports:
+import functools
+import os
+import sys
+import threading
+
+# third party imports:
+from fair.RCPs import rcp45
+from fair.ancil import cmip5_annex2_forcing as ar5
+from fair.ancil import cmip6_solar, natural
+from fair.forward import fair_scm
+import numpy as np
+
+# --- global variables
+
+# path to baseline table:
+BASELINE_FILE = os.sep.join([
+    os.path.dirname(os.path.realpath(__file__)), 'fair_baseline.npz'
+])
+# first and last eruption years in the baseline table:
+YEAR_MIN = 1800
+YEAR_MAX = 2050
+# index of volcanic forcing in fair forcing output:
+VOLCANIC_INDEX = 11
+# background volcanic forcing value:
+VOLCANIC_BG = -0.06
+# number of years from eruption year for which background volcanic forcing
+# is used in place of ar5 values:
+BG_YEARS = 4
+
+# loaded baseline table:
+__BASELINE = {}
+# lock used when loading baseline table:
+__BASELINE_LOCK = threading.Lock()
+
+# ---
+
+def __ar5_volcanic():
+    """
+    Return volcanic forcing values for rcp45 emissions years, using ar5
+    values where available
+    """
+    # need an array of same size as rcp45 emissions, init as background
+    # forcing value:
+    ar5_volcanic = np.zeros(rcp45.Emissions.year.shape) + VOLCANIC_BG
+    # add in values available from ar5 data where available:
+    rcp45_mask = np.isin(rcp45.Emissions.year, ar5.Forcing.year)
+    ar5_index = np.searchsorted(
+        ar5.Forcing.year, rcp45.Emissions.year[rcp45_mask]
+    )
+    ar5_volcanic[rcp45_mask] = ar5.Forcing.volcanic[ar5_index]
+    # update 2011 -> 2015 as per Schmidt et al (2018):
+    ar5_volcanic[rcp45.Emissions.year == 2011] = -0.11
+    ar5_volcanic[rcp45.Emissions.year == 2012] = -0.10
+    ar5_volcanic[rcp45.Emissions.year == 2013] = -0.03
+    ar5_volcanic[rcp45.Emissions.year == 2014] = -0.11
+    ar5_volcanic[rcp45.Emissions.year == 2015] = -0.17
+    # update 2019 for raikoke guess -0.20 w m-2
+    ar5_volcanic[rcp45.Emissions.year == 2019] = -0.20
+    # return the values:
+    return ar5_volcanic
+
+# volcanic forcing values for rcp45 emissions years:
+AR5_VOLCANIC = __ar5_volcanic()
+AR5_VOLCANIC.flags.writeable = False
+
+def volcanic_background(eruption_years):
+    """
+    Return ar5 volcanic forcing, with background forcing for the eruption
+    year(s) -> eruption year(s) + 3
+
+    :param eruption_years: Eruption year, or array of eruption years
+    """
+    ar5_volcanic_bg = AR5_VOLCANIC.copy()
+    for eruption_year in np.atleast_1d(eruption_years):
+        ar5_volcanic_bg[
+            (eruption_year <= rcp45.Emissions.year) &
+            (rcp45.Emissions.year < eruption_year + BG_YEARS)
+        ] = VOLCANIC_BG
+    return ar5_volcanic_bg
+
+def run_fair(volcanic_forcing, end_year=None):
+    """
+    Run FAIR for rcp45 emissions, returning volcanic forcing and temperature
+
+    FAIR steps forward in time, so a run which stops at end_year gives
+    identical values, up to end_year, to a run over all rcp45 emissions
+    years. The time series inputs are cut at end_year, and the outputs end
+    there.
+
+    :param volcanic_forcing: Volcanic forcing for rcp45 emissions years
+    :param end_year: Optional last year of the run, defaults to the last
+                     rcp45 emissions year
+    """
+    # number of years to run:
+    if end_year is None:
+        year_count = rcp45.Emissions.year.size
+    else:
+        year_count = int(np.searchsorted(rcp45.Emissions.year, end_year)) + 1
+    fair_result = fair_scm(
+        emissions=rcp45.Emissions.emissions[:year_count],
+        F_volcanic=volcanic_forcing[:year_count],
+        F_solar=cmip6_solar.Forcing.solar[:year_count],
+        natural=natural.Emissions.emissions[:year_count]
+    )
+    return fair_result[1][:, VOLCANIC_INDEX], fair_result[2]
+
+@functools.lru_cache(maxsize=32)
+def __compute_baseline(eruption_years):
+    """
+    Run FAIR without EVA_H volcanic forcing for a set of eruption years
+
+    :param eruption_years: Tuple of eruption years
+    """
+    forcing, temp = run_fair(volcanic_background(eruption_years))
+    forcing.flags.writeable = False
+    temp.flags.writeable = False
+    return forcing, temp
+
+def build_baseline(baseline_file=BASELINE_FILE):
+    """
+    Run FAIR without EVA_H volcanic forcing for every eruption year, and save
+    to file
+
+    :param baseline_file: Output file
+    """
+    years = np.arange(YEAR_MIN, YEAR_MAX + 1)
+    baseline = [run_fair(volcanic_background(i)) for i in years]
+    np.savez_compressed(
+        baseline_file, years=years,
+        forcing=np.array([i[0] for i in baseline]),
+        temp=np.array([i[1] for i in baseline])
+    )
+
+def __load_baseline():
+    """
+    Load stored baseline table, returning None if there is no stored data
+    """
+    if not os.path.exists(BASELINE_FILE):
+        return None
+    with np.load(BASELINE_FILE) as baseline_data:
+        baseline = {i: baseline_data[i] for i in baseline_data.files}
+    # the arrays are shared between requests, so make them read only:
+    for i in baseline.values():
+        i.flags.writeable = False
+    return baseline
+
+def get_baseline(eruption_years):
+    """
+    Return FAIR volcanic forcing and temperature, for rcp45 emissions years,
+    without EVA_H volcanic forcing
+
+    Stored values are used for single eruption years where available,
+    loading the table on first use, otherwise FAIR is run.
+
+    :param eruption_years: Eruption year, or array of eruption years
+    """
+    if 'table' not in __BASELINE:
+        with __BASELINE_LOCK:
+            if 'table' not in __BASELINE:
+                __BASELINE['table'] = __load_baseline()
+    baseline = __BASELINE['table']
+    eruption_years = tuple(int(i) for i in np.unique(eruption_years))
+    # check if this is a single year in the table:
+    if (baseline is not None) and (len(eruption_years) == 1) and \
+       (baseline['years'][0] <= eruption_years[0] <= baseline['years'][-1]):
+        year_index = eruption_years[0] - baseline['years'][0]
+        return baseline['forcing'][year_index], baseline['temp'][year_index]
+    # not stored, run fair:
+    return __compute_baseline(eruption_years)
+
+if __name__ == '__main__':
+    # build the table at the default location, or the path given:
+    if len(sys.argv) > 1:
+        build_baseline(sys.argv[1])
+    else:
+        build_baseline()
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""
+Queue of asynchronous model runs, shared between worker processes.
+
+Jobs are held in a SQLite database, which all workers on the host can see,
+so no external broker is needed. Each web worker process runs a dispatcher
+thread, which claims queued jobs and runs them one at a time in a separate
+process, so that long model runs do not hold a web worker. The number of
+jobs running across all workers is limited by the database, and results
+are stored in the database until they expire.
+"""
+
+# --- imports
+
+# std lib imports:
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import datetime
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+# --- global variables
+
+# default job database file:
+JOB_FILE = os.sep.join([tempfile.gettempdir(), 'volc2clim_jobs.sqlite'])
+# default maximum number of jobs running across all workers:
+JOB_CONCURRENCY = 2
+# default seconds for which finished jobs are kept:
+JOB_RETENTION = 24 * 60 * 60
+# seconds between checks for queued jobs:
+JOB_POLL_INTERVAL = 1
+# seconds to wait for the database lock:
+JOB_TIMEOUT = 10
+# job states:
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# ---
+
+class JobQueue:
+    """
+    SQLite queue of model runs
+
+    :param run_job: Function which runs a job, taking the job parameters as
+                    a dict and returning a JSON serialisable result. This is
+                    run in a separate process, so must be picklable
+    :param job_file: SQLite database file
+    :param concurrency: Maximum number of jobs running across all workers
+    :param retention: Seconds for which finished jobs are kept
+    :param initializer: Optional function run when the job process starts
+    :param initargs: Arguments for initializer
+    :param on_result: Optional function called with the job parameters and
+                      result when a job is done
+    """
+    def __init__(self, run_job, job_file=JOB_FILE,
+                 concurrency=JOB_CONCURRENCY, retention=JOB_RETENTION,
+                 initializer=None, initargs=(), on_result=None):
+        self.run_job = run_job
+        self.on_result = on_result
+        self.job_file = job_file
+        self.concurrency = concurrency
+        self.retention = retention
+        self.initializer = initializer
+        self.initargs = initargs
+        # connections are per thread:
+        self.__local = threading.local()
+        # the dispatcher is started by start, which submit calls, and woken
+        # up when a job is submitted from this process:
+        self.__dispatcher = None
+        self.__dispatcher_lock = threading.Lock()
+        self.__wake = threading.Event()
+        with self.__connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, status TEXT NOT NULL, '
+                'params TEXT NOT NULL, result BLOB, message TEXT, '
+                'pid INTEGER, submitted REAL NOT NULL, started REAL, '
+                'finished REAL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_status '
+                'ON jobs (status, submitted)'
+            )
+
+    def __connect(self):
+        """
+        Return the SQLite connection for this thread
+        """
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.job_file, timeout=JOB_TIMEOUT)
+            # write ahead logging lets workers read while another writes:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.__local.conn = conn
+        return conn
+
+    def submit(self, params, result_json=None):
+        """
+        Queue a job, returning the job id
+
+        :param params: Job parameters, a JSON serialisable dict
+        :param result_json: Optional JSON result, as bytes, if the result is
+                            already known, in which case the job is done
+                            immediately
+        """
+        job_id = uuid.uuid4().hex
+        submit_time = time.time()
+        with self.__connect() as conn:
+            # remove expired jobs:
+            conn.execute(
+                'DELETE FROM jobs WHERE finished < ?',
+                (submit_time - self.retention,)
+            )
+            if result_json is not None:
+                conn.execute(
+                    'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, NULL, ?, ?, ?)',
+                    (job_id, JOB_DONE, json.dumps(params),
+                     zlib.compress(result_json, 1), '', submit_time,
+                     submit_time, submit_time)
+                )
+                return job_id
+            conn.execute(
+                'INSERT INTO jobs (id, status, params, submitted) '
+                'VALUES (?, ?, ?, ?)',
+                (job_id, JOB_QUEUED, json.dumps(params), submit_time)
+            )
+        # make sure this process is dispatching jobs:
+        self.start()
+        self.__wake.set()
+        return job_id
+
+    def get(self, job_id):
+        """
+        Return the job status and parameters as a dict, including the result
+        if the job is done, or None if there is no job with this id
+
+        :param job_id: Job id
+        """
+        with self.__connect() as conn:
+            row = conn.execute(
+                'SELECT status, params, result, message, submitted, '
+                'started, finished FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            (status, params, result, message, submitted, started,
+             finished) = row
+            job = {
+                'job_id': job_id,
+                'job_status': status,
+                'params': json.loads(params),
+                'message': message or '',
+                'submitted': self.__timestamp(submitted),
+                'started': self.__timestamp(started),
+                'finished': self.__timestamp(finished)
+            }
+            # position in the queue for queued jobs:
+            if status == JOB_QUEUED:
+                job['queue_position'] = conn.execute(
+                    'SELECT COUNT(*) FROM jobs WHERE status = ? AND '
+                    'submitted < ?', (JOB_QUEUED, submitted)
+                ).fetchone()[0] + 1
+        if result is not None:
+            job['result'] = json.loads(zlib.decompress(result))
+        return job
+
+    @staticmethod
+    def __pid_running(pid):
+        """
+        Return True if a process with this id is running on this host
+
+        :param pid: Process id
+        """
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    @staticmethod
+    def __timestamp(value):
+        """
+        Convert a time in seconds since the epoch to an ISO format string,
+        or None
+
+        :param value: Time in seconds since the epoch, or None
+        """
+        if value is None:
+            return None
+        return datetime.datetime.fromtimestamp(value).isoformat(
+            timespec='seconds'
+        )
+
+    def __claim(self):
+        """
+        Claim the oldest queued job for this process, if fewer than the
+        maximum number of jobs are running, returning the job id and
+        parameters, or None
+        """
+        conn = self.__connect()
+        # lock the database while checking and claiming, so that two workers
+        # can not claim the same job:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # requeue jobs left running by processes which have stopped:
+            for job_id, pid in conn.execute(
+                'SELECT id, pid FROM jobs WHERE status = ?', (JOB_RUNNING,)
+            ).fetchall():
+                if not self.__pid_running(pid):
+                    conn.execute(
+                        'UPDATE jobs SET status = ?, pid = NULL, '
+                        'started = NULL WHERE id = ?', (JOB_QUEUED, job_id)
+                    )
+            running = conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status = ?', (JOB_RUNNING,)
+            ).fetchone()[0]
+            row = None
+            if running < self.concurrency:
+                row = conn.execute(
+                    'SELECT id, params FROM jobs WHERE status = ? '
+                    'ORDER BY submitted LIMIT 1', (JOB_QUEUED,)
+                ).fetchone()
+            if row is not None:
+                conn.execute(
+                    'UPDATE jobs SET status = ?, pid = ?, started = ? '
+                    'WHERE id = ?',
+                    (JOB_RUNNING, os.getpid(), time.time(), row[0])
+                )
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def __finish(self, job_id, status, result=None, message=''):
+        """
+        Store the result of a job
+
+        :param job_id: Job id
+        :param status: Final job status, JOB_DONE or JOB_FAILED
+        :param result: JSON serialisable job result
+        :param message: Error message for failed jobs
+        """
+        if result is not None:
+            result = zlib.compress(json.dumps(result).encode(), 1)
+        with self.__connect() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, message = ?, '
+                'finished = ? WHERE id = ?',
+                (status, result, message, time.time(), job_id)
+            )
+
+    def start(self):
+        """
+        Start the dispatcher thread for this process, if not running
+        """
+        with self.__dispatcher_lock:
+            if (self.__dispatcher is None) or \
+               (not self.__dispatcher.is_alive()):
+                self.__dispatcher = threading.Thread(
+                    target=self.__dispatch, daemon=True
+                )
+                self.__dispatcher.start()
+
+    def __dispatch(self):
+        """
+        Claim and run jobs, one at a time, in a separate process
+        """
+        # jobs run in a spawned process, as forking a threaded web worker
+        # is not safe:
+        pool = None
+        while True:
+            try:
+                job = self.__claim()
+            except sqlite3.Error as err_msg:
+                self.__log(err_msg)
+                job = None
+            if job is None:
+                # wait for a job to be submitted from this process, or poll
+                # for jobs submitted from other processes:
+                self.__wake.wait(JOB_POLL_INTERVAL)
+                self.__wake.clear()
+                continue
+            job_id, params = job
+            if pool is None:
+                pool = ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=self.initializer, initargs=self.initargs
+                )
+            try:
+                result = pool.submit(self.run_job, params).result()
+                self.__finish(job_id, JOB_DONE, result)
+                if self.on_result is not None:
+                    self.on_result(params, result)
+            except BrokenProcessPool as err_msg:
+                # the job process died, so start a new one for the next job:
+                self.__log(err_msg)
+                pool = None
+                self.__finish(job_id, JOB_FAILED, message='job failed')
+            except Exception as err_msg:
+                self.__log(err_msg)
+                try:
+                    self.__finish(job_id, JOB_FAILED, message='job failed')
+                except sqlite3.Error as db_err_msg:
+                    self.__log(db_err_msg)
+
+    @staticmethod
+    def __log(err_msg):
+        """
+        Write a job queue error message to stderr
+
+        :param err_msg: Error message
+        """
+        sys.stderr.write('[{0}] [ERROR] job queue: {1}\n'.format(
+            datetime.datetime.now(), err_msg
+        ))
@@ -7,31 +7,100 @@ Code to run the EVA_H and FAIR models
 # --- imports
 
 # std lib imports:
-import base64 as b64
-from copy import deepcopy
 import datetime
 import sys
+import time
 
 # third party imports:
 from fair.RCPs import rcp45
-from fair.ancil import cmip5_annex2_forcing as ar5
-from fair.forward import fair_scm
 import netCDF4 as nc
 import numpy as np
-from scipy.integrate import solve_ivp
-from scipy.interpolate import PchipInterpolator
 
 # local imports:
-from eva_h.eightboxequations import eightboxequations
 from eva_h.parameters import ModelParams
-from eva_h.postproc import postproc
+from eva_h.postproc import (
+    postproc, postproc_global, postproc_optics, postproc_spatial
+)
+from eva_h.reference_runs import get_reference_run
 from eva_h.so2injection_8boxes import so2injection_8boxes
+from eva_h.solvers import (
+    constant_transport, model_times, solve_so4_mass,
+    solve_so4_mass_propagator_batch, PROPAGATOR, SOLVER_METHODS
+)
+from fair_emulator import emulate_fair
+from fair_runs import get_baseline, run_fair, volcanic_background
+from stage_cache import StageCache, stage_key
+from timing import stage_timer
 
 # --- global variables
 
+# model run time after the last eruption, in years:
+RUN_YEARS = 5
+# maximum number of eruptions in a single model run:
+MAX_ERUPTIONS = 20
+# maximum number of years between first and last eruption:
+MAX_ERUPTION_YEARS = 20
+# allowed ranges of radiative efficiency and aerosol timescale:
+RAD_EFF_RANGE = (-50, -0.1)
+AEROSOL_TIMESCALE_RANGE = (0.1, 50)
+# maximum number of samples for uncertainty bands:
+MAX_SAMPLES = 1000
+# resolution of aerosol timescale samples, in months:
+AEROSOL_TIMESCALE_RESOLUTION = 0.1
+# maximum number of samples for which fair is run:
+MAX_FAIR_SAMPLES = 100
+# percentiles returned for uncertainty bands:
+PERCENTILES = [5, 17, 50, 83, 95]
+# maximum number of scenarios in a batch model run:
+MAX_BATCH_SCENARIOS = 500
+# maximum number of time steps post processed together in a batch model
+# run:
+POSTPROC_BATCH_STEPS = 1200
+# output levels. global mean values only, time-latitude saod, or full
+# (time, latitude, altitude, wavelength) optical properties as NetCDF:
+OUTPUT_GLOBAL = 'global'
+OUTPUT_SAOD = 'saod'
+OUTPUT_FULL = 'full'
+OUTPUT_LEVELS = [OUTPUT_GLOBAL, OUTPUT_SAOD, OUTPUT_FULL]
+# number of years before the first eruption and after the last eruption
+# for which fair values are output:
+FAIR_WINDOW_YEARS = 10
+# fair modes. full fair runs, or the linear impulse response emulator, which
+# is checked against full fair runs by fair_emulator.py:
+FAIR_FULL = 'full'
+FAIR_EMULATOR = 'emulator'
+FAIR_MODES = [FAIR_FULL, FAIR_EMULATOR]
+
+# in memory caches for model run stages, with the maximum number of entries
+# for each stage, and the maximum total size in bytes for the stages with
+# large outputs. optics outputs grow with the number of wavelengths, so are
+# limited by size, per process:
+STAGE_CACHES = {
+    'injection': StageCache(64),
+    'solve': StageCache(32),
+    'spatial': StageCache(8, 64 * 1024 ** 2),
+    'optics': StageCache(8, 256 * 1024 ** 2),
+    'fair': StageCache(64),
+    'encoding': StageCache(4, 64 * 1024 ** 2)
+}
+
+# default NetCDF encoding options. values are stored as float32, or packed
+# as int16, compressed at complevel, with the shuffle filter, in chunks of
+# chunk_time time steps:
+NC_ENCODING = {
+    'packing': 'float32',
+    'shuffle': True,
+    'complevel': 1,
+    'chunk_time': 1
+}
+NC_PACKINGS = ['float32', 'int16']
+# maximum absolute packed int16 value, and fill value for packed values:
+NC_INT16_MAX = 32766
+NC_INT16_FILL = -32767
 
 # ---
 
+@stage_timer('check')
 def check_params(request_params):
     """
     Check supplied parameters, converting values as required
@@ -44,7 +113,7 @@ def check_params(request_params):
     if 'wavelengths' in request_params.keys():
         try:
             # get requested values:
-            wavelengths_in = request_params['wavelengths']
+            wavelengths_in = str(request_params['wavelengths'])
             # convert from string to list:
             wavelengths_out = [
                 float(i) for i in
@@ -64,35 +133,143 @@ def check_params(request_params):
     else:
         # no parameters present. use default values:
         user_params['wavelengths'] = np.array([380, 550, 1020]) / 1000
-    # additional expected parameters:
+    # additional expected parameters. eruption parameters may be a single
+    # value, or a list of values with one value per eruption, in the same
+    # format as the wavelengths:
     params = [
-        {'name': 'lat', 'type': float},
-        {'name': 'year', 'type': int},
-        {'name': 'month', 'type': int},
-        {'name': 'so2_mass', 'type': float},
-        {'name': 'so2_height', 'type': float},
-        {'name': 'tropo_height', 'type': float},
-        {'name': 'aerosol_timescale', 'type': float},
-        {'name': 'rad_eff', 'type': float}
+        {'name': 'lat', 'type': float, 'eruption': True},
+        {'name': 'year', 'type': int, 'eruption': True},
+        {'name': 'month', 'type': int, 'eruption': True},
+        {'name': 'so2_mass', 'type': float, 'eruption': True},
+        {'name': 'so2_height', 'type': float, 'eruption': True},
+        {'name': 'tropo_height', 'type': float, 'eruption': True},
+        {'name': 'aerosol_timescale', 'type': float, 'eruption': False},
+        {'name': 'rad_eff', 'type': float, 'eruption': False}
     ]
     # loop through expected parameters and try to get values:
     for param in params:
         param_name = param['name']
         param_type = param['type']
         try:
-            user_params[param_name] = np.array([
-                param_type(request_params[param_name])
-            ])
+            if param['eruption']:
+                user_params[param_name] = np.array([
+                    param_type(i) for i in
+                    str(request_params[param_name]).lstrip('[').rstrip(
+                        ']'
+                    ).split(',')
+                ])
+            else:
+                user_params[param_name] = np.array([
+                    param_type(request_params[param_name])
+                ])
         # return False on failure:
         except:
             err_msg = 'invalid {} parameter'.format(param_name)
             return False, {}, err_msg
+    # check the number of eruptions:
+    eruption_count = user_params['lat'].size
+    for param in params:
+        if param['eruption'] and \
+           user_params[param['name']].size != eruption_count:
+            err_msg = 'eruption parameters should all have the same number'
+            err_msg += ' of values'
+            return False, {}, err_msg
+    if eruption_count > MAX_ERUPTIONS:
+        err_msg = 'number of eruptions should not be greater than'
+        err_msg += ' {0} ({1})'.format(MAX_ERUPTIONS, eruption_count)
+        return False, {}, err_msg
     # check for optional netcdf flag, presume not:
     user_params['nc'] = False
     if 'nc' in request_params.keys():
         # 1 is True, anything else is False:
-        if request_params['nc'] == '1':
+        if str(request_params['nc']) == '1':
             user_params['nc'] = True
+    # check for optional output level. the netcdf flag is the same as full
+    # output, otherwise time-latitude saod is output by default:
+    user_params['output'] = request_params.get(
+        'output', OUTPUT_FULL if user_params['nc'] else OUTPUT_SAOD
+    )
+    if user_params['output'] not in OUTPUT_LEVELS:
+        err_msg = 'output parameter should be one of {0}'.format(
+            ', '.join(OUTPUT_LEVELS)
+        )
+        return False, {}, err_msg
+    if user_params['nc'] and (user_params['output'] != OUTPUT_FULL):
+        err_msg = 'nc parameter requires {0} output'.format(OUTPUT_FULL)
+        return False, {}, err_msg
+    user_params['nc'] = user_params['output'] == OUTPUT_FULL
+    # check for optional netcdf encoding options:
+    user_params['nc_encoding'] = dict(NC_ENCODING)
+    nc_encoding_params = [
+        {'name': 'packing', 'type': str, 'values': NC_PACKINGS},
+        {'name': 'shuffle', 'type': int, 'values': [0, 1]},
+        {'name': 'complevel', 'type': int, 'values': range(10)},
+        {'name': 'chunk_time', 'type': int, 'values': range(1, 10000)}
+    ]
+    for param in nc_encoding_params:
+        param_name = 'nc_{0}'.format(param['name'])
+        if param_name not in request_params.keys():
+            continue
+        try:
+            param_value = param['type'](request_params[param_name])
+        except:
+            err_msg = 'invalid {} parameter'.format(param_name)
+            return False, {}, err_msg
+        if param_value not in param['values']:
+            err_msg = 'invalid {} parameter'.format(param_name)
+            return False, {}, err_msg
+        user_params['nc_encoding'][param['name']] = param_value
+    user_params['nc_encoding']['shuffle'] = bool(
+        user_params['nc_encoding']['shuffle']
+    )
+    # check for optional solver method, presume the exact propagator:
+    user_params['solver'] = request_params.get('solver', PROPAGATOR)
+    if user_params['solver'] not in SOLVER_METHODS:
+        err_msg = 'solver parameter should be one of {0}'.format(
+            ', '.join(SOLVER_METHODS)
+        )
+        return False, {}, err_msg
+    # check for optional fair mode, presume full fair runs:
+    user_params['fair_mode'] = request_params.get('fair_mode', FAIR_FULL)
+    if user_params['fair_mode'] not in FAIR_MODES:
+        err_msg = 'fair_mode parameter should be one of {0}'.format(
+            ', '.join(FAIR_MODES)
+        )
+        return False, {}, err_msg
+    # check for optional uncertainty parameters. no samples are drawn by
+    # default, and the standard deviations default to 0:
+    uncertainty_params = [
+        {'name': 'samples', 'type': int, 'default': 0,
+         'range': (0, MAX_SAMPLES)},
+        {'name': 'rad_eff_sd', 'type': float, 'default': 0,
+         'range': (0, RAD_EFF_RANGE[1] - RAD_EFF_RANGE[0])},
+        {'name': 'aerosol_timescale_sd', 'type': float, 'default': 0,
+         'range': (0, AEROSOL_TIMESCALE_RANGE[1] -
+                   AEROSOL_TIMESCALE_RANGE[0])},
+        {'name': 'seed', 'type': int, 'default': None,
+         'range': (0, 2**32 - 1)}
+    ]
+    for param in uncertainty_params:
+        param_name = param['name']
+        param_range = param['range']
+        if param_name not in request_params.keys():
+            user_params[param_name] = param['default']
+            continue
+        try:
+            user_params[param_name] = param['type'](
+                request_params[param_name]
+            )
+        except:
+            err_msg = 'invalid {} parameter'.format(param_name)
+            return False, {}, err_msg
+        if not param_range[0] <= user_params[param_name] <= param_range[1]:
+            err_msg = '{0} parameter should not be less than {1}'.format(
+                param_name, param_range[0]
+            )
+            err_msg += ' or greater than {0} ({1})'.format(
+                param_range[1], user_params[param_name]
+            )
+            return False, {}, err_msg
     # check parameter values ... so2_mass:
     for i in user_params['so2_mass']:
         if not 0 <= i <= 999999:
@@ -111,6 +288,13 @@ def check_params(request_params):
             err_msg = 'lat parameter should not be less than 1800'
             err_msg += ' or greater than 2050 ({0})'.format(i)
             return False, {}, err_msg
+    eruption_years = user_params['year'].max() - user_params['year'].min()
+    if eruption_years > MAX_ERUPTION_YEARS:
+        err_msg = 'eruptions should not be more than {0} years apart'.format(
+            MAX_ERUPTION_YEARS
+        )
+        err_msg += ' ({0})'.format(eruption_years)
+        return False, {}, err_msg
     # check month:
     for i in user_params['month']:
         if not 1 <= i <= 12:
@@ -131,15 +315,19 @@ def check_params(request_params):
             return False, {}, err_msg
     # check aerosol_timescale:
     for i in user_params['aerosol_timescale']:
-        if not 0.1 <= i <= 50:
-            err_msg = 'aerosol_timescale parameter should not be less than 0.1'
-            err_msg += ' or greater than 50 ({0})'.format(i)
+        if not AEROSOL_TIMESCALE_RANGE[0] <= i <= AEROSOL_TIMESCALE_RANGE[1]:
+            err_msg = 'aerosol_timescale parameter should not be less than'
+            err_msg += ' {0} or greater than {1} ({2})'.format(
+                *AEROSOL_TIMESCALE_RANGE, i
+            )
             return False, {}, err_msg
     # check rad_eff:
     for i in user_params['rad_eff']:
-        if not -50 <= i <= -0.1:
-            err_msg = 'rad_eff parameter should not be less than -50'
-            err_msg += ' or greater than -0.1 ({0})'.format(i)
+        if not RAD_EFF_RANGE[0] <= i <= RAD_EFF_RANGE[1]:
+            err_msg = 'rad_eff parameter should not be less than'
+            err_msg += ' {0} or greater than {1} ({2})'.format(
+                *RAD_EFF_RANGE, i
+            )
             return False, {}, err_msg
     # check wavelengths:
     for i in user_params['wavelengths']:
@@ -150,10 +338,53 @@ def check_params(request_params):
     # return the parameters:
     return True, user_params, None
 
+def __create_nc_var(nc_data, var_name, var_dims, values, nc_encoding):
+    """
+    Create a compressed NetCDF variable, chunked by time, and store the
+    values, packing them as int16 if requested
+
+    :param nc_data: NetCDF dataset
+    :param var_name: Name of the variable
+    :param var_dims: Tuple of variable dimensions, starting with time
+    :param values: Numpy array of variable values
+    :param nc_encoding: Dict of NetCDF encoding options, with keys packing,
+                        shuffle, complevel and chunk_time
+    """
+    # chunks hold chunk_time time steps:
+    chunk_sizes = (min(nc_encoding['chunk_time'], values.shape[0]),) + \
+        values.shape[1:]
+    # compression options:
+    var_options = {
+        'zlib': nc_encoding['complevel'] > 0,
+        'complevel': max(nc_encoding['complevel'], 1),
+        'shuffle': (nc_encoding['complevel'] > 0) and nc_encoding['shuffle'],
+        'chunksizes': chunk_sizes
+    }
+    # store as float32:
+    if nc_encoding['packing'] == 'float32':
+        nc_var = nc_data.createVariable(
+            var_name, 'f4', var_dims, **var_options
+        )
+        nc_var[:] = values
+        return nc_var
+    # pack as int16, with the range of the values mapped to
+    # -NC_INT16_MAX -> NC_INT16_MAX, and NaNs stored as the fill value:
+    nc_var = nc_data.createVariable(
+        var_name, 'i2', var_dims, fill_value=NC_INT16_FILL, **var_options
+    )
+    value_min = np.nanmin(values) if np.any(np.isfinite(values)) else 0.0
+    value_max = np.nanmax(values) if np.any(np.isfinite(values)) else 0.0
+    nc_var.add_offset = (value_max + value_min) / 2
+    nc_var.scale_factor = (value_max - value_min) / (2 * NC_INT16_MAX) or 1.0
+    nc_var[:] = np.ma.masked_invalid(values)
+    return nc_var
+
 def data_to_nc(model_dates, model_lats, model_alts, model_wls,
-               model_ext, model_ssa, model_asy, model_saod):
+               model_ext, model_ssa, model_asy, model_saod,
+               nc_encoding=None):
     """
-    Create NetCDF dataset for model data and return as base64
+    Create NetCDF dataset for model data and return as a read only
+    memoryview of the NetCDF file contents
 
     :param model_dates: List of model dates as strings in format %Y-%m-%d
     :param model_lats: Numpy array of model latitudes
@@ -163,7 +394,13 @@ def data_to_nc(model_dates, model_lats, model_alts, model_wls,
     :param model_ssa: Numpy array of model single scattering albedo
     :param model_ssa: Numpy array of model aerosol scattering asymmtery factor
     :param model_saod: Numpy array of model stratospheric aerosol optical depth
+    :param nc_encoding: Dict of NetCDF encoding options, with keys packing
+                        ('float32' or 'int16'), shuffle, complevel (0 for no
+                        compression) and chunk_time (time steps per chunk),
+                        defaults to NC_ENCODING
     """
+    # encoding options:
+    nc_encoding = dict(NC_ENCODING, **(nc_encoding or {}))
     # create the netcdf dataset:
     nc_data = nc.Dataset(None, mode='w', memory=True, format='NETCDF4')
     # set up time units and calendar:
@@ -177,7 +414,7 @@ def data_to_nc(model_dates, model_lats, model_alts, model_wls,
     # create time dimension:
     nc_data.createDimension('time', len(model_datetimes))
     # create time variable:
-    nc_times = nc_data.createVariable('time', 'f', ('time'))
+    nc_times = nc_data.createVariable('time', 'f8', ('time'))
     # store the times, long name, standard_name, units and calendar:
     nc_times[:] = nc_time_values
     nc_times.long_name = 'time'
@@ -210,292 +447,710 @@ def data_to_nc(model_dates, model_lats, model_alts, model_wls,
     nc_wls[:] = model_wls
     nc_wls.long_name = 'wavelength'
     nc_wls.units = 'nm'
-    # create aerosol extinction variable:
-    nc_ext = nc_data.createVariable(
-        'ext', 'f', ('time', 'latitude', 'altitude', 'wavelength'),
-        zlib=True, complevel=1
+    # create aerosol extinction variable, and store the extinction:
+    nc_ext = __create_nc_var(
+        nc_data, 'ext', ('time', 'latitude', 'altitude', 'wavelength'),
+        model_ext, nc_encoding
     )
-    # store the extinction, long name, and units:
-    nc_ext[:] = model_ext
+    # store the long name, and units:
     nc_ext.long_name = 'aerosol extinction'
     nc_ext.units = 'K m**-1'
-    # create single scattering albedo variable:
-    nc_ssa = nc_data.createVariable(
-        'ssa', 'f', ('time', 'latitude', 'altitude', 'wavelength'),
-        zlib=True, complevel=1
+    # create single scattering albedo variable, and store the scattering:
+    nc_ssa = __create_nc_var(
+        nc_data, 'ssa', ('time', 'latitude', 'altitude', 'wavelength'),
+        model_ssa, nc_encoding
     )
-    # store the scattering and long name:
-    nc_ssa[:] = model_ssa
+    # store the long name:
     nc_ssa.long_name = 'single scattering albedo'
-    # create aerosol scattering asymmtery factor variable:
-    nc_asy = nc_data.createVariable(
-        'asy', 'f', ('time', 'latitude', 'altitude', 'wavelength'),
-        zlib=True, complevel=1
+    # create aerosol scattering asymmtery factor variable, and store the
+    # scattering asymmetry factor:
+    nc_asy = __create_nc_var(
+        nc_data, 'asy', ('time', 'latitude', 'altitude', 'wavelength'),
+        model_asy, nc_encoding
     )
-    # store the scattering asymmetry factor and long name:
-    nc_asy[:] = model_asy
+    # store the long name:
     nc_asy.long_name = 'aerosol scattering asymmtery factor'
-    # create stratospheric aerosol optical depth variable:
-    nc_saod = nc_data.createVariable(
-        'saod', 'f', ('time', 'latitude', 'wavelength'),
-        zlib=True, complevel=1
+    # create stratospheric aerosol optical depth variable, and store the
+    # stratospheric aerosol optical depth:
+    nc_saod = __create_nc_var(
+        nc_data, 'saod', ('time', 'latitude', 'wavelength'), model_saod,
+        nc_encoding
     )
-    # store the stratospheric aerosol optical depth and long name:
-    nc_saod[:] = model_saod
+    # store the long name:
     nc_saod.long_name = 'stratospheric aerosol optical depth'
     # close the dataset:
     nc_mem = nc_data.close()
-    # convert to base64:
-    nc_b64 = b64.b64encode(nc_mem.tobytes()).decode()
-    # return base64 encoded NetCDF:
-    return nc_b64
+    # return the NetCDF file contents:
+    return nc_mem
 
-def __run_model(eva_h_dir, user_params):
+def __setup_run(eva_h_dir, user_params):
     """
-    Main model running function
+    Set up a model run, returning a dict of model parameters, time span, SO2
+    injections, and output times and dates
 
     :param eva_h_dir: Directory containing EVA_H data files
     :param user_params: User supplied parameters
     """
     # init the model parameters:
     model_params = ModelParams()
-    # model run time in years:
-    run_years = 5
-    # subtract 1 from month value, so january = 0:
-    user_params['month'] -= 1
-    # add eruption year to months:
-    user_params['month'] += (user_params['year'] * 12)
-    # time span in months. run for five years, starting from lowest eruption
-    # date:
+    # subtract 1 from month value, so january = 0, and add eruption year to
+    # months. this makes a new array, so the checked values are unchanged:
+    user_params['month'] = user_params['month'] - 1 + \
+        (user_params['year'] * 12)
+    # time span in months. run for five years after the last eruption,
+    # starting from lowest eruption date:
     start_month = user_params['month'].min()
-    tspan = [start_month, start_month + (run_years * 12)]
-    # copy user params, and set so2_mass to 0 for anomaly calculating:
-    user_params_ref = deepcopy(user_params)
-    user_params_ref['so2_mass'] = np.array([0.])
-    user_params_ref['wavelengths'] = np.array([550]) / 1000
+    tspan = [start_month, user_params['month'].max() + (RUN_YEARS * 12)]
     # adjust aerosol timescale to user provided value:
     model_params.tauprod = np.ones(8) * user_params['aerosol_timescale']
-    # calculate volcanic so2 injections:
-    inmass, intime = so2injection_8boxes(
-        eva_h_dir,
-        model_params.h1lim,
-        model_params.h2lim,
-        model_params.latlim,
-        user_params
+    # calculate volcanic so2 injections, which depend only on the eruption
+    # parameters:
+    injection_key = stage_key(
+        eva_h_dir, user_params['lat'], user_params['month'],
+        user_params['so2_mass'], user_params['so2_height'],
+        user_params['tropo_height']
     )
-    # same again for reference values:
-    inmass_ref, intime_ref = so2injection_8boxes(
-        eva_h_dir,
-        model_params.h1lim,
-        model_params.h2lim,
-        model_params.latlim,
-        user_params_ref
+    with stage_timer('injection'):
+        inmass, intime = STAGE_CACHES['injection'].get(
+            injection_key, lambda: so2injection_8boxes(
+                eva_h_dir,
+                model_params.h1lim,
+                model_params.h2lim,
+                model_params.latlim,
+                user_params
+            )
+        )
+    # model output times and dates:
+    tref, model_time_dates = model_times(tspan)
+    # return the model run set up:
+    return {
+        'injection_key': injection_key,
+        'model_params': model_params,
+        'tspan': tspan,
+        'inmass': inmass,
+        'intime': intime,
+        'tref': tref,
+        'model_time_dates': model_time_dates
+    }
+
+def __annual_means(model_time_years, model_rf_anom):
+    """
+    Return the model years, and annual means of the radiative forcing
+    anomaly for each year, with years as the last dimension
+
+    :param model_time_years: List of model times in years
+    :param model_rf_anom: Numpy array of radiative forcing anomaly, with time
+                          as the last dimension
+    """
+    # get year for each time step:
+    all_model_years = np.floor(model_time_years).astype(int)
+    # unique years in model time period:
+    model_years = np.unique(all_model_years)
+    # get mean of all values for each year:
+    model_rf_means = np.stack([
+        np.nanmean(model_rf_anom[..., all_model_years == model_year], axis=-1)
+        for model_year in model_years
+    ], axis=-1)
+    # return the years and means:
+    return model_years, model_rf_means
+
+def __run_fair_eva_h(user_params, model_years, model_rf_means,
+                     fair_cache=None):
+    """
+    Run FAIR with volcanic forcing updated with the EVA_H radiative forcing,
+    returning volcanic forcing and temperature, up to the last output year
+
+    In emulator mode, the FAIR emulator is used in place of FAIR, and the
+    radiative forcing anomaly may have a leading dimension of samples.
+
+    :param user_params: User supplied parameters
+    :param model_years: Numpy array of model years
+    :param model_rf_means: Numpy array of annual mean radiative forcing
+                           anomaly for each model year
+    :param fair_cache: Optional dict of FAIR results keyed by volcanic
+                       forcing, shared between runs, used in place of the
+                       FAIR stage cache
+    """
+    # fair is only run to the last output year:
+    end_year = user_params['year'].max() + FAIR_WINDOW_YEARS
+    # the emulator is cheap, so its results are not stored:
+    if user_params['fair_mode'] == FAIR_EMULATOR:
+        return emulate_fair(
+            user_params['year'], model_years, model_rf_means, end_year
+        )
+    # volcanic forcing values for fair, using ar5 values, with background
+    # forcing for eruption year -> eruption year + 3, for each eruption:
+    ar5_volcanic_bg = volcanic_background(user_params['year'])
+    # update volcanic forcing values with those from eva_h:
+    for i, model_year in enumerate(model_years):
+        ar5_volcanic_bg[rcp45.Emissions.year == model_year] += model_rf_means[i]
+    # the forcing after the last output year is not used:
+    ar5_volcanic_bg = ar5_volcanic_bg[rcp45.Emissions.year <= end_year]
+    # run fair, reusing results for identical forcing:
+    fair_key = ar5_volcanic_bg.tobytes()
+    if fair_cache is None:
+        return STAGE_CACHES['fair'].get(
+            fair_key, lambda: run_fair(ar5_volcanic_bg, end_year)
+        )
+    if fair_key not in fair_cache:
+        fair_cache[fair_key] = run_fair(ar5_volcanic_bg, end_year)
+    return fair_cache[fair_key]
+
+def __fair_window(user_params, model_years):
+    """
+    Return the years, and their indexes in the FAIR output, for the year of
+    the first eruption -FAIR_WINDOW_YEARS to the year of the last eruption
+    +FAIR_WINDOW_YEARS
+
+    :param user_params: User supplied parameters
+    :param model_years: Numpy array of model years
+    """
+    fair_years = np.arange(model_years.min() - FAIR_WINDOW_YEARS,
+                           user_params['year'].max() + FAIR_WINDOW_YEARS + 1)
+    fair_index = np.searchsorted(rcp45.Emissions.year, fair_years)
+    return fair_years, fair_index
+
+def __model_uncertainty(eva_h_dir, user_params, model_run, model_saod_ts_ref,
+                        fair_cache=None):
+    """
+    Run the model for random samples of radiative efficiency and aerosol
+    timescale, returning percentiles of the model outputs across samples
+
+    Each distinct aerosol timescale sample needs its own model run and post
+    processing, which are done together as a batch, so aerosol timescale
+    samples are drawn at a resolution of AEROSOL_TIMESCALE_RESOLUTION. Radiative efficiency
+    only scales the global mean SAOD, so costs nothing extra until FAIR is
+    run for each sample. FAIR is by far the most expensive step, so FAIR
+    percentiles are calculated from a random subset of at most
+    MAX_FAIR_SAMPLES samples, unless the FAIR emulator is used, which runs
+    all samples at once.
+
+    The returned dict has the number of samples, 'samples', which the SAOD
+    and radiative forcing percentiles are calculated from, and the number of
+    samples, 'fair_samples', which the FAIR forcing and temperature
+    percentiles are calculated from.
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param user_params: User supplied parameters
+    :param model_run: Model run set up, from __setup_run
+    :param model_saod_ts_ref: Numpy array of reference run global mean SAOD
+                              at 550nm
+    :param fair_cache: Optional dict of FAIR results keyed by volcanic
+                       forcing, shared between runs
+    """
+    model_params = model_run['model_params']
+    wavelengths = user_params['wavelengths']
+    sample_count = user_params['samples']
+    # FAIR results for the samples are rarely reused, so are not stored in
+    # the FAIR stage cache:
+    if fair_cache is None:
+        fair_cache = {}
+    # draw the samples, limited to the allowed parameter ranges:
+    rng = np.random.default_rng(user_params['seed'])
+    rad_eff = np.clip(rng.normal(
+        user_params['rad_eff'][0], user_params['rad_eff_sd'], sample_count
+    ), RAD_EFF_RANGE[0], RAD_EFF_RANGE[1])
+    aerosol_timescale = np.clip(rng.normal(
+        user_params['aerosol_timescale'][0],
+        user_params['aerosol_timescale_sd'], sample_count
+    ), AEROSOL_TIMESCALE_RANGE[0], AEROSOL_TIMESCALE_RANGE[1])
+    # distinct aerosol timescales. samples are rounded to
+    # AEROSOL_TIMESCALE_RESOLUTION, unless no spread was requested, so that
+    # model runs are shared between samples:
+    if user_params['aerosol_timescale_sd']:
+        aerosol_timescale = np.round(
+            aerosol_timescale / AEROSOL_TIMESCALE_RESOLUTION
+        ) * AEROSOL_TIMESCALE_RESOLUTION
+    aerosol_timescale, sample_index = np.unique(
+        aerosol_timescale, return_inverse=True
     )
-    # set initial conditions:
-    ic = np.array([0.0126,0.0468,0.0152,0.0192,0.0359,0.0218,0.0349,0.0417])
-    # init arrays for model dates:
-    tref = []
-    model_time_dates = []
-    # create time range, where each step is the first day of each month in the
-    # range:
-    for i in np.arange(tspan[0], tspan[1] + 1):
-        # year for this time step:
-        step_yr = int(np.floor(i / 12))
-        # month for this time step:
-        step_month = int((i % 12) + 1)
-        # datetime for this time step:
-        step_dt = datetime.datetime(step_yr, step_month, 1)
-        # day of year for this time step:
-        step_doy = step_dt.timetuple().tm_yday - 1
-        # decimal year for this time step:
-        if (step_yr % 4) == 0:
-            step_dy = step_yr + (step_doy / 365)
-        else:
-            step_dy = step_yr + (step_doy / 366)
-        # date string for this time step:
-        step_str = step_dt.strftime('%Y-%m-%d')
-        # store the date and date string:
-        tref.append(step_dy)
-        model_time_dates.append(step_str)
-    # convert tref to numpy array in months:
-    tref = np.array(tref) * 12
-    # run the model:
-    sol = solve_ivp(
-        eightboxequations, tspan, ic,
-        args=[inmass, intime, model_params, model_params.backinj],
-        rtol=1e-4, atol=1e-8
+    # run the model for each aerosol timescale. model runs with the
+    # propagator are run as a batch:
+    tauprod = np.ones((aerosol_timescale.size, 8)) * \
+        aerosol_timescale[:, np.newaxis]
+    if (user_params['solver'] == PROPAGATOR) and \
+       constant_transport(model_params):
+        batch_shape = (aerosol_timescale.size,)
+        so4_masses = solve_so4_mass_propagator_batch(
+            np.broadcast_to(model_run['inmass'],
+                            batch_shape + model_run['inmass'].shape),
+            np.broadcast_to(model_run['intime'],
+                            batch_shape + model_run['intime'].shape),
+            model_params, tauprod,
+            np.broadcast_to(np.array(model_run['tspan'], dtype=float),
+                            batch_shape + (2,)),
+            np.broadcast_to(model_run['tref'],
+                            batch_shape + model_run['tref'].shape)
+        )
+    else:
+        so4_masses = []
+        for i in tauprod:
+            model_params.tauprod = i
+            so4_masses.append(solve_so4_mass(
+                model_run['inmass'], model_run['intime'], model_params,
+                model_run['tspan'], model_run['tref'],
+                method=user_params['solver']
+            ))
+        model_params.tauprod = np.ones(8) * user_params['aerosol_timescale']
+    # global mean saod for each aerosol timescale, post processing groups of
+    # runs together:
+    time_count = model_run['tref'].size
+    group_size = max(POSTPROC_BATCH_STEPS // time_count, 1)
+    gmsaod = np.concatenate([
+        postproc_global(
+            eva_h_dir, *postproc_spatial(
+                eva_h_dir, np.concatenate(so4_masses[i:i + group_size]),
+                model_params, model_params.mstar, model_params.R_reff
+            )[:2], wavelengths
+        ).reshape(-1, time_count, wavelengths.size)
+        for i in range(0, aerosol_timescale.size, group_size)
+    ])
+    gmsaod = np.round(gmsaod, 6)
+    # radiative forcing and anomaly for each sample:
+    index_550 = np.where(wavelengths == 0.55)[0][0]
+    model_rf = rad_eff[:, np.newaxis] * gmsaod[sample_index, :, index_550]
+    model_rf_anom = model_rf - (rad_eff[:, np.newaxis] * model_saod_ts_ref)
+    # run fair for each sample, or for a random subset of MAX_FAIR_SAMPLES
+    # samples:
+    model_years, model_rf_means = __annual_means(
+        np.round(model_run['tref'] / 12, 2), model_rf_anom
     )
-    so4_mass = PchipInterpolator(sol.t, sol.y.T, axis=0)(tref)
-    # same again for reference values:
-    sol_ref = solve_ivp(
-        eightboxequations, tspan, ic,
-        args=[inmass_ref, intime_ref, model_params, model_params.backinj],
-        rtol=1e-4, atol=1e-8
+    fair_years, fair_index = __fair_window(user_params, model_years)
+    if user_params['fair_mode'] == FAIR_EMULATOR:
+        # the emulator runs all samples at once:
+        fair_sample_count = sample_count
+        forcing, temp = __run_fair_eva_h(
+            user_params, model_years, model_rf_means
+        )
+        fair_rf = forcing[:, fair_index]
+        fair_temp = temp[:, fair_index]
+    else:
+        fair_sample_count = min(sample_count, MAX_FAIR_SAMPLES)
+        fair_sample_index = np.sort(rng.choice(
+            sample_count, fair_sample_count, replace=False
+        ))
+        fair_rf = np.zeros((fair_sample_count, fair_index.size))
+        fair_temp = np.zeros((fair_sample_count, fair_index.size))
+        for i, j in enumerate(fair_sample_index):
+            forcing, temp = __run_fair_eva_h(
+                user_params, model_years, model_rf_means[j], fair_cache
+            )
+            fair_rf[i] = forcing[fair_index]
+            fair_temp[i] = temp[fair_index]
+    # return the percentiles:
+    return {
+        'samples': sample_count,
+        'fair_samples': fair_sample_count,
+        'percentiles': PERCENTILES,
+        'saod_ts': np.round(np.moveaxis(np.percentile(
+            gmsaod[sample_index], PERCENTILES, axis=0
+        ), 2, 1), 6),
+        'rf_ts': np.round(
+            np.percentile(model_rf, PERCENTILES, axis=0), 6
+        ),
+        'fair_rf': np.round(
+            np.percentile(fair_rf, PERCENTILES, axis=0), 6
+        ),
+        'fair_temp': np.round(
+            np.percentile(fair_temp, PERCENTILES, axis=0), 6
+        )
+    }
+
+def __model_output(eva_h_dir, user_params, model_run, so4_mass,
+                   postproc_out, fair_cache=None):
+    """
+    Calculate radiative forcing and FAIR response from the model run, and
+    return the data for output
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param user_params: User supplied parameters
+    :param model_run: Model run set up, from __setup_run
+    :param so4_mass: Numpy array of model sulfate mass, (time, box)
+    :param postproc_out: Tuple of postproc outputs
+    :param fair_cache: Optional dict of FAIR results keyed by volcanic
+                       forcing, shared between runs in a batch
+    """
+    tspan = model_run['tspan']
+    tref = model_run['tref']
+    model_time_dates = model_run['model_time_dates']
+    # get the reference run, where so2_mass is 0, for anomaly calculating.
+    # this depends only on the start month and run length, so is usually
+    # precomputed:
+    so4_mass_ref, gmsaod_ref = get_reference_run(
+        eva_h_dir, tspan, method=user_params['solver']
     )
-    so4_mass_ref = PchipInterpolator(sol_ref.t, sol_ref.y.T, axis=0)(tref)
     # list of wavelengths at which output are requested, in um:
     wavelengths = user_params['wavelengths']
-    # run the post processing:
-    gmsaod, saod, reff, ext, ssa, asy, lat, alt = postproc(
-        eva_h_dir, so4_mass, model_params, model_params.mstar,
-        model_params.R_reff, wavelengths
-    )
-    # same again for reference values:
-    wavelengths_ref = user_params_ref['wavelengths']
-    (gmsaod_ref, saod_ref, reff_ref, ext_ref, ssa_ref, asy_ref, lat_ref,
-     alt_ref) = postproc(
-        eva_h_dir, so4_mass_ref, model_params, model_params.mstar,
-        model_params.R_reff, wavelengths_ref
-    )
-    # convert values for json output ..
+    # post processing outputs:
+    gmsaod, saod, _, _, _, _, lat, _ = postproc_out
+    # round values for output ..
     # model time in years to 2 decimal places:
-    model_time_years = (tref / 12)
-    model_time_years = np.round(model_time_years, 2).tolist()
-    # init list for saod values at different wavelengths:
-    model_saod_ts = []
-    model_saod = []
-    # loop through wavelengths:
-    for i in range(wavelengths.size):
-        # store time series data:
-        model_saod_ts.append(
-            np.round(gmsaod[:, i], 6).tolist()
-        )
-        # store 2d time-lat data:
-        model_saod.append(
-             np.round((saod[:, :, i]).T, 6).tolist()
-        )
-    # same again for reference values:
-    model_saod_ts_ref = []
-    for i in range(wavelengths_ref.size):
-        model_saod_ts_ref.append(
-            np.round(gmsaod_ref[:, i], 6).tolist()
-        )
-    # model latitude:
-    model_lat = lat.tolist()
+    model_time_years = np.round(tref / 12, 2)
+    # saod time series, (wavelength, time):
+    model_saod_ts = np.round(gmsaod.T, 6)
+    # same again for reference values, at 550nm only:
+    model_saod_ts_ref = np.round(gmsaod_ref, 6)
     # radiative forcing is model_saod_ts at 550nm multiplied by negative
     # scaling factor (radiative efficiency):
     index_550 = np.where(wavelengths == 0.55)[0][0]
     model_rf = user_params['rad_eff'] * model_saod_ts[index_550]
-    index_550_ref = np.where(wavelengths_ref == 0.55)[0][0]
-    model_rf_ref = user_params['rad_eff'] * model_saod_ts_ref[index_550_ref]
+    model_rf_ref = user_params['rad_eff'] * model_saod_ts_ref
     # difference between rf for user values and rf values where mass is 0,
     # i.e. rf anomaly from eva_h, which will be used with fair data:
     model_rf_anom = model_rf - model_rf_ref
-    # get annual global mean rf values for fair. get year for each time step:
-    all_model_years = np.array([
-        np.floor(i) for i in model_time_years
-    ], dtype=int)
-    # unique years in model time period:
-    model_years = np.unique(all_model_years)
-    model_years.sort()
-    # init list for rf means:
-    model_rf_means = []
-    # for each unique year:
-    for model_year in model_years:
-        # get mean of all values for this year:
-        model_rf_means.append(
-            np.nanmean(model_rf_anom[all_model_years == model_year])
-        )
-    # set up volcanic forcing values for fair, using ar5 values.
-    # need an array of same size as rcp45 emissions, init as -0.06 background
-    # forcing value:
-    ar5_volcanic = np.zeros(rcp45.Emissions.year.shape) - 0.06
-    # add in values available from ar5 data where available:
-    for rcp45_index, rcp45_year in enumerate(rcp45.Emissions.year):
-        # look for ar5 value for this year:
-        ar5_index = np.where(ar5.Forcing.year == rcp45_year)
-        if ar5_index[0].size > 0:
-            ar5_volcanic[rcp45_index] = ar5.Forcing.volcanic[ar5_index]
-    # update 2011 -> 2015 as per Schmidt et al (2018):
-    ar5_volcanic[rcp45.Emissions.year == 2011] = -0.11
-    ar5_volcanic[rcp45.Emissions.year == 2012] = -0.10
-    ar5_volcanic[rcp45.Emissions.year == 2013] = -0.03
-    ar5_volcanic[rcp45.Emissions.year == 2014] = -0.11
-    ar5_volcanic[rcp45.Emissions.year == 2015] = -0.17
-    # update 2019 for raikoke guess -0.20 w m-2
-    ar5_volcanic[rcp45.Emissions.year == 2019] = -0.20
-    # set background forcing for eruption year -> eruption year + 2 to be
-    # -0.06:
-    ar5_volcanic_bg = ar5_volcanic.copy()
-    ar5_volcanic_bg[
-        (user_params['year'] <= rcp45.Emissions.year) &
-        (rcp45.Emissions.year < user_params['year'] + 4)
-    ] = -0.06
-    # run fair without eva_h updates:
-    fair_result = fair_scm(
-        emissions=rcp45.Emissions.emissions,
-        F_volcanic=ar5_volcanic_bg
+    # annual global mean rf values for fair:
+    model_years, model_rf_means = __annual_means(
+        model_time_years, model_rf_anom
     )
-    forcing_a = fair_result[1]
-    temp_a = fair_result[2]
-    # update volcanic forcing values with those from eva_h:
-    for i, model_year in enumerate(model_years):
-        ar5_volcanic_bg[rcp45.Emissions.year == model_year] += model_rf_means[i]
+    # fair without eva_h updates depends only on the eruption years, so is
+    # usually precomputed for a single eruption year:
+    with stage_timer('fair_baseline'):
+        forcing_a, temp_a = get_baseline(user_params['year'])
     # run fair with eva_h updates:
-    fair_result = fair_scm(
-        emissions=rcp45.Emissions.emissions,
-        F_volcanic=ar5_volcanic_bg
-    )
-    forcing_b = fair_result[1]
-    temp_b = fair_result[2]
-    # get required values for year of eruption +/-10.
-    # init lists for values:
-    fair_years = []
-    fair_rf_wo = []
-    fair_rf = []
-    fair_temp_wo = []
-    fair_temp = []
-    # loop through years:
-    for i in np.arange(model_years.min() - 10, model_years.min() + 11):
-        # store the year:
-        fair_years.append(int(i))
-        # get the index for this year:
-        fair_index = np.where(rcp45.Emissions.year == i)[0][0]
-        # store required values:
-        fair_rf_wo.append(forcing_a[:, 11][fair_index])
-        fair_rf.append(forcing_b[:, 11][fair_index])
-        fair_temp_wo.append(temp_a[fair_index])
-        fair_temp.append(temp_b[fair_index])
-    # round values and convert to list for json output:
-    model_rf = np.round(model_rf, 6).tolist()
-    fair_rf_wo = np.round(fair_rf_wo, 6).tolist()
-    fair_rf = np.round(fair_rf, 6).tolist()
-    fair_temp_wo = np.round(fair_temp_wo, 6).tolist()
-    fair_temp = np.round(fair_temp, 6).tolist()
-    # wavelengths * 1000 (nm):
-    model_wavelengths = np.round(wavelengths * 1000, 6).tolist()
-    # data dict for output:
+    with stage_timer('fair'):
+        forcing_b, temp_b = __run_fair_eva_h(
+            user_params, model_years, model_rf_means, fair_cache
+        )
+    # get required values for year of first eruption -10 to year of last
+    # eruption +10:
+    fair_years, fair_index = __fair_window(user_params, model_years)
+    fair_rf_wo = forcing_a[fair_index]
+    fair_rf = forcing_b[fair_index]
+    fair_temp_wo = temp_a[fair_index]
+    fair_temp = temp_b[fair_index]
+    # data dict for output, with wavelengths in nm. numeric values are
+    # numpy arrays, which are converted to lists for json output:
     model_data = {
         'time_years': model_time_years,
         'time_dates': model_time_dates,
-        'lat': model_lat,
-        'wavelengths': model_wavelengths,
+        'lat': lat,
+        'wavelengths': np.round(wavelengths * 1000, 6),
         'saod_ts': model_saod_ts,
-        'saod': model_saod,
-        'rf_ts': model_rf,
+        'rf_ts': np.round(model_rf, 6),
         'fair_years': fair_years,
-        'fair_rf_wo': fair_rf_wo,
-        'fair_rf': fair_rf,
-        'fair_temp_wo': fair_temp_wo,
-        'fair_temp': fair_temp
+        'fair_rf_wo': np.round(fair_rf_wo, 6),
+        'fair_rf': np.round(fair_rf, 6),
+        'fair_temp_wo': np.round(fair_temp_wo, 6),
+        'fair_temp': np.round(fair_temp, 6)
     }
-    # if netcdf data has been requested:
-    if user_params['nc']:
-        model_data['nc'] = data_to_nc(
-            model_time_dates, lat, alt, wavelengths * 1000,
-            ext, ssa, asy, saod
-        )
-    else:
-        model_data['nc'] = ''
+    # 2d saod, (wavelength, lat, time), unless only global means are
+    # requested:
+    if user_params['output'] != OUTPUT_GLOBAL:
+        model_data['saod'] = np.round(saod.transpose(2, 1, 0), 6)
+    # if uncertainty bands have been requested:
+    if user_params['samples']:
+        with stage_timer('uncertainty'):
+            model_data['uncertainty'] = __model_uncertainty(
+                eva_h_dir, user_params, model_run, model_saod_ts_ref,
+                fair_cache
+            )
     # return the data:
     return model_data
 
-def run_model(eva_h_dir, request_params):
+def __run_stages(eva_h_dir, user_params, full=False):
+    """
+    Run the model and post processing, returning the model run set up,
+    sulfate mass, post processing outputs and the stage key of the post
+    processing outputs
+
+    Each stage is cached by the inputs it depends on, so that runs which
+    change only later inputs reuse earlier stages.
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param user_params: User supplied parameters
+    :param full: Whether to calculate the full (time, latitude, altitude,
+                 wavelength) optical properties
+    """
+    # set up the model run:
+    model_run = __setup_run(eva_h_dir, user_params)
+    model_params = model_run['model_params']
+    # run the model:
+    solve_key = model_run['injection_key'] + stage_key(
+        user_params['aerosol_timescale'], user_params['solver']
+    )
+    with stage_timer('solve'):
+        so4_mass = STAGE_CACHES['solve'].get(
+            solve_key, lambda: solve_so4_mass(
+                model_run['inmass'], model_run['intime'], model_params,
+                model_run['tspan'], model_run['tref'],
+                method=user_params['solver']
+            )
+        )
+    # run the post processing, spatial fields then optical properties:
+    with stage_timer('postproc_spatial'):
+        ext525, reff, lat, alt = STAGE_CACHES['spatial'].get(
+            solve_key, lambda: postproc_spatial(
+                eva_h_dir, so4_mass, model_params, model_params.mstar,
+                model_params.R_reff
+            )
+        )
+    # only the global mean saod is calculated if only global means are
+    # output:
+    global_only = (not full) and (user_params['output'] == OUTPUT_GLOBAL)
+    optics_key = solve_key + stage_key(
+        user_params['wavelengths'], full, global_only
+    )
+    with stage_timer('postproc_optics'):
+        if global_only:
+            gmsaod = STAGE_CACHES['optics'].get(
+                optics_key, lambda: postproc_global(
+                    eva_h_dir, ext525, reff, user_params['wavelengths']
+                )
+            )
+            saod, ext, ssa, asy = None, None, None, None
+        else:
+            gmsaod, saod, ext, ssa, asy = STAGE_CACHES['optics'].get(
+                optics_key, lambda: postproc_optics(
+                    eva_h_dir, ext525, reff, user_params['wavelengths'], full
+                )
+            )
+    postproc_out = (gmsaod, saod, reff, ext, ssa, asy, lat, alt)
+    # return the stage outputs:
+    return model_run, so4_mass, postproc_out, optics_key
+
+def __run_model(eva_h_dir, user_params):
+    """
+    Main model running function
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param user_params: User supplied parameters
+    """
+    # run the model and post processing:
+    model_run, so4_mass, postproc_out, _ = __run_stages(
+        eva_h_dir, user_params
+    )
+    # return the output data:
+    return __model_output(
+        eva_h_dir, user_params, model_run, so4_mass, postproc_out
+    )
+
+def __run_model_nc(eva_h_dir, user_params):
+    """
+    Run the model and return the NetCDF file contents, and the time taken
+    to encode the file, in seconds
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param user_params: User supplied parameters
+    """
+    # run the model and post processing:
+    model_run, _, postproc_out, optics_key = __run_stages(
+        eva_h_dir, user_params, full=True
+    )
+    _, saod, _, ext, ssa, asy, lat, alt = postproc_out
+    # create the netcdf file, timing the encoding:
+    def encode_nc():
+        encode_start = time.perf_counter()
+        with stage_timer('nc_encode'):
+            nc_mem = data_to_nc(
+                model_run['model_time_dates'], lat, alt,
+                user_params['wavelengths'] * 1000, ext, ssa, asy, saod,
+                user_params['nc_encoding']
+            )
+        return nc_mem, time.perf_counter() - encode_start
+    encoding_key = optics_key + stage_key(
+        *sorted(user_params['nc_encoding'].items())
+    )
+    return STAGE_CACHES['encoding'].get(encoding_key, encode_nc)
+
+def __solve_batch(model_runs, methods):
+    """
+    Run the model for a batch of runs, returning a list of sulfate mass
+    arrays
+
+    Runs using the propagator are solved together as one batch, padding
+    runs to the same number of output times and eruptions.
+
+    :param model_runs: List of model run set ups, from __setup_run
+    :param methods: List of solver methods for each run
+    """
+    # init list for sulfate mass:
+    so4_masses = [None] * len(model_runs)
+    # runs which can be solved with the batched propagator:
+    batch_index = [
+        i for i, model_run in enumerate(model_runs)
+        if (methods[i] == PROPAGATOR) and
+        constant_transport(model_run['model_params'])
+    ]
+    if batch_index:
+        batch_runs = [model_runs[i] for i in batch_index]
+        time_count = max(i['tref'].size for i in batch_runs)
+        eruption_count = max(i['intime'].size for i in batch_runs)
+        # pad output times with the last output time, and eruptions with
+        # zero mass eruptions at the start time:
+        inmass = np.zeros((len(batch_runs), 8, eruption_count))
+        intime = np.zeros((len(batch_runs), eruption_count))
+        tref = np.zeros((len(batch_runs), time_count))
+        for i, model_run in enumerate(batch_runs):
+            run_eruptions = model_run['intime'].size
+            inmass[i, :, :run_eruptions] = model_run['inmass']
+            intime[i, :] = model_run['tspan'][0]
+            intime[i, :run_eruptions] = model_run['intime']
+            tref[i, :] = model_run['tref'][-1]
+            tref[i, :model_run['tref'].size] = model_run['tref']
+        # run the model:
+        so4_mass = solve_so4_mass_propagator_batch(
+            inmass, intime, batch_runs[0]['model_params'],
+            np.array([i['model_params'].tauprod for i in batch_runs]),
+            np.array([i['tspan'] for i in batch_runs], dtype=float), tref
+        )
+        for i, j in enumerate(batch_index):
+            so4_masses[j] = so4_mass[i, :model_runs[j]['tref'].size]
+    # run the model for any remaining runs:
+    for i, model_run in enumerate(model_runs):
+        if so4_masses[i] is None:
+            so4_masses[i] = solve_so4_mass(
+                model_run['inmass'], model_run['intime'],
+                model_run['model_params'], model_run['tspan'],
+                model_run['tref'], method=methods[i]
+            )
+    # return the sulfate mass:
+    return so4_masses
+
+def __postproc_groups(model_runs, wavelengths, global_only):
+    """
+    Group runs in a batch for post processing, returning a list of lists of
+    run indexes
+
+    The post processing is independent at each time step, so runs with the
+    same wavelengths and output level can be processed together, with their
+    time steps concatenated. Groups are limited to POSTPROC_BATCH_STEPS time
+    steps, to limit memory use.
+
+    :param model_runs: List of model run set ups, from __setup_run
+    :param wavelengths: List of wavelength arrays for each run
+    :param global_only: List of whether only global means are output, for
+                        each run
+    """
+    # group runs by wavelengths and output level:
+    wl_groups = {}
+    for i, run_wavelengths in enumerate(wavelengths):
+        wl_groups.setdefault(
+            (tuple(run_wavelengths), global_only[i]), []
+        ).append(i)
+    # split groups by number of time steps:
+    groups = []
+    for group_index in wl_groups.values():
+        group = []
+        group_steps = 0
+        for i in group_index:
+            run_steps = model_runs[i]['tref'].size
+            if group and (group_steps + run_steps > POSTPROC_BATCH_STEPS):
+                groups.append(group)
+                group = []
+                group_steps = 0
+            group.append(i)
+            group_steps += run_steps
+        groups.append(group)
+    # return the groups:
+    return groups
+
+def __postproc_group(eva_h_dir, model_params, so4_masses, wavelengths,
+                     global_only=False):
+    """
+    Run the post processing for a group of runs with the same wavelengths,
+    returning a list of postproc outputs
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param model_params: ModelParams object
+    :param so4_masses: List of sulfate mass arrays, (time, box)
+    :param wavelengths: Numpy array of wavelengths, in um
+    :param global_only: Whether only the global mean saod is calculated, in
+                        which case the other optical properties are None
+    """
+    if global_only:
+        ext525, reff, lat, alt = postproc_spatial(
+            eva_h_dir, np.concatenate(so4_masses), model_params,
+            model_params.mstar, model_params.R_reff
+        )
+        group_out = (
+            postproc_global(eva_h_dir, ext525, reff, wavelengths), None,
+            reff, None, None, None, lat, alt
+        )
+    else:
+        group_out = postproc(
+            eva_h_dir, np.concatenate(so4_masses), model_params,
+            model_params.mstar, model_params.R_reff, wavelengths,
+            full=False
+        )
+    # split the time dependent outputs back into runs:
+    postproc_outs = []
+    time_start = 0
+    for so4_mass in so4_masses:
+        time_end = time_start + so4_mass.shape[0]
+        postproc_outs.append(tuple(
+            None if i is None else i[time_start:time_end]
+            for i in group_out[:6]
+        ) + group_out[6:])
+        time_start = time_end
+    # return the postproc outputs:
+    return postproc_outs
+
+def __run_model_batch(eva_h_dir, batch_user_params):
+    """
+    Main model running function for a batch of runs, returning a list of
+    output data
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param batch_user_params: List of user supplied parameters
+    """
+    # set up the model runs:
+    model_runs = [__setup_run(eva_h_dir, i) for i in batch_user_params]
+    # run the model:
+    with stage_timer('solve'):
+        so4_masses = __solve_batch(
+            model_runs, [i['solver'] for i in batch_user_params]
+        )
+    # fair results are shared between runs with identical forcing:
+    fair_cache = {}
+    # init list for output data:
+    batch_data = [None] * len(model_runs)
+    # run the post processing for each group of runs, and get the output
+    # data:
+    model_params = model_runs[0]['model_params']
+    global_only = [
+        i['output'] == OUTPUT_GLOBAL for i in batch_user_params
+    ]
+    for group in __postproc_groups(
+        model_runs, [i['wavelengths'] for i in batch_user_params],
+        global_only
+    ):
+        with stage_timer('postproc'):
+            postproc_outs = __postproc_group(
+                eva_h_dir, model_params, [so4_masses[i] for i in group],
+                batch_user_params[group[0]]['wavelengths'],
+                global_only[group[0]]
+            )
+        for i, postproc_out in zip(group, postproc_outs):
+            batch_data[i] = __model_output(
+                eva_h_dir, batch_user_params[i], model_runs[i],
+                so4_masses[i], postproc_out, fair_cache=fair_cache
+            )
+    # return the output data:
+    return batch_data
+
+def __data_to_lists(model_data):
+    """
+    Return model output data with numpy arrays converted to lists, for json
+    output
+
+    :param model_data: Dict of model output data
+    """
+    return {
+        i: j.tolist() if isinstance(j, np.ndarray) else
+        __data_to_lists(j) if isinstance(j, dict) else j
+        for i, j in model_data.items()
+    }
+
+def run_model(eva_h_dir, request_params, arrays=False, user_params=None):
     """
     Wrapper function for running model
 
     :param eva_h_dir: Directory containing EVA_H data files
     :param request_params: POST supplied parameters
+    :param arrays: If True, numeric values in the result data are numpy
+                   arrays, otherwise they are lists
+    :param user_params: Optional parameters from check_params, if the
+                        request parameters are already checked
     """
     # init result dict:
     result = {
@@ -503,21 +1158,72 @@ def run_model(eva_h_dir, request_params):
         'message': '',
         'data': {}
     }
-    # check user parameters:
-    status, user_params, err_msg = check_params(request_params)
-    # if that failed ... :
-    if not status:
-        # updata result dict:
+    # check user parameters, if not already checked:
+    if user_params is None:
+        status, user_params, err_msg = check_params(request_params)
+        # if that failed ... :
+        if not status:
+            # updata result dict:
+            result['status'] = 1
+            result['message'] = err_msg
+            # return the result:
+            return result
+    # try to run the model. the run sets values in the parameters, so uses
+    # a copy:
+    try:
+        model_data = __run_model(eva_h_dir, dict(user_params))
+        result['status'] = 0
+        result['message'] = 'model run suceeded'
+        if arrays:
+            result['data'] = model_data
+        else:
+            with stage_timer('json'):
+                result['data'] = __data_to_lists(model_data)
+    # if that fails:
+    except Exception as err_msg:
+        sys.stderr.write('[{0}] [ERROR] {1}\n'.format(
+            datetime.datetime.now(), err_msg
+        ))
         result['status'] = 1
-        result['message'] = err_msg
-        # return the result:
-        return result
-    # try to run the model:
+        result['message'] = 'model run failed'
+    # return the result:
+    return result
+
+def run_model_nc(eva_h_dir, request_params, user_params=None):
+    """
+    Wrapper function for running model and returning NetCDF data. The
+    result data is a read only memoryview of the NetCDF file contents, and
+    the result also includes the time taken to encode the file, in seconds
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param request_params: POST supplied parameters
+    :param user_params: Optional parameters from check_params, if the
+                        request parameters are already checked
+    """
+    # init result dict:
+    result = {
+        'status': -1,
+        'message': '',
+        'data': None
+    }
+    # check user parameters, if not already checked:
+    if user_params is None:
+        status, user_params, err_msg = check_params(request_params)
+        # if that failed ... :
+        if not status:
+            # updata result dict:
+            result['status'] = 1
+            result['message'] = err_msg
+            # return the result:
+            return result
+    # try to run the model. the run sets values in the parameters, so uses
+    # a copy:
     try:
-        model_data = __run_model(eva_h_dir, user_params)
+        result['data'], result['encode_time'] = __run_model_nc(
+            eva_h_dir, dict(user_params)
+        )
         result['status'] = 0
         result['message'] = 'model run suceeded'
-        result['data'] = model_data
     # if that fails:
     except Exception as err_msg:
         sys.stderr.write('[{0}] [ERROR] {1}\n'.format(
@@ -527,3 +1233,82 @@ def run_model(eva_h_dir, request_params):
         result['message'] = 'model run failed'
     # return the result:
     return result
+
+def run_model_batch(eva_h_dir, batch_params):
+    """
+    Wrapper function for running model for a batch of scenarios
+
+    Valid scenarios are run together. The result data contains the result
+    for each scenario, in the same format as the result of run_model, keyed
+    by scenario name, or by position in the batch if a list of scenarios is
+    supplied.
+
+    :param eva_h_dir: Directory containing EVA_H data files
+    :param batch_params: Dict of scenario parameters keyed by scenario name,
+                         or list of scenario parameters
+    """
+    # init result dict:
+    result = {
+        'status': -1,
+        'message': '',
+        'data': {}
+    }
+    # check the batch:
+    if isinstance(batch_params, list):
+        batch_params = {str(i): j for i, j in enumerate(batch_params)}
+    if (not isinstance(batch_params, dict)) or \
+       (not all(isinstance(i, dict) for i in batch_params.values())):
+        result['status'] = 1
+        result['message'] = 'invalid batch parameters'
+        return result
+    if not 1 <= len(batch_params) <= MAX_BATCH_SCENARIOS:
+        result['status'] = 1
+        result['message'] = 'number of scenarios should not be less than 1'
+        result['message'] += ' or greater than {0} ({1})'.format(
+            MAX_BATCH_SCENARIOS, len(batch_params)
+        )
+        return result
+    # check user parameters for each scenario:
+    batch_names = []
+    batch_user_params = []
+    for scenario_name, request_params in batch_params.items():
+        status, user_params, err_msg = check_params(request_params)
+        if status:
+            batch_names.append(scenario_name)
+            batch_user_params.append(user_params)
+        else:
+            result['data'][scenario_name] = {
+                'status': 1,
+                'message': err_msg,
+                'data': {}
+            }
+    # try to run the model for valid scenarios:
+    try:
+        if batch_user_params:
+            batch_data = __run_model_batch(eva_h_dir, batch_user_params)
+            with stage_timer('json'):
+                for scenario_name, model_data in zip(batch_names,
+                                                     batch_data):
+                    result['data'][scenario_name] = {
+                        'status': 0,
+                        'message': 'model run suceeded',
+                        'data': __data_to_lists(model_data)
+                    }
+        result['status'] = 0
+        result['message'] = 'batch run suceeded'
+    # if that fails:
+    except Exception as err_msg:
+        sys.stderr.write('[{0}] [ERROR] {1}\n'.format(
+            datetime.datetime.now(), err_msg
+        ))
+        for scenario_name in batch_names:
+            result['data'][scenario_name] = {
+                'status': 1,
+                'message': 'model run failed',
+                'data': {}
+            }
+        result['status'] = 1
+        result['message'] = 'batch run failed'
+    # return the result, with scenarios in the order supplied:
+    result['data'] = {i: result['data'][i] for i in batch_params}
+    return result
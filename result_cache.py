@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content addressed store of model results, shared between worker processes.
+
+Results are keyed by a hash of the checked model parameters, so requests
+which differ only in formatting (e.g. '15' and '15.0') share a result. The
+store is a SQLite database, which all workers on the host can see, and is
+limited in size by evicting the least recently used results.
+"""
+
+# --- imports
+
+# std lib imports:
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+# third party imports:
+import numpy as np
+
+# --- global variables
+
+# version of the model results. change this whenever what is stored for the
+# same checked parameters changes, so that old results are not served. this
+# includes model output values, e.g. the default solver or fair mode, the
+# outputs of each output level, and the binary and NetCDF encodings:
+RESULTS_VERSION = '6'
+# default store file and maximum size of stored results, in bytes:
+CACHE_FILE = os.sep.join([tempfile.gettempdir(), 'volc2clim_results.sqlite'])
+CACHE_SIZE = 256 * 1024 * 1024
+# seconds to wait for the database lock:
+CACHE_TIMEOUT = 10
+
+# ---
+
+def __canonical_value(value):
+    """
+    Convert a parameter value to a JSON serialisable value
+
+    :param value: Parameter value
+    """
+    if isinstance(value, np.ndarray):
+        return [__canonical_value(i) for i in value.tolist()]
+    if isinstance(value, (np.generic, float)):
+        return float(value)
+    return value
+
+def result_key(user_params):
+    """
+    Return the result key for checked model parameters, or None if the
+    result can not be cached, i.e. random samples without a seed
+
+    :param user_params: Model parameters, as returned by check_params
+    """
+    if user_params.get('samples') and (user_params.get('seed') is None):
+        return None
+    canonical_params = json.dumps({
+        i: __canonical_value(j) for i, j in user_params.items()
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(
+        '{0}:{1}'.format(RESULTS_VERSION, canonical_params).encode()
+    ).hexdigest()
+
+class ResultCache:
+    """
+    SQLite store of model results, as JSON, keyed by result key
+
+    :param cache_file: SQLite database file
+    :param max_size: Maximum total size of stored results, in bytes
+    """
+    def __init__(self, cache_file=CACHE_FILE, max_size=CACHE_SIZE):
+        self.cache_file = cache_file
+        self.max_size = max_size
+        # connections are per thread:
+        self.__local = threading.local()
+        with self.__connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                'size INTEGER NOT NULL, last_used REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS results_last_used '
+                'ON results (last_used)'
+            )
+
+    def __connect(self):
+        """
+        Return the SQLite connection for this thread
+        """
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.cache_file, timeout=CACHE_TIMEOUT)
+            # write ahead logging lets workers read while another writes:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.__local.conn = conn
+        return conn
+
+    def get(self, key):
+        """
+        Return the stored JSON result for a key, or None if not stored
+
+        :param key: Result key
+        """
+        with self.__connect() as conn:
+            row = conn.execute(
+                'SELECT value FROM results WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE results SET last_used = ? WHERE key = ?',
+                (time.time(), key)
+            )
+        return zlib.decompress(row[0])
+
+    def put(self, key, value):
+        """
+        Store a JSON result, evicting least recently used results if the
+        store is over size
+
+        :param key: Result key
+        :param value: JSON result, as bytes
+        """
+        value = zlib.compress(value, 1)
+        with self.__connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                (key, value, len(value), time.time())
+            )
+            total_size = conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM results'
+            ).fetchone()[0]
+            if total_size > self.max_size:
+                # delete oldest results until under size:
+                rows = conn.execute(
+                    'SELECT key, size FROM results ORDER BY last_used'
+                ).fetchall()
+                evict_keys = []
+                for row_key, row_size in rows:
+                    if total_size <= self.max_size:
+                        break
+                    evict_keys.append((row_key,))
+                    total_size -= row_size
+                conn.executemany(
+                    'DELETE FROM results WHERE key = ?', evict_keys
+                )
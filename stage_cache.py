@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+In memory caches for the stages of a model run.
+
+Each stage (injection, sulfate solve, spatial fields, optical properties,
+FAIR and NetCDF encoding) is cached by a key made from the inputs it
+depends on, so that a run which changes one input only reruns the stages
+which depend on that input. Caches are per process, and hold a limited
+number of entries, and optionally a limited total size of numpy arrays and
+bytes, evicting the least recently used.
+"""
+
+# --- imports
+
+# std lib imports:
+from collections import OrderedDict
+import threading
+
+# third party imports:
+import numpy as np
+
+# ---
+
+def stage_key(*values):
+    """
+    Return a hashable cache key for a set of stage inputs, converting numpy
+    arrays to tuples
+
+    :param values: Stage input values
+    """
+    return tuple(
+        tuple(np.ravel(i).tolist()) if isinstance(i, np.ndarray) else i
+        for i in values
+    )
+
+class StageCache:
+    """
+    Least recently used cache for the outputs of a model run stage
+
+    :param max_entries: Maximum number of cached outputs
+    :param max_bytes: Optional maximum total size of the cached outputs, in
+                      bytes. An output larger than this is not cached
+    """
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # cached outputs and their sizes, in bytes:
+        self.__entries = OrderedDict()
+        self.__sizes = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __read_only(value):
+        """
+        Make numpy arrays in a stage output read only, as they are shared
+        between runs
+
+        :param value: Stage output, a numpy array or a tuple of outputs
+        """
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+        elif isinstance(value, tuple):
+            for i in value:
+                StageCache.__read_only(i)
+
+    @staticmethod
+    def __nbytes(value):
+        """
+        Return the size in bytes of the numpy arrays and bytes in a stage
+        output
+
+        :param value: Stage output
+        """
+        if isinstance(value, (np.ndarray, memoryview)):
+            return value.nbytes
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        if isinstance(value, (tuple, list)):
+            return sum(StageCache.__nbytes(i) for i in value)
+        return 0
+
+    def get(self, key, compute):
+        """
+        Return the cached output for a key, calculating and caching the
+        output if it is not cached
+
+        :param key: Cache key, from stage_key
+        :param compute: Function with no arguments which calculates the
+                        output
+        """
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                return self.__entries[key]
+        # calculate without holding the lock, so that other stages and
+        # threads are not blocked:
+        value = compute()
+        self.__read_only(value)
+        value_size = self.__nbytes(value)
+        if (self.max_bytes is not None) and (value_size > self.max_bytes):
+            return value
+        with self.__lock:
+            self.__entries[key] = value
+            self.__sizes[key] = value_size
+            self.__entries.move_to_end(key)
+            while (len(self.__entries) > self.max_entries) or (
+                    (self.max_bytes is not None) and
+                    (sum(self.__sizes.values()) > self.max_bytes)
+            ):
+                old_key, _ = self.__entries.popitem(last=False)
+                del self.__sizes[old_key]
+        return value
+
+    def clear(self):
+        """
+        Remove all cached outputs
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.__sizes.clear()
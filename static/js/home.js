@@ -4,6 +4,8 @@
 
 /* url for running model: */
 var model_url = '/model';
+/* mime type of binary model results: */
+var model_binary_type = 'application/x-volc2clim-arrays';
 
 /* model parameters: */
 var model_params = {
@@ -1158,6 +1160,75 @@ function display_stats() {
   };
 };
 
+/*
+ * decode a binary model result (see binary_format.py). arrays are returned
+ * as typed arrays, with arrays of more than one dimension split in to
+ * nested arrays of typed array rows, which share the response buffer:
+ */
+function decode_model_binary(buffer) {
+  var bytes = new Uint8Array(buffer);
+  var view = new DataView(buffer);
+  /* check the format identifier: */
+  if (String.fromCharCode.apply(null, bytes.subarray(0, 4)) != 'V2CB') {
+    throw new Error('invalid binary model result');
+  };
+  /* read the json header: */
+  var header_len = view.getUint32(4, true);
+  var header_end = 8 + header_len;
+  var result = JSON.parse(
+    new TextDecoder().decode(bytes.subarray(8, header_end))
+  );
+  /* array data starts at a multiple of 8 bytes: */
+  var data_start = header_end + ((8 - (header_end % 8)) % 8);
+  /* split typed array values in to nested rows: */
+  function nest_array(values, shape) {
+    if (shape.length <= 1) {
+      return values;
+    };
+    var row_size = values.length / shape[0];
+    var rows = [];
+    for (var i = 0; i < shape[0]; i++) {
+      rows.push(nest_array(
+        values.subarray(i * row_size, (i + 1) * row_size), shape.slice(1)
+      ));
+    };
+    return rows;
+  };
+  /* add each array to the result data. data is little endian, as are the
+     typed arrays on all supported platforms: */
+  for (var i = 0; i < result['arrays'].length; i++) {
+    var array_info = result['arrays'][i];
+    var array_size = array_info['shape'].reduce(function(a, b) {
+      return a * b;
+    }, 1);
+    var array_types = {
+      'int32': Int32Array, 'float32': Float32Array, 'float64': Float64Array
+    };
+    var array_type = array_types[array_info['dtype']];
+    var values = new array_type(
+      buffer, data_start + array_info['offset'], array_size
+    );
+    var path = array_info['path'];
+    var parent = result['data'];
+    for (var j = 0; j < path.length - 1; j++) {
+      if (!(path[j] in parent)) {
+        parent[path[j]] = {};
+      };
+      parent = parent[path[j]];
+    };
+    parent[path[path.length - 1]] = nest_array(values, array_info['shape']);
+  };
+  delete result['arrays'];
+  /* return the result: */
+  return result;
+};
+
+/* round a model value to 6 decimal places, as float32 values from binary
+   results are not exact: */
+function round_value(value) {
+  return parseFloat(value.toFixed(6));
+};
+
 /* run the model by posting parameters: */
 function __run_model(model_params) {
   /* init result variable: */
@@ -1198,11 +1269,13 @@ function __run_model(model_params) {
   };
   /* create new request: */
   var model_req = new XMLHttpRequest();
-  model_req.responseType = 'json';
+  model_req.responseType = 'arraybuffer';
   model_req.open('POST', model_url, true);
   model_req.setRequestHeader(
     'Content-type', 'application/x-www-form-urlencoded'
   );
+  /* request results in the binary format: */
+  model_req.setRequestHeader('Accept', model_binary_type);
   /* on request load: */
   model_req.onload = function() {
     /* if not successful: */
@@ -1210,7 +1283,13 @@ function __run_model(model_params) {
       model_req_error();
     } else {
       /* model results: */
-      model_result = model_req.response;
+      try {
+        model_result = decode_model_binary(model_req.response);
+      } catch (err) {
+        console.log(err);
+        model_req_error();
+        return;
+      };
       console.log('* model run result:');
       console.log(model_result['status'] + ': ' + model_result['message']);
       /* if model succeeded: */
@@ -1275,9 +1354,9 @@ async function get_csv_data() {
     /* add line to csv: */
     csv_data += time_dates[i] + ',';
     for (var j = 0; j < wavelengths.length; j++) {
-      csv_data += saod_ts[j][i] + ',';
+      csv_data += round_value(saod_ts[j][i]) + ',';
     };
-    csv_data += rf_ts[i] + '\r\n';
+    csv_data += round_value(rf_ts[i]) + '\r\n';
   };
   /* add csv data to zip file: */
   await zip_writer.add('saod_time_series.csv', new zip.TextReader(csv_data));
@@ -1298,7 +1377,7 @@ async function get_csv_data() {
       csv_data += time_dates[j] + ',' +
                   lat[i];
       for (var k = 0; k < wavelengths.length; k++) {
-        csv_data += ',' + saod[k][i][j];
+        csv_data += ',' + round_value(saod[k][i][j]);
       };
       csv_data += '\r\n';
     };
@@ -1317,10 +1396,10 @@ async function get_csv_data() {
   for (var i = 0; i < fair_years.length; i++) {
     /* add line to csv: */
     csv_data += fair_years[i] + ',' +
-                fair_rf_wo[i] + ',' +
-                fair_rf[i] + ',' +
-                fair_temp_wo[i] + ',' +
-                fair_temp[i] + '\r\n';
+                round_value(fair_rf_wo[i]) + ',' +
+                round_value(fair_rf[i]) + ',' +
+                round_value(fair_temp_wo[i]) + ',' +
+                round_value(fair_temp[i]) + '\r\n';
   };
   /* add csv data to zip file: */
   await zip_writer.add('fair_time_series.csv', new zip.TextReader(csv_data));
@@ -1341,15 +1420,13 @@ async function get_csv_data() {
 
 /* function to get data as netcdf: */
 async function get_nc_data() {
-  /* get base64 encdoded netcdf data: */
-  var nc_data = encodeURI(
-    'data:application/x-netcdf;base64,' +  model_data['nc']
-  );
-  /* name for csv file: */
+  /* url of netcdf data, which is downloaded directly from the server: */
+  var nc_url = model_data['nc_url'];
+  /* name for netcdf file: */
   var nc_name = 'model_data.nc';
   /* create a temporary link element: */
   var nc_link = document.createElement("a");
-  nc_link.setAttribute("href", nc_data);
+  nc_link.setAttribute("href", nc_url);
   nc_link.setAttribute("download", nc_name);
   nc_link.style.visibility = 'hidden';
   /* add link to document, click to init download, then remove: */
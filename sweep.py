@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+"""
+Code to run the EVA_H and FAIR models over a parameter sweep.
+
+The Cartesian product of the swept values of so2_mass, so2_height, lat,
+month and aerosol_timescale is run across a pool of worker processes, with
+the remaining parameters fixed. Results are written to a single NetCDF
+file, with one dimension per swept parameter, as each model run finishes.
+
+For example:
+
+    python sweep.py sweep.nc --so2_mass=1:50:50 --lat=-60:60:25 --year=1991
+
+Values which start with a minus sign, e.g. negative latitudes, must be
+given in the --option=value form, otherwise they are read as options.
+"""
+
+# --- imports
+
+# std lib imports:
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import datetime
+import itertools
+import os
+import sys
+
+# third party imports:
+import netCDF4 as nc
+import numpy as np
+
+# local imports:
+from eva_h.static_data import warm_up
+from model import (
+    check_params, run_model, FAIR_WINDOW_YEARS, OUTPUT_GLOBAL, RUN_YEARS
+)
+
+# --- global variables
+
+# path to eva_h directory:
+EVA_H_DIR = os.sep.join([
+    os.path.dirname(os.path.realpath(__file__)), 'eva_h'
+])
+# swept parameters, in dimension order, with their types and units:
+SWEEP_PARAMS = [
+    {'name': 'so2_mass', 'type': float, 'units': 'Tg'},
+    {'name': 'so2_height', 'type': float, 'units': 'km'},
+    {'name': 'lat', 'type': float, 'units': 'degrees_north'},
+    {'name': 'month', 'type': int, 'units': '1'},
+    {'name': 'aerosol_timescale', 'type': float, 'units': 'months'}
+]
+# default values for parameters which are not swept, as used on the web
+# page:
+DEFAULT_PARAMS = {
+    'wavelengths': '[550]',
+    'lat': '15.1',
+    'year': '2023',
+    'month': '1',
+    'so2_mass': '18',
+    'so2_height': '25',
+    'tropo_height': '16',
+    'aerosol_timescale': '8',
+    'rad_eff': '-21.5'
+}
+# number of model runs in progress per worker process:
+RUNS_PER_WORKER = 4
+
+# ---
+
+def __run_point(request_params):
+    """
+    Pool helper for running the model for a single sweep point, returning
+    output arrays, or None if the model run fails
+
+    :param request_params: Model parameters for this point
+    """
+    # check the parameters. only global mean values are stored:
+    status, user_params, err_msg = check_params(
+        dict(request_params, output=OUTPUT_GLOBAL)
+    )
+    if not status:
+        raise ValueError(err_msg)
+    # run the model. failures are logged by run_model:
+    result = run_model(
+        EVA_H_DIR, request_params, arrays=True, user_params=user_params
+    )
+    if result['status'] != 0:
+        return None
+    model_data = result['data']
+    # return output arrays, (time, wavelength) and (time) or (fair year):
+    return {
+        'saod_ts': np.array(model_data['saod_ts'], dtype=np.float32).T,
+        'rf_ts': np.array(model_data['rf_ts'], dtype=np.float32),
+        'fair_rf': np.array(model_data['fair_rf'], dtype=np.float32),
+        'fair_temp': np.array(model_data['fair_temp'], dtype=np.float32),
+        'fair_rf_wo': np.array(model_data['fair_rf_wo'], dtype=np.float32),
+        'fair_temp_wo': np.array(
+            model_data['fair_temp_wo'], dtype=np.float32
+        )
+    }
+
+def __create_nc(out_file, sweep_values, fixed_params, wavelengths):
+    """
+    Create the sweep NetCDF file, returning the open dataset
+
+    :param out_file: Output NetCDF file
+    :param sweep_values: Dict of swept values, keyed by parameter name
+    :param fixed_params: Dict of fixed parameter values
+    :param wavelengths: Numpy array of output wavelengths, in nm
+    """
+    # create the netcdf dataset:
+    nc_data = nc.Dataset(out_file, mode='w', format='NETCDF4')
+    # store the fixed parameters as attributes:
+    for param_name, param_value in fixed_params.items():
+        nc_data.setncattr(param_name, str(param_value))
+    nc_data.history = 'created {0} by sweep.py'.format(
+        datetime.datetime.now().isoformat(timespec='seconds')
+    )
+    # create the sweep dimensions and variables:
+    for param in SWEEP_PARAMS:
+        param_name = param['name']
+        nc_data.createDimension(param_name, sweep_values[param_name].size)
+        nc_param = nc_data.createVariable(
+            param_name, 'i' if param['type'] is int else 'f', (param_name)
+        )
+        nc_param[:] = sweep_values[param_name]
+        nc_param.units = param['units']
+    # create time dimension, in months since the eruption:
+    time_count = RUN_YEARS * 12 + 1
+    nc_data.createDimension('time', time_count)
+    nc_times = nc_data.createVariable('time', 'i', ('time'))
+    nc_times[:] = np.arange(time_count)
+    nc_times.long_name = 'time since eruption'
+    nc_times.units = 'months'
+    # create fair year dimension, in years since the eruption. the eruption
+    # year is fixed, so fair values are output for FAIR_WINDOW_YEARS either
+    # side of it:
+    fair_years = np.arange(-FAIR_WINDOW_YEARS, FAIR_WINDOW_YEARS + 1)
+    nc_data.createDimension('fair_year', fair_years.size)
+    nc_fair_years = nc_data.createVariable('fair_year', 'i', ('fair_year'))
+    nc_fair_years[:] = fair_years
+    nc_fair_years.long_name = 'years since eruption year'
+    nc_fair_years.units = 'years'
+    # create wavelength dimension:
+    nc_data.createDimension('wavelength', wavelengths.size)
+    nc_wls = nc_data.createVariable('wavelength', 'f', ('wavelength'))
+    nc_wls[:] = wavelengths
+    nc_wls.long_name = 'wavelength'
+    nc_wls.units = 'nm'
+    # create the output variables, chunked by sweep point:
+    sweep_dims = tuple(i['name'] for i in SWEEP_PARAMS)
+    out_vars = [
+        ('saod_ts', ('time', 'wavelength'),
+         'global mean stratospheric aerosol optical depth', '1'),
+        ('rf_ts', ('time',), 'global mean radiative forcing', 'W m-2'),
+        ('fair_rf', ('fair_year',), 'FaIR volcanic forcing', 'W m-2'),
+        ('fair_temp', ('fair_year',), 'FaIR temperature anomaly', 'K')
+    ]
+    for var_name, var_dims, long_name, units in out_vars:
+        nc_var = nc_data.createVariable(
+            var_name, 'f', sweep_dims + var_dims, zlib=True, complevel=1,
+            chunksizes=(1,) * len(sweep_dims) +
+            tuple(nc_data.dimensions[i].size for i in var_dims),
+            fill_value=np.float32(np.nan)
+        )
+        nc_var.long_name = long_name
+        nc_var.units = units
+    # the values without eva_h volcanic forcing depend only on the eruption
+    # year, which is fixed:
+    for var_name, long_name, units in [
+        ('fair_rf_wo', 'FaIR volcanic forcing without eruption', 'W m-2'),
+        ('fair_temp_wo', 'FaIR temperature anomaly without eruption', 'K')
+    ]:
+        nc_var = nc_data.createVariable(
+            var_name, 'f', ('fair_year'), fill_value=np.float32(np.nan)
+        )
+        nc_var.long_name = long_name
+        nc_var.units = units
+    # return the dataset:
+    return nc_data
+
+def run_sweep(out_file, sweep_values, fixed_params=None, max_workers=None):
+    """
+    Run the model for every combination of swept values, writing results to
+    a NetCDF file as each model run finishes, and return the number of
+    failed model runs
+
+    :param out_file: Output NetCDF file
+    :param sweep_values: Dict of swept values, keyed by parameter name, for
+                         any of so2_mass, so2_height, lat, month and
+                         aerosol_timescale
+    :param fixed_params: Dict of values for other model parameters, with
+                         defaults from DEFAULT_PARAMS
+    :param max_workers: Number of worker processes, defaults to cpu count
+    """
+    # fixed parameter values:
+    fixed_params = dict(DEFAULT_PARAMS, **(fixed_params or {}))
+    # all swept parameters, using the fixed value for parameters which are
+    # not swept:
+    sweep_values = {
+        param['name']: np.atleast_1d(np.array(
+            sweep_values.get(
+                param['name'], param['type'](fixed_params[param['name']])
+            ), dtype=param['type']
+        )) for param in SWEEP_PARAMS
+    }
+    for param in SWEEP_PARAMS:
+        fixed_params.pop(param['name'])
+    # check all sweep points before starting, so that invalid values are
+    # reported up front:
+    for param in SWEEP_PARAMS:
+        param_name = param['name']
+        for i in sweep_values[param_name]:
+            point_params = dict(
+                DEFAULT_PARAMS, **fixed_params, **{param_name: str(i)}
+            )
+            status, user_params, err_msg = check_params(point_params)
+            if not status:
+                raise ValueError(err_msg)
+    # output wavelengths:
+    wavelengths = np.round(user_params['wavelengths'] * 1000, 6)
+    # sweep point indexes:
+    sweep_shape = tuple(
+        sweep_values[i['name']].size for i in SWEEP_PARAMS
+    )
+    sweep_points = np.ndindex(*sweep_shape)
+    # number of worker processes:
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    # number of failed model runs:
+    fail_count = 0
+    with __create_nc(out_file, sweep_values, fixed_params,
+                     wavelengths) as nc_data:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=warm_up,
+            initargs=(EVA_H_DIR,)
+        ) as pool:
+            # keep a limited number of model runs in progress, so that the
+            # sweep points are not all held in memory:
+            max_running = max_workers * RUNS_PER_WORKER
+            running = {}
+            while True:
+                for sweep_index in itertools.islice(
+                    sweep_points, max_running - len(running)
+                ):
+                    point_params = dict(fixed_params, **{
+                        param['name']: str(
+                            sweep_values[param['name']][sweep_index[i]]
+                        ) for i, param in enumerate(SWEEP_PARAMS)
+                    })
+                    running[pool.submit(__run_point, point_params)] = \
+                        sweep_index
+                if not running:
+                    break
+                # write results as model runs finish:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sweep_index = running.pop(future)
+                    point_data = future.result()
+                    if point_data is None:
+                        fail_count += 1
+                        continue
+                    for var_name in ['saod_ts', 'rf_ts', 'fair_rf',
+                                     'fair_temp']:
+                        nc_data[var_name][sweep_index] = point_data[var_name]
+                    for var_name in ['fair_rf_wo', 'fair_temp_wo']:
+                        nc_data[var_name][:] = point_data[var_name]
+                nc_data.sync()
+    # return the number of failed model runs:
+    return fail_count
+
+def __sweep_values(sweep_arg, value_type):
+    """
+    Convert a command line sweep argument, either start:stop:count or a
+    comma separated list of values, to a numpy array
+
+    :param sweep_arg: Command line argument value
+    :param value_type: Type of the swept values
+    """
+    if ':' in sweep_arg:
+        start, stop, count = sweep_arg.split(':')
+        return np.linspace(
+            float(start), float(stop), int(count)
+        ).astype(value_type)
+    return np.array([value_type(i) for i in sweep_arg.split(',')])
+
+def __main():
+    """
+    Run a parameter sweep from the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='Run the EVA_H and FAIR models over a parameter sweep',
+        epilog='values which start with a minus sign must be given as '
+               '--option=value, e.g. --lat=-60:60:25'
+    )
+    parser.add_argument('out_file', help='output NetCDF file')
+    for param in SWEEP_PARAMS:
+        parser.add_argument(
+            '--{0}'.format(param['name']),
+            help='start:stop:count or comma separated values'
+        )
+    for param_name in ['year', 'tropo_height', 'rad_eff', 'wavelengths']:
+        parser.add_argument(
+            '--{0}'.format(param_name),
+            default=DEFAULT_PARAMS[param_name],
+            help='fixed value (default {0})'.format(
+                DEFAULT_PARAMS[param_name]
+            )
+        )
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of worker processes (default cpu count)'
+    )
+    args = parser.parse_args()
+    # swept and fixed values:
+    sweep_values = {
+        param['name']: __sweep_values(
+            getattr(args, param['name']), param['type']
+        ) for param in SWEEP_PARAMS
+        if getattr(args, param['name']) is not None
+    }
+    fixed_params = {
+        i: getattr(args, i)
+        for i in ['year', 'tropo_height', 'rad_eff', 'wavelengths']
+    }
+    # run the sweep:
+    fail_count = run_sweep(
+        args.out_file, sweep_values, fixed_params, args.workers
+    )
+    if fail_count:
+        sys.stderr.write('{0} model runs failed\n'.format(fail_count))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    __main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the NetCDF data url of model results. Run from the repository
+root by:
+
+    python -m pytest tests
+"""
+
+# --- imports
+
+# third party imports:
+import netCDF4 as nc
+import pytest
+
+# local imports:
+from app import app
+from sweep import DEFAULT_PARAMS
+
+# --- global variables
+
+# multi eruption parameters, as JSON values:
+ERUPTION_PARAMS = {
+    'lat': [15.1, -8],
+    'year': [1991, 1993],
+    'month': [6, 4],
+    'so2_mass': [15, 5],
+    'so2_height': [24, 20],
+    'tropo_height': [16.5, 16]
+}
+
+# ---
+
+def __nc_time_count(client, nc_url):
+    """
+    Return the number of times in the NetCDF data served from a url
+
+    :param client: Flask test client
+    :param nc_url: NetCDF data url
+    """
+    nc_response = client.get(nc_url)
+    assert nc_response.status_code == 200
+    with nc.Dataset('model_data.nc', memory=nc_response.get_data()) as \
+            nc_data:
+        return len(nc_data.dimensions['time'])
+
+@pytest.fixture
+def client():
+    """
+    Flask test client
+    """
+    return app.test_client()
+
+def test_form_nc_url(client):
+    """
+    The NetCDF data for a multi eruption /model request has the times of
+    the JSON result
+    """
+    form_params = dict(DEFAULT_PARAMS, output='full', **{
+        i: '[{0}]'.format(','.join(str(k) for k in j))
+        for i, j in ERUPTION_PARAMS.items()
+    })
+    result = client.post('/model', data=form_params).get_json()
+    assert result['status'] == 0
+    assert __nc_time_count(client, result['data']['nc_url']) == \
+        len(result['data']['time_years'])
+
+def test_batch_nc_url(client):
+    """
+    The NetCDF data for a multi eruption /model/batch scenario, with JSON
+    list parameters, has the times of the JSON result
+    """
+    batch_params = {'multi': dict(
+        DEFAULT_PARAMS, output='full', **ERUPTION_PARAMS
+    )}
+    result = client.post('/model/batch', json=batch_params).get_json()
+    scenario_result = result['data']['multi']
+    assert scenario_result['status'] == 0
+    assert __nc_time_count(client, scenario_result['data']['nc_url']) == \
+        len(scenario_result['data']['time_years'])
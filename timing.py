@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timing of the stages of a request, and latency histograms shared between
+worker processes.
+
+Timings are collected per thread, between start_timing and finish_timing,
+by wrapping each stage in stage_timer. A stage which runs more than once in
+a request, e.g. JSON conversion, has its times added together. Outside a
+request, e.g. in sweep.py, stage_timer does nothing.
+
+Finished request timings are added to histograms of request and stage
+latency. The timings of a request with a streamed body, e.g. NetCDF data,
+are finished before the body is sent, so the time to send the body is
+added to the histograms once it is sent, as the stream stage. The
+histograms are held in a SQLite database, which all workers on the host can
+see, and can be output in the Prometheus text format.
+"""
+
+# --- imports
+
+# std lib imports:
+import contextlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# --- global variables
+
+# default metrics database file:
+METRICS_FILE = os.sep.join([
+    tempfile.gettempdir(), 'volc2clim_metrics.sqlite'
+])
+# seconds to wait for the database lock:
+METRICS_TIMEOUT = 10
+# upper bounds of the latency histogram buckets, in seconds:
+TIMING_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60
+]
+# names of the histogram metrics:
+REQUEST_METRIC = 'volc2clim_request_duration_seconds'
+STAGE_METRIC = 'volc2clim_stage_duration_seconds'
+
+# timings for the request in progress in each thread:
+__TIMINGS = threading.local()
+
+# ---
+
+def start_timing():
+    """
+    Start collecting stage timings for a request in this thread
+    """
+    __TIMINGS.start = time.perf_counter()
+    __TIMINGS.stages = {}
+
+def finish_timing():
+    """
+    Stop collecting stage timings for this thread, returning the total
+    request time and a dict of stage times, in seconds, in the order the
+    stages first ran, or None if timings were not being collected
+    """
+    stages = getattr(__TIMINGS, 'stages', None)
+    if stages is None:
+        return None
+    total = time.perf_counter() - __TIMINGS.start
+    __TIMINGS.stages = None
+    return total, stages
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """
+    Time a stage of the request in progress in this thread, adding the time
+    to the stage timings
+
+    :param stage: Stage name
+    """
+    stages = getattr(__TIMINGS, 'stages', None)
+    if stages is None:
+        yield
+        return
+    stage_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[stage] = stages.get(stage, 0) + \
+            time.perf_counter() - stage_start
+
+def server_timing(total, stages, exclude=()):
+    """
+    Return a Server-Timing header value for request timings, with times in
+    milliseconds
+
+    :param total: Total request time, in seconds
+    :param stages: Dict of stage times, in seconds
+    :param exclude: Names of stages which are not included
+    """
+    return ', '.join(
+        '{0};dur={1:.1f}'.format(stage, stage_time * 1000)
+        for stage, stage_time in list(stages.items()) + [('total', total)]
+        if stage not in exclude
+    )
+
+class TimingMetrics:
+    """
+    SQLite store of request and stage latency histograms
+
+    :param metrics_file: SQLite database file
+    """
+    def __init__(self, metrics_file=METRICS_FILE):
+        self.metrics_file = metrics_file
+        # connections are per thread:
+        self.__local = threading.local()
+        with self.__connect() as conn:
+            # count of observations in each bucket, which are not
+            # cumulative:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS timing_buckets ('
+                'metric TEXT NOT NULL, label TEXT NOT NULL, '
+                'bucket INTEGER NOT NULL, count INTEGER NOT NULL, '
+                'PRIMARY KEY (metric, label, bucket))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS timing_totals ('
+                'metric TEXT NOT NULL, label TEXT NOT NULL, '
+                'count INTEGER NOT NULL, sum REAL NOT NULL, '
+                'PRIMARY KEY (metric, label))'
+            )
+
+    def __connect(self):
+        """
+        Return the SQLite connection for this thread
+        """
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.metrics_file, timeout=METRICS_TIMEOUT
+            )
+            # write ahead logging lets workers read while another writes:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.__local.conn = conn
+        return conn
+
+    @staticmethod
+    def __bucket_index(seconds):
+        """
+        Return the index of the histogram bucket for a time, where the index
+        len(TIMING_BUCKETS) is the +Inf bucket
+
+        :param seconds: Time in seconds
+        """
+        for i, bucket in enumerate(TIMING_BUCKETS):
+            if seconds <= bucket:
+                return i
+        return len(TIMING_BUCKETS)
+
+    @staticmethod
+    def __observations(endpoint, total, stages):
+        """
+        Return a list of (metric, label, bucket index, seconds) histogram
+        observations for request timings
+
+        :param endpoint: Name of the request endpoint
+        :param total: Total request time, in seconds
+        :param stages: Dict of stage times, in seconds
+        """
+        observations = [(REQUEST_METRIC, endpoint, total)]
+        observations += [(STAGE_METRIC, i, j) for i, j in stages.items()]
+        return [
+            (i, j, TimingMetrics.__bucket_index(k), k)
+            for i, j, k in observations
+        ]
+
+    def observe(self, endpoint, total, stages):
+        """
+        Add the timings of a request to the histograms
+
+        :param endpoint: Name of the request endpoint
+        :param total: Total request time, in seconds
+        :param stages: Dict of stage times, in seconds
+        """
+        observations = self.__observations(endpoint, total, stages)
+        with self.__connect() as conn:
+            conn.executemany(
+                'INSERT INTO timing_buckets VALUES (?, ?, ?, 1) '
+                'ON CONFLICT (metric, label, bucket) '
+                'DO UPDATE SET count = count + 1',
+                [(i, j, k) for i, j, k, _ in observations]
+            )
+            conn.executemany(
+                'INSERT INTO timing_totals VALUES (?, ?, 1, ?) '
+                'ON CONFLICT (metric, label) '
+                'DO UPDATE SET count = count + 1, sum = sum + excluded.sum',
+                [(i, j, l) for i, j, _, l in observations]
+            )
+
+    def prometheus_text(self):
+        """
+        Return the histograms in the Prometheus text format
+        """
+        with self.__connect() as conn:
+            bucket_rows = conn.execute(
+                'SELECT metric, label, bucket, count FROM timing_buckets'
+            ).fetchall()
+            total_rows = conn.execute(
+                'SELECT metric, label, count, sum FROM timing_totals '
+                'ORDER BY metric, label'
+            ).fetchall()
+        bucket_counts = {(i, j, k): l for i, j, k, l in bucket_rows}
+        # bucket labels, including the +Inf bucket:
+        bucket_bounds = ['{0:g}'.format(i) for i in TIMING_BUCKETS]
+        bucket_bounds.append('+Inf')
+        metric_info = [
+            (REQUEST_METRIC, 'endpoint', 'Request latency by endpoint'),
+            (STAGE_METRIC, 'stage', 'Model run stage latency by stage')
+        ]
+        lines = []
+        for metric, label_name, metric_help in metric_info:
+            lines.append('# HELP {0} {1}'.format(metric, metric_help))
+            lines.append('# TYPE {0} histogram'.format(metric))
+            for row_metric, label, count, seconds in total_rows:
+                if row_metric != metric:
+                    continue
+                label_text = '{0}="{1}"'.format(label_name, label)
+                # bucket counts are cumulative:
+                cumulative_count = 0
+                for i, bucket_bound in enumerate(bucket_bounds):
+                    cumulative_count += bucket_counts.get(
+                        (metric, label, i), 0
+                    )
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                        metric, label_text, bucket_bound, cumulative_count
+                    ))
+                lines.append('{0}_sum{{{1}}} {2!r}'.format(
+                    metric, label_text, seconds
+                ))
+                lines.append('{0}_count{{{1}}} {2}'.format(
+                    metric, label_text, count
+                ))
+        return '\n'.join(lines) + '\n'